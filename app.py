@@ -1,10 +1,15 @@
 """Main application entry point for Imagepulate."""
 
 import argparse
+from typing import Optional, Set
 
 from modules.logger_util import get_logger
-from modules.sam_inference import SamInference
+from modules.sam_inference import SamInference, DEFAULT_PROXY_MAX_SIZE
+from modules.segment_store import DEFAULT_SEGMENT_RAM_BUDGET_MB
+from modules.frame_encoder import DEFAULT_PRECOMPUTE_BUDGET_MB
 from modules.paths import OUTPUT_DIR, MODELS_DIR
+from modules.onnx_backend import AVAILABLE_BACKENDS, TORCH_BACKEND
+from modules.utils import get_config_manager
 from modules.ui.app_ui import AppUI
 
 logger = get_logger()
@@ -13,20 +18,34 @@ logger = get_logger()
 class App:
     """Main application class - simplified orchestrator."""
 
-    def __init__(self, args: argparse.Namespace):
+    def __init__(self, args: argparse.Namespace, explicit_args: Optional[Set[str]] = None):
         """
         Initialize the application.
 
         Args:
             args: Command line arguments
+            explicit_args: Names of the arguments that were given on the command line. The performance profile
+                doesn't override them
         """
         self.args = args
 
         # Initialize SAM inference engine
         self.sam_inf = SamInference(
             model_dir=self.args.model_dir,
-            output_dir=self.args.output_dir
+            output_dir=self.args.output_dir,
+            backend=self.args.backend,
+            onnx_num_threads=self.args.onnx_num_threads,
+            onnx_enable_cpu_mem_arena=self.args.onnx_mem_arena,
+            video_memory_budget_mb=self.args.video_memory_budget_mb,
+            proxy_max_size=self.args.proxy_max_size or None,
+            segment_ram_budget_mb=self.args.segment_ram_budget_mb or None,
+            keep_mask_logits=self.args.keep_mask_logits,
+            precompute_budget_mb=self.args.precompute_budget_mb,
+            keyframe_stride=self.args.keyframe_stride
         )
+        self.sam_inf.fixed_settings = set(explicit_args or [])
+        if self.args.profile is not None:
+            self.sam_inf.apply_profile(self.args.profile)
         logger.info(f'Device "{self.sam_inf.device}" detected')
 
         # Create UI
@@ -54,6 +73,33 @@ if __name__ == "__main__":
                         help='Model directory for segment-anything-2')
     parser.add_argument('--output_dir', type=str, default=OUTPUT_DIR,
                         help='Output directory for the results')
+    parser.add_argument('--backend', type=str, default=TORCH_BACKEND, choices=AVAILABLE_BACKENDS,
+                        help='Inference backend for image prediction. Video tracking always uses torch')
+    parser.add_argument('--onnx_num_threads', type=int, default=None,
+                        help='Intra-op thread count for ONNX Runtime sessions')
+    parser.add_argument('--onnx_mem_arena', type=bool, default=True, nargs='?', const=True,
+                        help='Whether to enable the CPU memory arena for ONNX Runtime sessions or not')
+    parser.add_argument('--video_memory_budget_mb', type=int, default=None,
+                        help='Memory budget in MB for the video inference state. Longer videos are tracked in '
+                             'overlapping windows to stay under it')
+    parser.add_argument('--proxy_max_size', type=int, default=DEFAULT_PROXY_MAX_SIZE,
+                        help='Longest side of the downscaled proxy frames that videos are tracked on. '
+                             'Set 0 to track on the full resolution frames')
+    parser.add_argument('--segment_ram_budget_mb', type=int, default=DEFAULT_SEGMENT_RAM_BUDGET_MB,
+                        help='RAM budget in MB for the tracked masks of a video. Masks over it are spilled to disk. '
+                             'Set 0 to keep all masks in RAM')
+    parser.add_argument('--keep_mask_logits', type=bool, default=False, nargs='?', const=True,
+                        help='Whether to keep the low resolution mask logits of tracked videos and upsample them at '
+                             'render time, so the mask threshold can be changed without re-tracking')
+    parser.add_argument('--precompute_budget_mb', type=int, default=DEFAULT_PRECOMPUTE_BUDGET_MB,
+                        help='Memory budget in MB for the video frame features that are computed in the background '
+                             'after a video is uploaded. Set 0 to disable')
+    parser.add_argument('--keyframe_stride', type=int, default=1,
+                        help='Track videos on every n-th frame and interpolate the masks between them with optical '
+                             'flow. Fast moving parts are still tracked on every frame. Set 1 to track every frame')
+    parser.add_argument('--profile', type=str, default=None, choices=list(get_config_manager().profiles),
+                        help='Performance profile from configs/default_hparams.yaml. Its settings override the '
+                             'defaults of the other arguments, and arguments that are given explicitly are kept')
     parser.add_argument('--inbrowser', type=bool, default=True, nargs='?', const=True,
                         help='Whether to automatically start Gradio app or not')
     parser.add_argument('--share', type=bool, default=True, nargs='?', const=True,
@@ -71,6 +117,7 @@ if __name__ == "__main__":
     parser.add_argument('--password', type=str, default=None,
                         help='Gradio authentication password')
     args = parser.parse_args()
+    explicit_args = {name for name, value in vars(args).items() if value != parser.get_default(name)}
 
-    demo = App(args=args)
+    demo = App(args=args, explicit_args=explicit_args)
     demo.launch()
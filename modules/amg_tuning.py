@@ -0,0 +1,357 @@
+"""Automatic points_per_batch sizing for automatic segmentation from the available memory."""
+
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from modules.paths import MODELS_DIR
+from modules.logger_util import get_logger
+
+logger = get_logger()
+
+AMG_TUNING_PATH = os.path.join(MODELS_DIR, "amg_tuning.json")
+# Crop sizes are rounded up to this step, so images of similar sizes share the calibration
+CROP_SIZE_STEP = 256
+MIN_POINTS_PER_BATCH = 16
+MAX_POINTS_PER_BATCH = 1024
+CALIBRATION_POINTS = 16
+# Fraction of the available memory used by a batch. The rest is left for the other tensors of the generator
+MEMORY_FRACTION = 0.6
+FALLBACK_POINTS_PER_BATCH = 64
+# Measured bytes per point are calibrated again after this age, e.g. for a new model or library version
+CALIBRATION_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+# Interval of the process memory samples while the calibration batch runs on the CPU
+RSS_SAMPLE_INTERVAL_SECONDS = 0.001
+
+_lock = threading.Lock()
+
+
+def get_host_key(device: str) -> str:
+    """
+    Get the key of this host, the device and its total memory, so the calibration isn't shared between machines and
+    is done again when the memory of the machine changes.
+    """
+    device_name = torch.cuda.get_device_name(0) if device == "cuda" else "cpu"
+    total_memory = get_total_memory(device)
+    total_gib = f"{total_memory / 1024 ** 3:.0f}GiB" if total_memory is not None else "unknown"
+    return f"{socket.gethostname()}|{device_name}|{total_gib}"
+
+
+def get_crop_size_key(crop_size: Sequence[int]) -> str:
+    """Get the key of the crop size in HxW format, rounded up to CROP_SIZE_STEP."""
+    height, width = (int(np.ceil(size / CROP_SIZE_STEP) * CROP_SIZE_STEP) for size in crop_size[:2])
+    return f"{height}x{width}"
+
+
+def load_tuning_cache(cache_path: str = AMG_TUNING_PATH) -> Dict[str, Any]:
+    """Load the calibrated batch sizes. Returns an empty cache if the file is missing or broken."""
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        logger.exception(f"Error while loading the points_per_batch calibration {cache_path}")
+        return {}
+
+
+def save_tuning_cache(cache: Dict[str, Any], cache_path: str = AMG_TUNING_PATH):
+    """Save the calibrated batch sizes."""
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temp_path = cache_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(temp_path, cache_path)
+
+
+def get_available_memory(device: str) -> Optional[int]:
+    """
+    Get the available memory of the device in bytes.
+
+    Args:
+        device: "cuda" or "cpu"
+
+    Returns:
+        Available bytes. None if it can't be read
+    """
+    if device == "cuda":
+        free, _ = torch.cuda.mem_get_info()
+        return int(free)
+
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_total_memory(device: str) -> Optional[int]:
+    """
+    Get the total memory of the device in bytes.
+
+    Args:
+        device: "cuda" or "cpu"
+
+    Returns:
+        Total bytes. None if it can't be read
+    """
+    if device == "cuda":
+        return int(torch.cuda.get_device_properties(0).total_memory)
+
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_process_memory() -> Optional[int]:
+    """Get the resident memory of this process in bytes. None if it can't be read."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def measure_peak_process_memory(fn: Callable[[], Any],
+                                interval: float = RSS_SAMPLE_INTERVAL_SECONDS) -> Tuple[Any, Optional[int]]:
+    """
+    Run the function while the resident memory of the process is sampled in a background thread.
+
+    Args:
+        fn: Function to run
+        interval: Seconds between the samples
+
+    Returns:
+        Result of the function, and its peak resident memory above the memory before the run. None if the memory
+        of the process can't be read
+    """
+    baseline = get_process_memory()
+    if baseline is None:
+        return fn(), None
+
+    peak = baseline
+    done = threading.Event()
+
+    def sample():
+        nonlocal peak
+        while not done.is_set():
+            peak = max(peak, get_process_memory() or 0)
+            done.wait(interval)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        result = fn()
+        peak = max(peak, get_process_memory() or 0)
+    finally:
+        done.set()
+        sampler.join()
+    return result, peak - baseline
+
+
+def measure_bytes_per_point(model: torch.nn.Module,
+                            crop_size: Sequence[int],
+                            device: str = "cuda",
+                            num_points: int = CALIBRATION_POINTS) -> int:
+    """
+    Measure the peak memory of predicting a batch of points on a crop, like one batch of automatic segmentation.
+    The peak is read from the CUDA allocator on CUDA, and sampled from the resident memory of the process on the
+    CPU. The CPU peak is at least the size of the predicted logits, since freed memory that the allocator reuses
+    doesn't show up in the resident memory.
+
+    Args:
+        model: SAM2 model on the device
+        crop_size: Crop size in HxW format
+        device: Device of the model
+        num_points: Number of points in the measured batch
+
+    Returns:
+        Peak bytes per point
+    """
+    # Imported here because the image predictor is only needed for the calibration run
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+    height, width = crop_size[:2]
+    predictor = SAM2ImagePredictor(model)
+    predictor.set_image(np.zeros((height, width, 3), dtype=np.uint8))
+    point_coords = np.random.rand(num_points, 1, 2) * [width, height]
+
+    def predict():
+        return predictor.predict(
+            point_coords=point_coords,
+            point_labels=np.ones((num_points, 1)),
+            multimask_output=True,
+            return_logits=True
+        )
+
+    if device == "cuda":
+        torch.cuda.synchronize()
+        baseline = torch.cuda.memory_allocated()
+        torch.cuda.reset_peak_memory_stats()
+        predict()
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - baseline
+    else:
+        outputs, peak = measure_peak_process_memory(predict)
+        peak = max(peak or 0, sum(output.nbytes for output in outputs))
+    predictor.reset_predictor()
+    # Thresholding and stability scores keep about as much again alive in the generator
+    return max(1, int(2 * peak / num_points))
+
+
+def calibrate_points_per_batch(bytes_per_point: int, available_memory: Optional[int]) -> int:
+    """
+    Get the largest safe points_per_batch from the memory of a point.
+
+    Args:
+        bytes_per_point: Peak bytes per point
+        available_memory: Available bytes of the device
+
+    Returns:
+        Batch size, a multiple of MIN_POINTS_PER_BATCH between MIN_POINTS_PER_BATCH and MAX_POINTS_PER_BATCH
+    """
+    if available_memory is None:
+        return FALLBACK_POINTS_PER_BATCH
+    points_per_batch = int(available_memory * MEMORY_FRACTION / max(1, bytes_per_point))
+    points_per_batch = points_per_batch // MIN_POINTS_PER_BATCH * MIN_POINTS_PER_BATCH
+    return int(np.clip(points_per_batch, MIN_POINTS_PER_BATCH, MAX_POINTS_PER_BATCH))
+
+
+def get_points_per_batch(model: torch.nn.Module,
+                         model_type: str,
+                         crop_size: Sequence[int],
+                         device: str,
+                         cache_path: str = AMG_TUNING_PATH) -> int:
+    """
+    Get the calibrated points_per_batch for the model type and the crop size on this host. The first run for a
+    model type and crop size measures the peak memory of a batch per point, and the measurement is cached per host
+    and total memory until it's older than CALIBRATION_MAX_AGE_SECONDS. The batch size is fitted to the memory that
+    is available on every call.
+
+    Args:
+        model: SAM2 model
+        model_type: Model type of the model
+        crop_size: Largest crop size in HxW format, which is the image size
+        device: Device of the model
+        cache_path: Path of the calibration cache
+
+    Returns:
+        points_per_batch
+    """
+    host_key = get_host_key(device)
+    entry_key = f"{model_type}|{get_crop_size_key(crop_size)}"
+    with _lock:
+        cache = load_tuning_cache(cache_path)
+        cached = cache.get(host_key, {}).get(entry_key)
+        if cached is not None and time.time() - cached.get("calibrated_at", 0) < CALIBRATION_MAX_AGE_SECONDS:
+            bytes_per_point = int(cached["bytes_per_point"])
+        else:
+            rounded_size = [int(size) for size in get_crop_size_key(crop_size).split("x")]
+            try:
+                bytes_per_point = measure_bytes_per_point(model, rounded_size, device=device)
+            except Exception:
+                logger.exception("Error while calibrating points_per_batch, using the fallback batch size")
+                return FALLBACK_POINTS_PER_BATCH
+            logger.info(f"Measured {bytes_per_point} bytes per point for {model_type} at {entry_key.split('|')[1]}")
+            cache.setdefault(host_key, {})[entry_key] = {
+                "bytes_per_point": bytes_per_point,
+                "calibrated_at": time.time()
+            }
+            save_tuning_cache(cache, cache_path)
+
+    return calibrate_points_per_batch(bytes_per_point, get_available_memory(device))
+
+
+def sweep_amg_params(generate: Callable[..., List[Dict[str, Any]]],
+                     image: np.ndarray,
+                     points_per_side_values: Sequence[int],
+                     points_per_batch_values: Sequence[int]) -> List[Dict[str, Any]]:
+    """
+    Time automatic segmentation over the grid of points_per_side and points_per_batch values.
+
+    Args:
+        generate: Generates masks for the image with points_per_side and points_per_batch keyword arguments
+        image: Input image
+        points_per_side_values: points_per_side values to sweep
+        points_per_batch_values: points_per_batch values to sweep
+
+    Returns:
+        Rows with "points_per_side", "points_per_batch", "seconds" and "num_masks", or "error" if the run failed
+    """
+    rows = []
+    for points_per_side in points_per_side_values:
+        for points_per_batch in points_per_batch_values:
+            row = {"points_per_side": points_per_side, "points_per_batch": points_per_batch}
+            start = time.perf_counter()
+            try:
+                masks = generate(image=image, points_per_side=points_per_side, points_per_batch=points_per_batch)
+                row.update(seconds=time.perf_counter() - start, num_masks=len(masks))
+            except Exception as e:
+                row.update(error=str(e))
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            rows.append(row)
+    return rows
+
+
+def format_sweep_report(rows: List[Dict[str, Any]]) -> str:
+    """Format the sweep rows as a markdown table."""
+    lines = ["| points_per_side | points_per_batch | seconds | masks |", "|---|---|---|---|"]
+    for row in rows:
+        if "error" in row:
+            result = f"error: {row['error']} | -"
+        else:
+            result = f"{row['seconds']:.2f} | {row['num_masks']}"
+        lines.append(f"| {row['points_per_side']} | {row['points_per_batch']} | {result} |")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    from PIL import Image
+    from modules.sam_inference import SamInference
+    from modules.model_downloader import DEFAULT_MODEL_TYPE
+
+    parser = argparse.ArgumentParser(description="Time automatic segmentation over points_per_side and "
+                                                 "points_per_batch values")
+    parser.add_argument('image', type=str, help='Image to segment')
+    parser.add_argument('--model_type', type=str, default=DEFAULT_MODEL_TYPE, help='Model type')
+    parser.add_argument('--points_per_side', type=int, nargs='+', default=[16, 32, 64],
+                        help='points_per_side values to sweep')
+    parser.add_argument('--points_per_batch', type=int, nargs='+', default=[32, 64, 128, 256],
+                        help='points_per_batch values to sweep')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Performance profile from configs/default_hparams.yaml')
+    args = parser.parse_args()
+
+    sam_inf = SamInference()
+    if args.profile is not None:
+        sam_inf.apply_profile(args.profile)
+    input_image = np.array(Image.open(args.image).convert("RGB"))
+    report_rows = sweep_amg_params(
+        generate=lambda **params: sam_inf.generate_mask(model_type=args.model_type, **params),
+        image=input_image,
+        points_per_side_values=args.points_per_side,
+        points_per_batch_values=args.points_per_batch
+    )
+    print(format_sweep_report(report_rows))
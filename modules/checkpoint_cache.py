@@ -0,0 +1,159 @@
+"""One-time conversion of SAM2 checkpoints to a memory-mappable format for fast model loading."""
+
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+import torch
+
+from modules.paths import MODELS_DIR
+from modules.exceptions import ModelLoadError
+from modules.logger_util import get_logger
+
+logger = get_logger()
+
+CHECKPOINT_INDEX_NAME = "checkpoint_index.json"
+SAFETENSORS_FORMAT = "safetensors"
+TORCH_MMAP_FORMAT = "torch"
+MMAP_CHECKPOINT_EXTS = {
+    SAFETENSORS_FORMAT: ".safetensors",
+    TORCH_MMAP_FORMAT: ".mmap.pt",
+}
+
+_lock = threading.Lock()
+
+
+def is_safetensors_available() -> bool:
+    """Whether the optional safetensors package is installed."""
+    try:
+        import safetensors  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_mmap_format() -> str:
+    """Get the memory-mappable format. safetensors is used if it's installed, otherwise the torch zip format."""
+    return SAFETENSORS_FORMAT if is_safetensors_available() else TORCH_MMAP_FORMAT
+
+
+def get_mmap_checkpoint_path(model_path: str, mmap_format: Optional[str] = None) -> str:
+    """Get the path of the converted checkpoint next to the downloaded checkpoint."""
+    name, _ = os.path.splitext(model_path)
+    return name + MMAP_CHECKPOINT_EXTS[mmap_format or get_mmap_format()]
+
+
+def load_checkpoint_index(model_dir: str = MODELS_DIR) -> Dict[str, Dict]:
+    """Load the index of the converted checkpoints. Returns an empty index if the file is missing or broken."""
+    index_path = os.path.join(model_dir, CHECKPOINT_INDEX_NAME)
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        logger.exception(f"Error while loading the checkpoint index {index_path}")
+        return {}
+
+
+def save_checkpoint_index(index: Dict[str, Dict], model_dir: str = MODELS_DIR):
+    """Save the index of the converted checkpoints."""
+    index_path = os.path.join(model_dir, CHECKPOINT_INDEX_NAME)
+    temp_path = index_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.replace(temp_path, index_path)
+
+
+def get_source_signature(model_path: str) -> Dict[str, int]:
+    """Get the size and the modification time of the downloaded checkpoint, to detect a re-download."""
+    stat = os.stat(model_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def convert_checkpoint(model_path: str, output_path: str, mmap_format: str):
+    """
+    Convert the downloaded .pt checkpoint to the memory-mappable format.
+
+    Args:
+        model_path: Path of the downloaded checkpoint
+        output_path: Path of the converted checkpoint
+        mmap_format: "safetensors" or "torch"
+    """
+    state_dict = torch.load(model_path, map_location="cpu", weights_only=True)["model"]
+    # Shared or strided tensors can't be mapped one by one
+    state_dict = {key: value.contiguous().clone() for key, value in state_dict.items()}
+
+    temp_path = output_path + ".tmp"
+    if mmap_format == SAFETENSORS_FORMAT:
+        from safetensors.torch import save_file
+        save_file(state_dict, temp_path)
+    else:
+        torch.save(state_dict, temp_path)
+    os.replace(temp_path, output_path)
+
+
+def load_mmap_state_dict(model_path: str, model_dir: str = MODELS_DIR) -> Dict[str, torch.Tensor]:
+    """
+    Load the state dict of the checkpoint with the weights memory-mapped from disk. The checkpoint is converted on
+    the first load, and the index in the model directory maps it to the converted file, so later loads don't read
+    the pickle at all. A safetensors checkpoint is converted again to the torch format if safetensors isn't
+    installed anymore.
+
+    Args:
+        model_path: Path of the downloaded .pt checkpoint
+        model_dir: Directory of the checkpoint index
+
+    Returns:
+        State dict of CPU tensors backed by the converted file
+    """
+    model_name = os.path.basename(model_path)
+    with _lock:
+        index = load_checkpoint_index(model_dir)
+        entry = index.get(model_name)
+        signature = get_source_signature(model_path)
+        if entry is not None and entry.get("format") == SAFETENSORS_FORMAT and not is_safetensors_available():
+            logger.warning(f"safetensors is not installed, converting {model_name} to the torch format again. "
+                           f"Install it with: pip install safetensors")
+            entry = None
+        if (entry is None or entry.get("source") != signature or
+                not os.path.exists(os.path.join(model_dir, entry["path"]))):
+            mmap_format = get_mmap_format()
+            output_path = get_mmap_checkpoint_path(model_path, mmap_format)
+            logger.info(f"Converting {model_name} to a memory-mappable {mmap_format} checkpoint..")
+            convert_checkpoint(model_path, output_path, mmap_format)
+            entry = {
+                "path": os.path.relpath(output_path, model_dir),
+                "format": mmap_format,
+                "source": signature,
+            }
+            index[model_name] = entry
+            save_checkpoint_index(index, model_dir)
+
+    mmap_path = os.path.join(model_dir, entry["path"])
+    if entry["format"] == SAFETENSORS_FORMAT:
+        from safetensors.torch import load_file
+        return load_file(mmap_path, device="cpu")
+    return torch.load(mmap_path, map_location="cpu", weights_only=True, mmap=True)
+
+
+def load_mmap_weights(model: torch.nn.Module, model_path: str, model_dir: str = MODELS_DIR) -> torch.nn.Module:
+    """
+    Load the checkpoint weights into the model built without a checkpoint. The parameters are replaced by the
+    memory-mapped tensors instead of being copied into the initialized ones.
+
+    Args:
+        model: SAM2 model on CPU, built with ckpt_path=None
+        model_path: Path of the downloaded .pt checkpoint
+        model_dir: Directory of the checkpoint index
+
+    Returns:
+        The model with the checkpoint weights
+    """
+    state_dict = load_mmap_state_dict(model_path, model_dir)
+    missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False, assign=True)
+    if missing_keys or unexpected_keys:
+        raise ModelLoadError(f"Checkpoint {model_path} doesn't match the model. Missing keys: {missing_keys}, "
+                             f"unexpected keys: {unexpected_keys}")
+    return model
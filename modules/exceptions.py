@@ -54,3 +54,8 @@ class FileOperationError(ImagepulateError):
 class ConfigurationError(ImagepulateError):
     """Raised when configuration loading or parsing fails."""
     pass
+
+
+class JobCancelledError(ImagepulateError):
+    """Raised when a background job is cancelled."""
+    pass
@@ -0,0 +1,142 @@
+"""Frame index and downscaled preview cache for scrubbing extracted video frames."""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+from PIL import Image
+
+from modules.video_utils import get_frames_from_dir
+from modules.logger_util import get_logger
+
+logger = get_logger()
+
+# Longest side of the preview images shown in the frame prompter
+DEFAULT_PREVIEW_MAX_SIZE = 1024
+DEFAULT_CACHE_SIZE = 32
+DEFAULT_PREFETCH_FRAMES = 2
+
+
+class FrameCache:
+    """
+    Index of the extracted frames, built once at ingest, with an LRU cache of downscaled preview images.
+    Getting a preview prefetches the neighbouring frames in a background thread, so scrubbing the frame slider
+    doesn't list the frames directory or decode full resolution frames on every move.
+    """
+
+    def __init__(self,
+                 preview_max_size: int = DEFAULT_PREVIEW_MAX_SIZE,
+                 cache_size: int = DEFAULT_CACHE_SIZE,
+                 prefetch_frames: int = DEFAULT_PREFETCH_FRAMES):
+        self.preview_max_size = preview_max_size
+        self.cache_size = cache_size
+        self.prefetch_frames = prefetch_frames
+        self.frame_paths: List[str] = []
+        self.frame_size: Optional[tuple] = None
+        self.preview_size: Optional[tuple] = None
+        self._cache: OrderedDict = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="frame_prefetch")
+
+    def __len__(self) -> int:
+        return len(self.frame_paths)
+
+    @property
+    def scale(self) -> float:
+        """Scale from the full resolution frames to the preview images."""
+        if self.frame_size is None or self.preview_size is None:
+            return 1.0
+        return self.preview_size[0] / self.frame_size[0]
+
+    def build_index(self, frames_dir: str):
+        """
+        Index the frames in the directory and clear the cached previews.
+
+        Args:
+            frames_dir: Directory of the extracted frames
+        """
+        with self._lock:
+            self._cache.clear()
+            self.frame_paths = get_frames_from_dir(vid_dir=frames_dir)
+            self.frame_size = self.preview_size = None
+            if self.frame_paths:
+                with Image.open(self.frame_paths[0]) as image:
+                    self.frame_size = image.size
+                width, height = self.frame_size
+                ratio = min(1.0, self.preview_max_size / max(width, height))
+                self.preview_size = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+
+    def get_frame_path(self, frame_idx: int) -> str:
+        """Get the full resolution frame path."""
+        return self.frame_paths[frame_idx]
+
+    def get_preview(self, frame_idx: int) -> Image.Image:
+        """
+        Get the downscaled preview image of the frame, and prefetch the neighbouring frames.
+
+        Args:
+            frame_idx: Frame index
+
+        Returns:
+            Preview image in RGB
+        """
+        frame_idx = int(frame_idx)
+        with self._lock:
+            image = self._cache.get(frame_idx)
+            if image is not None:
+                self._cache.move_to_end(frame_idx)
+
+        if image is None:
+            image = self._load_preview(self.frame_paths[frame_idx])
+            self._put(frame_idx, image, self.frame_paths)
+
+        self._prefetch(frame_idx)
+        return image
+
+    def to_full_resolution(self, coords: Optional[np.ndarray]) -> Optional[np.ndarray]:
+        """Map point or box coordinates from the preview image back to the full resolution frame."""
+        if coords is None:
+            return None
+        return np.asarray(coords, dtype=np.float64) / self.scale
+
+    def _load_preview(self, frame_path: str) -> Image.Image:
+        image = Image.open(frame_path)
+        if self.preview_size is not None and self.preview_size != image.size:
+            # Let the JPEG decoder downscale while decoding
+            image.draft("RGB", self.preview_size)
+            image = image.convert("RGB").resize(self.preview_size, Image.BILINEAR)
+        return image.convert("RGB")
+
+    def _put(self, frame_idx: int, image: Image.Image, frame_paths: List[str]):
+        with self._lock:
+            # Skip frames of a previous video
+            if frame_paths is not self.frame_paths:
+                return
+            self._cache[frame_idx] = image
+            self._cache.move_to_end(frame_idx)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _prefetch(self, frame_idx: int):
+        for offset in range(1, self.prefetch_frames + 1):
+            for neighbour_idx in [frame_idx + offset, frame_idx - offset]:
+                if not 0 <= neighbour_idx < len(self.frame_paths):
+                    continue
+                with self._lock:
+                    if neighbour_idx in self._cache or neighbour_idx in self._pending:
+                        continue
+                    self._pending.add(neighbour_idx)
+                self._executor.submit(self._prefetch_frame, neighbour_idx, self.frame_paths)
+
+    def _prefetch_frame(self, frame_idx: int, frame_paths: List[str]):
+        try:
+            if frame_paths is self.frame_paths:
+                self._put(frame_idx, self._load_preview(frame_paths[frame_idx]), frame_paths)
+        except Exception:
+            logger.exception(f"Error while prefetching frame {frame_idx}")
+        finally:
+            with self._lock:
+                self._pending.discard(frame_idx)
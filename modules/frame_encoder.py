@@ -0,0 +1,138 @@
+"""Speculative image encoding of video frames in the background while the video is being prompted."""
+
+import os
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional
+
+import torch
+
+from modules.logger_util import get_logger
+
+logger = get_logger()
+
+DEFAULT_PRECOMPUTE_BUDGET_MB = 2048
+# Nice value of the encoding thread on Linux, so the foreground work gets the CPU first
+BACKGROUND_NICE = 10
+
+# Backbone output with "backbone_fpn" and "vision_pos_enc" lists, same as SAM2Base.forward_image()
+BackboneOutput = Dict[str, List[torch.Tensor]]
+
+
+class BackgroundFrameEncoder:
+    """
+    Compute the image encoder features of the video frames one frame at a time in a background thread, and keep
+    them on the storage device up to the memory budget. The features are looked up by the video inference state
+    before SAM2 runs the encoder, so tracking a video after prompting it mostly skips the encoder.
+    The thread waits while the foreground work holds paused(), and stop() abandons the remaining frames, e.g. when
+    another video is loaded.
+    """
+
+    def __init__(self,
+                 encode_frame: Callable[[int], BackboneOutput],
+                 budget_mb: float = DEFAULT_PRECOMPUTE_BUDGET_MB,
+                 storage_device: str = "cpu"):
+        """
+        Args:
+            encode_frame: Runs the image encoder on the frame index and returns the backbone output
+            budget_mb: Memory budget for the stored features in MB. Encoding stops when it's reached
+            storage_device: Device that the features are stored on
+        """
+        self.encode_frame = encode_frame
+        self.budget_bytes = budget_mb * 1024 ** 2
+        self.storage_device = storage_device
+        self._features: Dict[int, List[torch.Tensor]] = {}
+        # Positional encodings only depend on the feature sizes, so a single copy is shared by all frames
+        self._pos_enc: Optional[List[torch.Tensor]] = None
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._resume = threading.Event()
+        self._resume.set()
+        self._num_paused = 0
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, frame_indices: Iterable[int]):
+        """Start encoding the frames in the given order."""
+        self._thread = threading.Thread(target=self._run, args=(list(frame_indices),), daemon=True,
+                                        name="frame_encoder")
+        self._thread.start()
+
+    def stop(self, wait: bool = True):
+        """Abandon the remaining frames. The frame being encoded is finished first if wait is set."""
+        self._stop.set()
+        self._resume.set()
+        if wait and self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    @contextmanager
+    def paused(self):
+        """Pause encoding after the current frame while the foreground work runs."""
+        with self._lock:
+            self._num_paused += 1
+            self._resume.clear()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._num_paused -= 1
+                if self._num_paused == 0:
+                    self._resume.set()
+
+    def get(self, frame_idx: int, device: str) -> Optional[BackboneOutput]:
+        """
+        Get the features of the frame on the device. They are returned in float32 like the features SAM2 computes
+        without autocast, and autocast casts them down again where it's enabled.
+
+        Args:
+            frame_idx: Frame index
+            device: Device of the model
+
+        Returns:
+            Backbone output of the frame. None if the frame isn't encoded yet
+        """
+        with self._lock:
+            backbone_fpn = self._features.get(frame_idx)
+            pos_enc = self._pos_enc
+        if backbone_fpn is None:
+            return None
+        return {
+            "backbone_fpn": [feat.to(device=device, dtype=torch.float32) for feat in backbone_fpn],
+            "vision_pos_enc": [pos.to(device=device, dtype=torch.float32) for pos in pos_enc],
+        }
+
+    @property
+    def num_encoded(self) -> int:
+        """Number of frames whose features are stored."""
+        with self._lock:
+            return len(self._features)
+
+    def _run(self, frame_indices: List[int]):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), BACKGROUND_NICE)
+        except (AttributeError, OSError):
+            pass
+
+        for frame_idx in frame_indices:
+            self._resume.wait()
+            if self._stop.is_set():
+                return
+            if frame_idx in self._features:
+                continue
+            try:
+                backbone_out = self.encode_frame(frame_idx)
+            except Exception:
+                logger.exception(f"Error while encoding frame {frame_idx} in the background, stopping")
+                return
+
+            backbone_fpn = [feat.to(self.storage_device) for feat in backbone_out["backbone_fpn"]]
+            num_bytes = sum(feat.nbytes for feat in backbone_fpn)
+            with self._lock:
+                if self._pos_enc is None:
+                    self._pos_enc = [pos.to(self.storage_device) for pos in backbone_out["vision_pos_enc"]]
+                if self._num_bytes + num_bytes > self.budget_bytes:
+                    logger.info(f"Stopped encoding frames in the background at the {self.budget_bytes / 1024 ** 2:.0f}"
+                                f" MB budget, after {len(self._features)} frames")
+                    return
+                self._features[frame_idx] = backbone_fpn
+                self._num_bytes += num_bytes
@@ -0,0 +1,358 @@
+"""Background video render jobs with persistent job records, progress, cancellation and resume."""
+
+import copy
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import numpy as np
+
+from modules.paths import TEMP_JOBS_DIR
+from modules.constants import IMAGE_FILE_EXT
+from modules.exceptions import JobCancelledError
+from modules.logger_util import get_logger
+
+logger = get_logger()
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+# Queued or running when the app stopped
+JOB_INTERRUPTED = "interrupted"
+ACTIVE_JOB_STATUSES = [JOB_QUEUED, JOB_RUNNING]
+RESUMABLE_JOB_STATUSES = [JOB_FAILED, JOB_CANCELLED, JOB_INTERRUPTED]
+# The job record is saved at most this often while frames are rendered
+CHECKPOINT_INTERVAL_SECONDS = 2.0
+# Subdirectory of the job frames directory with the tracked masks of the job
+MASK_CHECKPOINT_DIRNAME = "masks"
+
+
+def to_frame_ranges(frames: Iterable[int]) -> List[List[int]]:
+    """Compress the frame indexes to sorted [first, last] ranges (inclusive)."""
+    ranges = []
+    for frame_idx in sorted(set(frames)):
+        if ranges and frame_idx == ranges[-1][1] + 1:
+            ranges[-1][1] = frame_idx
+        else:
+            ranges.append([frame_idx, frame_idx])
+    return ranges
+
+
+def from_frame_ranges(ranges: Iterable[Iterable[int]]) -> Set[int]:
+    """Expand the [first, last] ranges (inclusive) to the frame indexes."""
+    return {frame_idx for first, last in ranges for frame_idx in range(int(first), int(last) + 1)}
+
+
+def serialize_prompts(prompts: Dict[int, Dict[int, Dict[str, Optional[np.ndarray]]]]) -> Dict[str, Dict]:
+    """Convert the registered video prompts, object id -> frame index -> prompt data, to JSON data."""
+    return {
+        str(obj_id): {
+            str(frame_idx): {key: np.asarray(value).tolist() if value is not None else None
+                             for key, value in prompt.items()}
+            for frame_idx, prompt in frame_prompts.items()
+        }
+        for obj_id, frame_prompts in prompts.items()
+    }
+
+
+def deserialize_prompts(data: Dict[str, Dict]) -> Dict[int, Dict[int, Dict[str, Optional[np.ndarray]]]]:
+    """Convert the JSON data from serialize_prompts() back to the registered video prompts."""
+    return {
+        int(obj_id): {
+            int(frame_idx): {key: np.asarray(value) if value is not None else None for key, value in prompt.items()}
+            for frame_idx, prompt in frame_prompts.items()
+        }
+        for obj_id, frame_prompts in data.items()
+    }
+
+
+def get_rendered_frames(frames_dir: str) -> Set[int]:
+    """Get the indexes of the frame files in the directory. Frame files are only renamed into place when complete."""
+    if not os.path.exists(frames_dir):
+        return set()
+    return {int(filename.split(".")[0]) for filename in os.listdir(frames_dir)
+            if filename.lower().endswith(tuple(IMAGE_FILE_EXT)) and filename.split(".")[0].isdigit()}
+
+
+class VideoJobManager:
+    """
+    Run video renders of SamInference.create_filtered_video() as background jobs, one at a time. Each job has a
+    JSON record in the job directory with its status, progress, parameters and the prompts it tracks, so the jobs
+    survive a browser disconnect or an app restart.
+    Jobs render into their own frames directory, and the completed frames are checkpointed in the record as frame
+    ranges. A cancelled, failed or interrupted job resumes by loading the video again if needed and rendering only
+    the frames that aren't on disk yet. Tracking is skipped as well if the mask track of the job was completed, and
+    otherwise resumes from the tracked masks in the mask checkpoint of the job.
+    A job holds the video lock of SamInference while it runs, and loads the video and the prompts of the UI session
+    back when it's done.
+    """
+
+    def __init__(self, sam_inference, job_dir: str = TEMP_JOBS_DIR):
+        """
+        Args:
+            sam_inference: SamInference instance that renders the jobs
+            job_dir: Directory of the job records and the frames of the jobs
+        """
+        self.sam_inf = sam_inference
+        self.job_dir = job_dir
+        self._lock = threading.Lock()
+        self._cancel_events: Dict[str, threading.Event] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="video_job")
+        os.makedirs(job_dir, exist_ok=True)
+
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        for filename in sorted(os.listdir(job_dir)):
+            if not filename.endswith(".json"):
+                continue
+            record = self._load_record(os.path.join(job_dir, filename))
+            if record is None:
+                continue
+            if record["status"] in ACTIVE_JOB_STATUSES:
+                record["status"] = JOB_INTERRUPTED
+                self._save_record(record)
+            self._jobs[record["id"]] = record
+
+    def submit(self,
+               image_prompt_input_data: Dict,
+               filter_mode: str,
+               frame_idx: int,
+               pixel_size: Optional[int] = None,
+               color_hex: Optional[str] = None,
+               output_mime_type: Optional[str] = None,
+               invert_mask: bool = False,
+               obj_id: int = 0,
+               mask_threshold: float = 0.0,
+               frame_range: Optional[List[int]] = None,
+               max_frames: Optional[int] = None) -> str:
+        """
+        Register the prompt like create_filtered_video(), and submit the render of the loaded video with the
+        registered prompts as a background job.
+
+        Args:
+            Same as SamInference.create_filtered_video()
+
+        Returns:
+            Job id
+        """
+        with self.sam_inf.video_lock:
+            if self.sam_inf.video_path is None:
+                raise RuntimeError("Load a video before submitting a job")
+            self.sam_inf.register_prompt_data(image_prompt_input_data, frame_idx=frame_idx, obj_id=obj_id)
+            if not self.sam_inf.video_prompts:
+                raise RuntimeError("No prompt data provided")
+            video_path, video_id = self.sam_inf.video_path, self.sam_inf.video_id
+            model_type = self.sam_inf.current_model_type
+            prompts = serialize_prompts(self.sam_inf.video_prompts)
+
+        job_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        record = {
+            "id": job_id,
+            "status": JOB_QUEUED,
+            "video_path": video_path,
+            "video_id": video_id,
+            "model_type": model_type,
+            "prompts": prompts,
+            "params": {
+                "filter_mode": filter_mode,
+                "frame_idx": int(frame_idx),
+                "pixel_size": pixel_size,
+                "color_hex": color_hex,
+                "output_mime_type": output_mime_type,
+                "invert_mask": bool(invert_mask),
+                "obj_id": int(obj_id),
+                "mask_threshold": float(mask_threshold) if mask_threshold is not None else 0.0,
+                "frame_range": list(frame_range) if frame_range is not None else None,
+                "max_frames": max_frames,
+            },
+            "completed_frames": [],
+            "num_rendered": 0,
+            "num_frames": None,
+            "output": None,
+            "error": None,
+            "created_at": time.time(),
+            "updated_at": time.time(),
+        }
+        with self._lock:
+            self._jobs[job_id] = record
+            self._save_record(record)
+        self._start(job_id)
+        return job_id
+
+    def resume(self, job_id: str):
+        """Resume a cancelled, failed or interrupted job from its completed frames."""
+        with self._lock:
+            record = self._jobs[job_id]
+            if record["status"] not in RESUMABLE_JOB_STATUSES:
+                raise RuntimeError(f"Job {job_id} is {record['status']} and can't be resumed")
+            record.update(status=JOB_QUEUED, error=None, updated_at=time.time())
+            self._save_record(record)
+        self._start(job_id)
+
+    def cancel(self, job_id: str):
+        """Ask the job to stop. A running job stops after the frame it's rendering, and keeps its completed frames."""
+        with self._lock:
+            event = self._cancel_events.get(job_id)
+        if event is not None:
+            event.set()
+
+    def get_job(self, job_id: str) -> Dict[str, Any]:
+        """Get a copy of the job record."""
+        with self._lock:
+            return json.loads(json.dumps(self._jobs[job_id]))
+
+    def list_jobs(self) -> List[Dict[str, Any]]:
+        """Get copies of all job records, the latest first."""
+        with self._lock:
+            records = json.loads(json.dumps(list(self._jobs.values())))
+        return sorted(records, key=lambda record: record["created_at"], reverse=True)
+
+    def get_frames_dir(self, job_id: str) -> str:
+        """Get the frames directory of the job."""
+        return os.path.join(self.job_dir, job_id)
+
+    def get_mask_checkpoint_dir(self, job_id: str) -> str:
+        """Get the directory of the tracked masks of the job, inside its frames directory."""
+        return os.path.join(self.get_frames_dir(job_id), MASK_CHECKPOINT_DIRNAME)
+
+    def shutdown(self, wait: bool = True):
+        """Cancel the running jobs and stop the worker."""
+        with self._lock:
+            events = list(self._cancel_events.values())
+        for event in events:
+            event.set()
+        self._executor.shutdown(wait=wait)
+
+    def _start(self, job_id: str):
+        with self._lock:
+            self._cancel_events[job_id] = threading.Event()
+        self._executor.submit(self._run, job_id)
+
+    def _run(self, job_id: str):
+        with self._lock:
+            record = self._jobs[job_id]
+            cancel_event = self._cancel_events[job_id]
+            if cancel_event.is_set():
+                record.update(status=JOB_CANCELLED, updated_at=time.time())
+                self._save_record(record)
+                self._cancel_events.pop(job_id, None)
+                return
+            record.update(status=JOB_RUNNING, updated_at=time.time())
+            self._save_record(record)
+
+        frames_dir = self.get_frames_dir(job_id)
+        # Frames checkpointed in the record that were never written are rendered again
+        completed_frames = from_frame_ranges(record["completed_frames"]) & get_rendered_frames(frames_dir)
+        last_checkpoint = time.monotonic()
+
+        def on_progress(frame_idx: int, num_rendered: int, num_frames: int):
+            nonlocal last_checkpoint
+            with self._lock:
+                completed_frames.add(frame_idx)
+                record.update(num_rendered=num_rendered, num_frames=num_frames)
+                if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL_SECONDS:
+                    record.update(completed_frames=to_frame_ranges(completed_frames), updated_at=time.time())
+                    self._save_record(record)
+                    last_checkpoint = time.monotonic()
+
+        # The job runs on the video and the prompts of the UI session, so it holds the video lock until the video
+        # and the prompts of the session are restored
+        self.sam_inf.video_lock.acquire()
+        session = self._save_video_session()
+        try:
+            self._load_job_video(record)
+            params = record["params"]
+            frame_range = params["frame_range"]
+            _, output = self.sam_inf.create_filtered_video(
+                image_prompt_input_data={"points": []},
+                filter_mode=params["filter_mode"],
+                frame_idx=params["frame_idx"],
+                pixel_size=params["pixel_size"],
+                color_hex=params["color_hex"],
+                output_mime_type=params["output_mime_type"],
+                invert_mask=params["invert_mask"],
+                obj_id=params["obj_id"],
+                mask_threshold=params["mask_threshold"],
+                frame_range=tuple(frame_range) if frame_range is not None else None,
+                max_frames=params["max_frames"],
+                frames_dir=frames_dir,
+                completed_frames=set(completed_frames),
+                progress_callback=on_progress,
+                cancel_event=cancel_event,
+                mask_checkpoint_dir=self.get_mask_checkpoint_dir(job_id)
+            )
+            status, error = JOB_COMPLETED, None
+        except JobCancelledError:
+            logger.info(f"Video job {job_id} was cancelled")
+            status, error, output = JOB_CANCELLED, None, None
+        except Exception as e:
+            logger.exception(f"Error while running video job {job_id}")
+            status, error, output = JOB_FAILED, str(e), None
+        finally:
+            try:
+                self._restore_video_session(session)
+            finally:
+                self.sam_inf.video_lock.release()
+
+        with self._lock:
+            record.update(status=status, error=error, output=output,
+                          completed_frames=to_frame_ranges(completed_frames), updated_at=time.time())
+            self._save_record(record)
+            self._cancel_events.pop(job_id, None)
+        if status == JOB_COMPLETED:
+            shutil.rmtree(frames_dir, ignore_errors=True)
+
+    def _load_job_video(self, record: Dict[str, Any]):
+        """Load the video of the job if another video or model is loaded, and register the prompts of the job."""
+        if (self.sam_inf.video_id != record["video_id"] or
+                self.sam_inf.current_model_type != record["model_type"]):
+            if not os.path.exists(record["video_path"]):
+                raise RuntimeError(f"Video of the job is not available anymore: {record['video_path']}")
+            self.sam_inf.init_video_inference_state(vid_input=record["video_path"],
+                                                    model_type=record["model_type"])
+        self.sam_inf.video_prompts = deserialize_prompts(record["prompts"])
+
+    def _save_video_session(self) -> Dict[str, Any]:
+        """Save the loaded video, model and prompts of the UI session before a job replaces them."""
+        return {
+            "video_path": self.sam_inf.video_path,
+            "video_id": self.sam_inf.video_id,
+            "model_type": self.sam_inf.current_model_type,
+            "prompts": copy.deepcopy(self.sam_inf.video_prompts),
+        }
+
+    def _restore_video_session(self, session: Dict[str, Any]):
+        """Load the video of the UI session again if the job loaded another one, and restore its prompts."""
+        if session["video_path"] is None:
+            return
+        try:
+            if (self.sam_inf.video_id != session["video_id"] or
+                    self.sam_inf.current_model_type != session["model_type"]):
+                self.sam_inf.init_video_inference_state(vid_input=session["video_path"],
+                                                        model_type=session["model_type"])
+            self.sam_inf.video_prompts = session["prompts"]
+        except Exception:
+            logger.exception(f"Error while restoring the video {session['video_path']} after a job")
+
+    def _save_record(self, record: Dict[str, Any]):
+        record_path = os.path.join(self.job_dir, f"{record['id']}.json")
+        temp_path = record_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(record, f, indent=2)
+        os.replace(temp_path, record_path)
+
+    @staticmethod
+    def _load_record(record_path: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(record_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.exception(f"Error while loading the job record {record_path}")
+            return None
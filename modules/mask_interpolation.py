@@ -0,0 +1,150 @@
+"""Motion compensated interpolation of tracked masks between keyframes with dense optical flow."""
+
+from typing import List, Sequence
+
+import cv2
+import numpy as np
+
+# Longest side of the grayscale frames that the optical flow is computed on
+FLOW_MAX_SIZE = 320
+# Keyframe gaps whose mean motion in the masks exceeds this fraction of the frame's longest side are fully tracked
+DEFAULT_MAX_KEYFRAME_MOTION = 0.05
+# Keyframe gaps where the mask warped from one keyframe to the other has a lower IoU are fully tracked
+DEFAULT_MIN_KEYFRAME_IOU = 0.8
+
+
+def get_keyframes(first_frame_idx: int,
+                  last_frame_idx: int,
+                  start_frame_idx: int,
+                  stride: int,
+                  required_frames: Sequence[int] = ()) -> List[int]:
+    """
+    Get the keyframes of the frame span, every stride-th frame counted from the start frame in both directions.
+
+    Args:
+        first_frame_idx: The first frame index of the span
+        last_frame_idx: The last frame index (inclusive) of the span
+        start_frame_idx: The frame index that tracking starts from
+        stride: The number of frames between keyframes
+        required_frames: Frames that are always keyframes, e.g. the prompted frames
+
+    Returns:
+        Sorted keyframe indexes, including the first, the last and the start frame
+    """
+    stride = max(int(stride), 1)
+    keyframes = set(range(start_frame_idx, last_frame_idx + 1, stride))
+    keyframes.update(range(start_frame_idx, first_frame_idx - 1, -stride))
+    keyframes.update([first_frame_idx, last_frame_idx])
+    keyframes.update(idx for idx in required_frames if first_frame_idx <= idx <= last_frame_idx)
+    return sorted(keyframes)
+
+
+def load_flow_frame(frame_path: str, max_size: int = FLOW_MAX_SIZE) -> np.ndarray:
+    """Load the frame as a grayscale image downscaled for the optical flow."""
+    gray = cv2.imread(frame_path, cv2.IMREAD_GRAYSCALE)
+    scale = max_size / max(gray.shape)
+    if scale < 1.0:
+        gray = cv2.resize(gray, (round(gray.shape[1] * scale), round(gray.shape[0] * scale)),
+                          interpolation=cv2.INTER_AREA)
+    return gray
+
+
+def compute_flow(frame: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    """
+    Compute the dense Farneback optical flow from the frame to the reference frame.
+
+    Args:
+        frame: Grayscale frame
+        reference: Grayscale reference frame of the same size
+
+    Returns:
+        HxWx2 flow in pixels, so that frame[y, x] corresponds to reference[y + flow[y, x, 1], x + flow[y, x, 0]]
+    """
+    return cv2.calcOpticalFlowFarneback(frame, reference, None, pyr_scale=0.5, levels=3, winsize=15,
+                                        iterations=3, poly_n=5, poly_sigma=1.2, flags=0)
+
+
+def warp_to_frame(maps: np.ndarray, flow: np.ndarray) -> np.ndarray:
+    """
+    Warp the per-object maps of the reference frame, such as mask logits, to the frame with the flow from
+    compute_flow(frame, reference). The flow is resized to the map resolution, so maps of any resolution that cover
+    the whole frame can be warped.
+
+    Args:
+        maps: Nx1xHxW maps of the reference frame
+        flow: hxwx2 flow from the frame to the reference frame
+
+    Returns:
+        Nx1xHxW float32 maps warped to the frame
+    """
+    height, width = maps.shape[-2:]
+    flow_h, flow_w = flow.shape[:2]
+    flow = cv2.resize(flow, (width, height), interpolation=cv2.INTER_LINEAR)
+    grid_x, grid_y = np.meshgrid(np.arange(width, dtype=np.float32), np.arange(height, dtype=np.float32))
+    map_x = grid_x + flow[..., 0] * (width / flow_w)
+    map_y = grid_y + flow[..., 1] * (height / flow_h)
+    warped = [cv2.remap(np.asarray(obj_map[0], dtype=np.float32), map_x, map_y, interpolation=cv2.INTER_LINEAR,
+                        borderMode=cv2.BORDER_REPLICATE)
+              for obj_map in maps]
+    return np.array(warped, dtype=np.float32).reshape(-1, 1, height, width)
+
+
+def interpolate_logits(logits_a: np.ndarray,
+                       logits_b: np.ndarray,
+                       flow_to_a: np.ndarray,
+                       flow_to_b: np.ndarray,
+                       weight: float) -> np.ndarray:
+    """
+    Interpolate the mask logits of a frame between two keyframes, by warping the logits of both keyframes to the
+    frame and blending them by the distance to each keyframe.
+
+    Args:
+        logits_a: Nx1xHxW mask logits of the keyframe before the frame
+        logits_b: Nx1xHxW mask logits of the keyframe after the frame
+        flow_to_a: Flow from the frame to keyframe a
+        flow_to_b: Flow from the frame to keyframe b
+        weight: Position of the frame between the keyframes, 0 at keyframe a and 1 at keyframe b
+
+    Returns:
+        Nx1xHxW float32 mask logits of the frame
+    """
+    return (1 - weight) * warp_to_frame(logits_a, flow_to_a) + weight * warp_to_frame(logits_b, flow_to_b)
+
+
+def needs_full_tracking(masks_a: np.ndarray,
+                        masks_b: np.ndarray,
+                        flow_b_to_a: np.ndarray,
+                        max_motion: float = DEFAULT_MAX_KEYFRAME_MOTION,
+                        min_iou: float = DEFAULT_MIN_KEYFRAME_IOU) -> bool:
+    """
+    Whether the frames between two keyframes should be tracked instead of interpolated, because the objects move too
+    far between the keyframes or the flow doesn't explain how their masks change.
+
+    Args:
+        masks_a: Nx1xHxW boolean masks of keyframe a
+        masks_b: Nx1xHxW boolean masks of keyframe b, with the objects in the same order
+        flow_b_to_a: Flow from keyframe b to keyframe a
+        max_motion: Maximum mean motion in the masks, as a fraction of the frame's longest side
+        min_iou: Minimum IoU of each warped mask of keyframe a with the mask of keyframe b
+
+    Returns:
+        True if the frames should be tracked
+    """
+    if masks_a.shape != masks_b.shape:
+        return True
+    flow_h, flow_w = flow_b_to_a.shape[:2]
+    objects_b = cv2.resize(masks_b.any(axis=(0, 1)).astype(np.uint8), (flow_w, flow_h),
+                           interpolation=cv2.INTER_NEAREST).astype(bool)
+    if objects_b.any():
+        motion = np.linalg.norm(flow_b_to_a[objects_b], axis=-1).mean() / max(flow_h, flow_w)
+        if motion > max_motion:
+            return True
+
+    warped_a = warp_to_frame(masks_a.astype(np.float32), flow_b_to_a) > 0.5
+    for mask_a, mask_b in zip(warped_a, masks_b):
+        union = np.logical_or(mask_a, mask_b).sum()
+        if union == 0:
+            continue
+        if np.logical_and(mask_a, mask_b).sum() / union < min_iou:
+            return True
+    return False
@@ -0,0 +1,232 @@
+"""Persisted mask tracks, so a tracked video can be re-rendered with other filter settings without re-tracking."""
+
+import hashlib
+import io
+import json
+import os
+import zipfile
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+
+import numpy as np
+
+from modules.paths import TEMP_TRACKS_DIR
+from modules.logger_util import get_logger
+
+logger = get_logger()
+
+MASK_TRACK_EXT = ".npz"
+# Number of mask tracks kept on disk. The least recently used tracks are removed first.
+MAX_MASK_TRACKS = 16
+
+
+def get_video_id(vid_input: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Get the identity of the video file from its size and the content of its first and last chunks. This doesn't
+    depend on the file path, and doesn't read the whole file.
+
+    Args:
+        vid_input: Video file path
+        chunk_size: Number of bytes hashed from the start and the end of the file
+
+    Returns:
+        Hex digest of the video identity
+    """
+    file_size = os.path.getsize(vid_input)
+    digest = hashlib.sha1(str(file_size).encode())
+    with open(vid_input, "rb") as f:
+        digest.update(f.read(chunk_size))
+        if file_size > chunk_size:
+            f.seek(max(chunk_size, file_size - chunk_size))
+            digest.update(f.read(chunk_size))
+    return digest.hexdigest()
+
+
+def get_mask_track_key(video_id: str,
+                       model_type: str,
+                       prompts: Dict[int, Dict[int, Dict[str, Optional[np.ndarray]]]],
+                       **params: Any) -> str:
+    """
+    Get the key of the mask track from everything that changes the tracked masks.
+
+    Args:
+        video_id: Identity of the video from get_video_id()
+        model_type: Model type used for tracking
+        prompts: Registered video prompts, object id -> frame index -> prompt data
+        **params: Other tracking parameters, e.g. the frame range
+
+    Returns:
+        Hex digest of the key
+    """
+    def to_list(value):
+        return np.asarray(value).tolist() if value is not None else None
+
+    serialized_prompts = {
+        str(obj_id): {
+            str(frame_idx): {key: to_list(value) for key, value in sorted(prompt.items())}
+            for frame_idx, prompt in sorted(frame_prompts.items())
+        }
+        for obj_id, frame_prompts in sorted(prompts.items())
+    }
+    data = {
+        "video_id": video_id,
+        "model_type": model_type,
+        "prompts": serialized_prompts,
+        "params": {key: to_list(value) for key, value in sorted(params.items())}
+    }
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def get_mask_track_path(key: str, track_dir: str = TEMP_TRACKS_DIR) -> str:
+    """Get the path of the mask track file."""
+    return os.path.join(track_dir, f"{key}{MASK_TRACK_EXT}")
+
+
+def encode_masks(masks: np.ndarray, obj_ids: List[int]) -> Dict[str, np.ndarray]:
+    """
+    Encode the masks of a frame into named arrays, bit-packed for boolean masks or float16 for mask logits.
+
+    Args:
+        masks: Boolean masks in Nx1xHxW format, or floating point mask logits
+        obj_ids: Object ids of the masks
+
+    Returns:
+        Arrays by name, decoded with decode_masks()
+    """
+    if np.issubdtype(np.asarray(masks).dtype, np.floating):
+        arrays = {"logits": np.asarray(masks, dtype=np.float16)}
+    else:
+        masks = np.asarray(masks, dtype=bool)
+        num_pixels = int(np.prod(masks.shape[1:]))
+        arrays = {
+            "masks": np.packbits(masks.reshape(len(masks), num_pixels), axis=1),
+            "shape": np.array(masks.shape, dtype=np.int64)
+        }
+    arrays["ids"] = np.array(obj_ids, dtype=np.int64)
+    return arrays
+
+
+def decode_masks(arrays: Mapping[str, np.ndarray]) -> Tuple[np.ndarray, List[int]]:
+    """Decode the arrays from encode_masks() to the masks, or the float16 mask logits, and the object ids."""
+    if "logits" in arrays:
+        return arrays["logits"], arrays["ids"].tolist()
+    shape = tuple(arrays["shape"])
+    num_pixels = int(np.prod(shape[1:]))
+    masks = np.unpackbits(arrays["masks"], axis=1, count=num_pixels).astype(bool)
+    return masks.reshape(shape), arrays["ids"].tolist()
+
+
+class MaskTrackWriter:
+    """
+    Write the tracked masks of each frame into a compressed npz file as bit-packed arrays, or as float16 arrays for
+    mask logits. Frames are written as they come, and the file only appears at its path when the writer is closed,
+    so an interrupted track is never loaded.
+    """
+
+    def __init__(self, track_path: str):
+        self.track_path = track_path
+        self._temp_path = track_path + ".tmp"
+        os.makedirs(os.path.dirname(track_path), exist_ok=True)
+        self._zip = zipfile.ZipFile(self._temp_path, "w", compression=zipfile.ZIP_DEFLATED)
+
+    def add(self, frame_idx: int, masks: np.ndarray, obj_ids: List[int]):
+        """
+        Add the masks of the frame.
+
+        Args:
+            frame_idx: Frame index
+            masks: Boolean masks in Nx1xHxW format, or floating point mask logits
+            obj_ids: Object ids of the masks
+        """
+        prefix = f"{frame_idx:05d}"
+        for name, array in encode_masks(masks, obj_ids).items():
+            self._write_array(f"{prefix}_{name}", array)
+
+    def close(self):
+        """Finish the track and move it to its path."""
+        self._zip.close()
+        os.replace(self._temp_path, self.track_path)
+        prune_mask_tracks(os.path.dirname(self.track_path))
+
+    def abort(self):
+        """Discard the unfinished track."""
+        self._zip.close()
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+    def _write_array(self, name: str, array: np.ndarray):
+        buffer = io.BytesIO()
+        np.lib.format.write_array(buffer, array, allow_pickle=False)
+        self._zip.writestr(f"{name}.npy", buffer.getvalue())
+
+
+class MaskCheckpoint:
+    """
+    Tracked masks of an unfinished render saved in a file per frame, so a cancelled, failed or interrupted render
+    resumes tracking from the saved frames instead of the start. Frame files are only renamed into place when
+    complete, so a crash never leaves a broken frame.
+    """
+
+    def __init__(self, checkpoint_dir: str):
+        self.checkpoint_dir = checkpoint_dir
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def add(self, frame_idx: int, masks: np.ndarray, obj_ids: List[int]):
+        """
+        Save the masks of the frame.
+
+        Args:
+            frame_idx: Frame index
+            masks: Boolean masks in Nx1xHxW format, or floating point mask logits
+            obj_ids: Object ids of the masks
+        """
+        frame_path = os.path.join(self.checkpoint_dir, f"{frame_idx:05d}{MASK_TRACK_EXT}")
+        temp_path = frame_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            np.savez_compressed(f, **encode_masks(masks, obj_ids))
+        os.replace(temp_path, frame_path)
+
+    def load(self) -> Iterator[Tuple[int, np.ndarray, List[int]]]:
+        """
+        Load the saved frames in the frame order.
+
+        Yields:
+            Frame index, boolean masks in Nx1xHxW format or float16 mask logits, and object ids of the frame
+        """
+        frame_indices = sorted(int(filename[:-len(MASK_TRACK_EXT)]) for filename in os.listdir(self.checkpoint_dir)
+                               if filename.endswith(MASK_TRACK_EXT) and filename[:-len(MASK_TRACK_EXT)].isdigit())
+        for frame_idx in frame_indices:
+            with np.load(os.path.join(self.checkpoint_dir, f"{frame_idx:05d}{MASK_TRACK_EXT}"),
+                         allow_pickle=False) as arrays:
+                yield (frame_idx, *decode_masks(arrays))
+
+
+def load_mask_track(track_path: str) -> Iterator[Tuple[int, np.ndarray, List[int]]]:
+    """
+    Load the mask track frame by frame in the frame order.
+
+    Args:
+        track_path: Path of the mask track file
+
+    Yields:
+        Frame index, boolean masks in Nx1xHxW format or float16 mask logits, and object ids of the frame
+    """
+    # Mark the track as recently used
+    os.utime(track_path)
+    with np.load(track_path, allow_pickle=False) as track:
+        frame_indices = sorted(int(name.split("_")[0]) for name in track.files if name.endswith("_ids"))
+        for frame_idx in frame_indices:
+            prefix = f"{frame_idx:05d}"
+            arrays = {name: track[f"{prefix}_{name}"] for name in ["logits", "masks", "shape", "ids"]
+                      if f"{prefix}_{name}" in track}
+            yield (frame_idx, *decode_masks(arrays))
+
+
+def prune_mask_tracks(track_dir: str = TEMP_TRACKS_DIR, max_tracks: int = MAX_MASK_TRACKS):
+    """Remove the least recently used mask tracks over max_tracks."""
+    track_paths = [os.path.join(track_dir, name) for name in os.listdir(track_dir) if name.endswith(MASK_TRACK_EXT)]
+    track_paths.sort(key=os.path.getmtime, reverse=True)
+    for track_path in track_paths[max_tracks:]:
+        try:
+            os.remove(track_path)
+        except OSError:
+            logger.exception(f"Error while removing mask track {track_path}")
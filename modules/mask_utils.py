@@ -1,13 +1,21 @@
+import os
 import cv2
 import numpy as np
 from numpy.typing import NDArray
 from typing import Dict, List, Tuple
 import colorsys
+from PIL import Image
 from pytoshop import layers
 from pytoshop.enums import BlendMode
 from pytoshop.core import PsdFile
 
 from modules.constants import DEFAULT_COLOR, DEFAULT_PIXEL_SIZE
+from modules.paths import TEMP_GALLERY_DIR
+
+# Longest side of the images shown in the layer divider gallery. Full resolution layers are only in the PSD file
+OVERVIEW_MAX_SIZE = 1024
+GALLERY_PREVIEW_MAX_SIZE = 384
+GALLERY_PREVIEW_QUALITY = 80
 
 
 def decode_to_mask(seg: NDArray[np.bool_] | NDArray[np.uint8]) -> NDArray[np.uint8]:
@@ -29,13 +37,110 @@ def invert_masks(masks: List[Dict]) -> List[Dict]:
     return inverted_masks
 
 
-def generate_random_color() -> Tuple[int, int, int]:
-    """Generate random color in RGB format"""
-    h = np.random.randint(0, 360)
-    s = np.random.randint(70, 100) / 100
-    v = np.random.randint(70, 100) / 100
-    r, g, b = colorsys.hsv_to_rgb(h/360, s, v)
-    return int(r * 255), int(g * 255), int(b * 255)
+def upsample_mask_logits(
+    mask_logits: np.ndarray,
+    guide_image: np.ndarray,
+    proxy_image: np.ndarray,
+    radius: int = 4,
+    eps: float = 1e-3,
+    threshold: float = 0.0
+) -> np.ndarray:
+    """
+    Upsample mask logits predicted on a downscaled proxy frame to the full resolution frame with the fast guided
+    filter, so the upsampled mask edges follow the edges of the full resolution frame.
+
+    Args:
+        mask_logits: Mask logits in NxHxW format at the proxy resolution
+        guide_image: Full resolution RGB frame
+        proxy_image: Proxy RGB frame that the masks were predicted on
+        radius: Box filter radius at the proxy resolution
+        eps: Regularization of the guided filter. Larger values smooth more across edges
+        threshold: Logit threshold of the masks
+
+    Returns:
+        Boolean masks in NxHxW format at the full resolution
+    """
+    full_h, full_w = guide_image.shape[:2]
+    proxy_h, proxy_w = mask_logits.shape[-2:]
+    if proxy_image.shape[:2] != (proxy_h, proxy_w):
+        proxy_image = cv2.resize(proxy_image, (proxy_w, proxy_h), interpolation=cv2.INTER_AREA)
+
+    guide = cv2.cvtColor(guide_image, cv2.COLOR_RGB2GRAY).astype(np.float32) / 255
+    proxy_guide = cv2.cvtColor(proxy_image, cv2.COLOR_RGB2GRAY).astype(np.float32) / 255
+
+    def box(x: np.ndarray) -> np.ndarray:
+        return cv2.boxFilter(x, -1, (2 * radius + 1, 2 * radius + 1))
+
+    mean_i = box(proxy_guide)
+    var_i = box(proxy_guide * proxy_guide) - mean_i * mean_i
+
+    prob_threshold = 1 / (1 + np.exp(-threshold))
+    masks = []
+    for logits in mask_logits.astype(np.float32):
+        prob = 1 / (1 + np.exp(-np.clip(logits, -30, 30)))
+        mean_p = box(prob)
+        cov_ip = box(proxy_guide * prob) - mean_i * mean_p
+        a = cov_ip / (var_i + eps)
+        b = mean_p - a * mean_i
+
+        mean_a = cv2.resize(box(a), (full_w, full_h), interpolation=cv2.INTER_LINEAR)
+        mean_b = cv2.resize(box(b), (full_w, full_h), interpolation=cv2.INTER_LINEAR)
+        masks.append(mean_a * guide + mean_b > prob_threshold)
+
+    return np.array(masks, dtype=bool).reshape(-1, full_h, full_w)
+
+
+def get_color_lut(num_colors: int) -> NDArray[np.uint8]:
+    """
+    Get the fixed color lookup table for the label map. Hues are spread by the golden ratio, so neighbouring labels
+    get distinct colors. The first row is the background.
+
+    Args:
+        num_colors: Number of colors excluding the background
+
+    Returns:
+        (num_colors + 1)x3 RGB lookup table
+    """
+    lut = np.zeros((num_colors + 1, 3), dtype=np.uint8)
+    for index in range(num_colors):
+        r, g, b = colorsys.hsv_to_rgb((index * 0.618033988749895) % 1, 0.85, 0.95)
+        lut[index + 1] = int(r * 255), int(g * 255), int(b * 255)
+    return lut
+
+
+def resize_to_max_size(image: np.ndarray, max_size: int) -> np.ndarray:
+    """Downscale the image so its longest side is at most max_size"""
+    height, width = image.shape[:2]
+    ratio = max_size / max(height, width)
+    if ratio >= 1:
+        return image
+    size = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def create_label_map(
+    masks: List[Dict],
+    size: Tuple[int, int]
+) -> NDArray[np.int32]:
+    """
+    Create the label map of the masks. Each pixel has the index + 1 of the last mask that covers it, and 0 for the
+    background.
+
+    Args:
+        masks: List of mask data
+        size: Size of the label map in (width, height). Masks are resized with the nearest neighbour
+
+    Returns:
+        HxW label map
+    """
+    width, height = size
+    label_map = np.zeros((height, width), dtype=np.int32)
+    for index, info in enumerate(masks):
+        mask = decode_to_mask(info['segmentation'])
+        if mask.shape != (height, width):
+            mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+        label_map[mask > 0] = index + 1
+    return label_map
 
 
 def create_base_layer(image: np.ndarray) -> List[np.ndarray]:
@@ -76,79 +181,76 @@ def create_mask_layers(
 
 def create_mask_gallery(
     image: np.ndarray,
-    masks: List[Dict]
+    masks: List[Dict],
+    output_dir: str = TEMP_GALLERY_DIR,
+    max_size: int = GALLERY_PREVIEW_MAX_SIZE,
+    file_prefix: str = "part"
 ) -> List:
     """
-    Create list of images with mask data. Masks are sorted by area in descending order. Specially used for gradio
-    Gallery component. each element has image and label, where label is the part number.
+    Create list of preview images with mask data. Masks are sorted by area in descending order. Specially used for
+    gradio Gallery component. each element has image and label, where label is the part number.
+    Each preview is cropped to the bounding box of the mask, downscaled to max_size and saved as a compressed WebP
+    file, so only small files are sent to the browser.
 
     Args:
         image: Original image
         masks: List of mask data
+        output_dir: Directory of the preview files
+        max_size: Longest side of the previews
+        file_prefix: File name prefix of the previews
 
     Returns:
-        List of [image, label] pairs
+        List of [image path, label] pairs
     """
-    mask_array_list = []
-    label_list = []
-
+    os.makedirs(output_dir, exist_ok=True)
     sorted_masks = sorted(masks, key=lambda x: x['area'], reverse=True)
 
+    gallery = []
     for index, info in enumerate(sorted_masks):
-        rle = info['segmentation']
-        mask = decode_to_mask(rle)
+        mask = decode_to_mask(info['segmentation'])
+        rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+        if len(rows) == 0:
+            top, bottom, left, right = 0, mask.shape[0], 0, mask.shape[1]
+        else:
+            top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
 
-        rgba_image = cv2.cvtColor(image, cv2.COLOR_RGB2RGBA)
-        rgba_image[..., 3] = cv2.bitwise_and(
-            rgba_image[..., 3], rgba_image[..., 3], mask=mask)
+        rgba_image = cv2.cvtColor(image[top:bottom, left:right], cv2.COLOR_RGB2RGBA)
+        rgba_image[..., 3] = np.where(mask[top:bottom, left:right] > 0, 255, 0)
+        rgba_image = resize_to_max_size(rgba_image, max_size)
 
-        mask_array_list.append(rgba_image)
-        label_list.append(f'Part {index}')
+        output_path = os.path.join(output_dir, f"{file_prefix}-{index}.webp")
+        Image.fromarray(rgba_image).save(output_path, quality=GALLERY_PREVIEW_QUALITY)
+        gallery.append([output_path, f'Part {index}'])
 
-    return [[img, label] for img, label in zip(mask_array_list, label_list)]
+    return gallery
 
 
 def create_mask_combined_images(
     image: np.ndarray,
-    masks: List[Dict]
+    masks: List[Dict],
+    max_size: int = OVERVIEW_MAX_SIZE
 ) -> List:
     """
-    Create an image with colored masks. Each mask is colored with a random color and blended with the original image.
+    Create an overview image with colored masks, downscaled to max_size. The masks are drawn into a label map, and
+    colored and blended with the original image in one pass with a fixed color lookup table.
 
     Args:
         image: Original image
         masks: List of mask data
+        max_size: Longest side of the overview image
 
     Returns:
         [image, label] pairs
     """
-    final_result = np.zeros_like(image)
-    used_colors = set()
-
-    for info in masks:
-        rle = info['segmentation']
-        mask = decode_to_mask(rle)
-
-        while True:
-            color = generate_random_color()
-            if color not in used_colors:
-                used_colors.add(color)
-                break
-
-        colored_mask = np.zeros_like(image)
-        colored_mask[mask > 0] = color
-
-        blended = cv2.addWeighted(image, 0.3, colored_mask, 0.7, 0)
-        final_result = np.where(
-            mask[:, :, np.newaxis] > 0, blended, final_result)
-
-    combined_image = np.where(final_result != 0, final_result, image)
+    overview = resize_to_max_size(image[..., :3], max_size)
+    height, width = overview.shape[:2]
+    label_map = create_label_map(masks, (width, height))
+    lut = get_color_lut(len(masks))
 
-    hsv = cv2.cvtColor(combined_image, cv2.COLOR_BGR2HSV)
-    hsv[:, :, 1] = np.clip(hsv[:, :, 1] * 1.5, 0, 255)
-    enhanced = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+    blended = (overview * 0.3 + lut[label_map] * 0.7).astype(np.uint8)
+    combined_image = np.where(label_map[..., np.newaxis] > 0, blended, overview)
 
-    return [enhanced, "Masked"]
+    return [combined_image, "Masked"]
 
 
 def create_mask_pixelized_image(
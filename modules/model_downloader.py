@@ -14,11 +14,24 @@ AVAILABLE_MODELS = {
     "sam2.1_hiera_base_plus": ["sam2.1_hiera_base_plus.pt", "https://dl.fbaipublicfiles.com/segment_anything_2/092824/sam2.1_hiera_base_plus.pt"],
     "sam2.1_hiera_large": ["sam2.1_hiera_large.pt", "https://dl.fbaipublicfiles.com/segment_anything_2/092824/sam2.1_hiera_large.pt"],
 }
+# Quantized variants are named with this suffix after the base model type, e.g. "sam2_hiera_large_int8"
+QUANTIZED_MODEL_SUFFIX = "_int8"
+QUANTIZED_MODELS = [f"{model_type}{QUANTIZED_MODEL_SUFFIX}" for model_type in AVAILABLE_MODELS]
+
+
+def is_quantized_model_type(model_type: str) -> bool:
+    return model_type.endswith(QUANTIZED_MODEL_SUFFIX)
+
+
+def get_base_model_type(model_type: str) -> str:
+    if is_quantized_model_type(model_type):
+        return model_type[:-len(QUANTIZED_MODEL_SUFFIX)]
+    return model_type
 
 
 def download_sam_model_url(model_type: str,
                            model_dir: str = MODELS_DIR):
-    filename, url = AVAILABLE_MODELS[model_type]
+    filename, url = AVAILABLE_MODELS[get_base_model_type(model_type)]
     load_file_from_url(url=url, model_dir=model_dir)
 
 
@@ -52,6 +65,6 @@ def is_sam_exist(
 ):
     if model_dir is None:
         model_dir = MODELS_DIR
-    filename, url = AVAILABLE_MODELS[model_type]
+    filename, url = AVAILABLE_MODELS[get_base_model_type(model_type)]
     model_path = os.path.join(model_dir, filename)
     return os.path.exists(model_path)
@@ -0,0 +1,417 @@
+"""ONNX Runtime backend for the SAM2 image encoder and prompt decoder."""
+
+import argparse
+import json
+import os
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from PIL.Image import Image
+
+from modules.model_downloader import AVAILABLE_MODELS, get_base_model_type
+from modules.paths import MODELS_DIR
+from modules.exceptions import ModelLoadError
+from modules.logger_util import get_logger
+
+logger = get_logger()
+
+TORCH_BACKEND = "torch"
+ONNX_BACKEND = "onnx"
+AVAILABLE_BACKENDS = [TORCH_BACKEND, ONNX_BACKEND]
+ONNX_OPSET_VERSION = 17
+# Spatial sizes of the backbone feature maps, same as SAM2ImagePredictor
+BACKBONE_FEAT_SIZES = [(256, 256), (128, 128), (64, 64)]
+
+
+def get_onnx_model_paths(model_type: str,
+                         model_dir: str = MODELS_DIR) -> Dict[str, str]:
+    """Get the paths of the exported encoder, decoder and metadata files for the model type."""
+    filename, url = AVAILABLE_MODELS[get_base_model_type(model_type)]
+    name = os.path.splitext(filename)[0]
+    return {
+        "encoder": os.path.join(model_dir, f"{name}.encoder.onnx"),
+        "decoder": os.path.join(model_dir, f"{name}.decoder.onnx"),
+        "metadata": os.path.join(model_dir, f"{name}.onnx.json"),
+    }
+
+
+def is_onnxruntime_available() -> bool:
+    """Whether the optional onnxruntime package is installed."""
+    try:
+        import onnxruntime  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def check_backend(backend: str):
+    """
+    Check that the packages of the backend are installed, so choosing a backend that can't run fails on startup
+    instead of on the first prediction.
+
+    Args:
+        backend: "torch" or "onnx"
+    """
+    if backend not in AVAILABLE_BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}'. Available backends: {', '.join(AVAILABLE_BACKENDS)}")
+    if backend == ONNX_BACKEND and not is_onnxruntime_available():
+        raise ModelLoadError(
+            "onnxruntime is required for the ONNX backend. "
+            "Install it with: pip install onnxruntime"
+        )
+
+
+def is_onnx_model_exist(model_type: str,
+                        model_dir: str = MODELS_DIR) -> bool:
+    return all(os.path.exists(path) for path in get_onnx_model_paths(model_type, model_dir).values())
+
+
+class SamImageEncoder(torch.nn.Module):
+    """Image encoder part of SAM2ImagePredictor.set_image() for the export."""
+
+    def __init__(self, sam_model: torch.nn.Module):
+        super().__init__()
+        self.model = sam_model
+
+    def forward(self, image: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        backbone_out = self.model.forward_image(image)
+        _, vision_feats, _, _ = self.model._prepare_backbone_features(backbone_out)
+        if self.model.directly_add_no_mem_embed:
+            vision_feats[-1] = vision_feats[-1] + self.model.no_mem_embed
+
+        feats = [
+            feat.permute(1, 2, 0).reshape(1, -1, *feat_size)
+            for feat, feat_size in zip(vision_feats[::-1], BACKBONE_FEAT_SIZES[::-1])
+        ][::-1]
+        return feats[-1], feats[0], feats[1]
+
+
+class SamPromptDecoder(torch.nn.Module):
+    """
+    Prompt encoder and mask decoder part of SAM2ImagePredictor.predict() for the export. It returns all mask tokens,
+    so the multimask selection is done outside the graph.
+    """
+
+    def __init__(self, sam_model: torch.nn.Module):
+        super().__init__()
+        self.prompt_encoder = sam_model.sam_prompt_encoder
+        self.mask_decoder = sam_model.sam_mask_decoder
+
+    def forward(self,
+                image_embed: torch.Tensor,
+                high_res_feats_0: torch.Tensor,
+                high_res_feats_1: torch.Tensor,
+                point_coords: torch.Tensor,
+                point_labels: torch.Tensor,
+                mask_input: torch.Tensor,
+                has_mask_input: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        sparse_embeddings = self.prompt_encoder._embed_points(
+            point_coords, point_labels, pad=False)
+
+        mask_embedding = self.prompt_encoder._embed_masks(mask_input)
+        no_mask_embedding = self.prompt_encoder.no_mask_embed.weight.reshape(1, -1, 1, 1)
+        dense_embeddings = has_mask_input * mask_embedding + (1 - has_mask_input) * no_mask_embedding
+
+        low_res_masks, iou_predictions, _, _ = self.mask_decoder.predict_masks(
+            image_embeddings=image_embed,
+            image_pe=self.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            repeat_image=True,
+            high_res_features=[high_res_feats_0, high_res_feats_1],
+        )
+        return low_res_masks, iou_predictions
+
+
+@torch.no_grad()
+def export_onnx_models(sam_model: torch.nn.Module,
+                       model_type: str,
+                       model_dir: str = MODELS_DIR) -> Dict[str, str]:
+    """
+    Export the image encoder and the prompt decoder of the model as ONNX graphs into the model directory.
+
+    Args:
+        sam_model: SAM2 model to export.
+        model_type: The model type of the model.
+        model_dir: The model directory.
+
+    Returns:
+        Dict[str, str]: Paths of the exported "encoder", "decoder" and "metadata" files.
+    """
+    paths = get_onnx_model_paths(model_type, model_dir)
+    device = sam_model.device
+    sam_model = sam_model.float().cpu().eval()
+    image_size = sam_model.image_size
+    logger.info(f"Exporting {model_type} model to ONNX..")
+
+    image = torch.randn(1, 3, image_size, image_size)
+    # The wrappers must be in eval mode, otherwise the export leaves the shared model in training mode
+    encoder = SamImageEncoder(sam_model).eval()
+    image_embed, high_res_feats_0, high_res_feats_1 = encoder(image)
+    torch.onnx.export(
+        encoder,
+        (image,),
+        paths["encoder"],
+        input_names=["image"],
+        output_names=["image_embed", "high_res_feats_0", "high_res_feats_1"],
+        opset_version=ONNX_OPSET_VERSION,
+        dynamo=False
+    )
+
+    low_res_size = image_size // 4
+    decoder_args = (
+        image_embed,
+        high_res_feats_0,
+        high_res_feats_1,
+        torch.randint(0, image_size, (1, 3, 2), dtype=torch.float),
+        torch.tensor([[2, 3, -1]], dtype=torch.float),
+        torch.zeros(1, 1, low_res_size, low_res_size),
+        torch.tensor([0], dtype=torch.float),
+    )
+    torch.onnx.export(
+        SamPromptDecoder(sam_model).eval(),
+        decoder_args,
+        paths["decoder"],
+        input_names=["image_embed", "high_res_feats_0", "high_res_feats_1",
+                     "point_coords", "point_labels", "mask_input", "has_mask_input"],
+        output_names=["low_res_masks", "iou_predictions"],
+        dynamic_axes={
+            "point_coords": {0: "num_prompts", 1: "num_points"},
+            "point_labels": {0: "num_prompts", 1: "num_points"},
+            "mask_input": {0: "num_prompts"},
+            "low_res_masks": {0: "num_prompts"},
+            "iou_predictions": {0: "num_prompts"},
+        },
+        opset_version=ONNX_OPSET_VERSION,
+        dynamo=False
+    )
+
+    mask_decoder = sam_model.sam_mask_decoder
+    metadata = {
+        "model_type": get_base_model_type(model_type),
+        "image_size": image_size,
+        "dynamic_multimask_via_stability": bool(mask_decoder.dynamic_multimask_via_stability),
+        "dynamic_multimask_stability_delta": float(mask_decoder.dynamic_multimask_stability_delta),
+        "dynamic_multimask_stability_thresh": float(mask_decoder.dynamic_multimask_stability_thresh),
+    }
+    with open(paths["metadata"], "w") as f:
+        json.dump(metadata, f, indent=2)
+
+    sam_model.to(device)
+    return paths
+
+
+def create_onnx_session(model_path: str,
+                        num_threads: Optional[int] = None,
+                        enable_cpu_mem_arena: bool = True):
+    """
+    Create an ONNX Runtime inference session on CPU.
+
+    Args:
+        model_path: Path of the ONNX graph.
+        num_threads: Intra-op thread count. Use the ONNX Runtime default if None.
+        enable_cpu_mem_arena: Whether to use the memory arena. Disabling it lowers the resident memory at the cost
+            of slower allocations.
+    """
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        raise ModelLoadError(
+            "onnxruntime is required for the ONNX backend. "
+            "Install it with: pip install onnxruntime"
+        )
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.enable_cpu_mem_arena = enable_cpu_mem_arena
+    if num_threads is not None:
+        options.intra_op_num_threads = num_threads
+    return ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+
+class OnnxImagePredictor:
+    """
+    Drop-in replacement of SAM2ImagePredictor for set_image() and predict() that runs the image encoder and the
+    prompt decoder with ONNX Runtime.
+    """
+
+    def __init__(self,
+                 model_type: str,
+                 model_dir: str = MODELS_DIR,
+                 num_threads: Optional[int] = None,
+                 enable_cpu_mem_arena: bool = True,
+                 mask_threshold: float = 0.0):
+        from sam2.utils.transforms import SAM2Transforms
+
+        if not is_onnx_model_exist(model_type, model_dir):
+            raise ModelLoadError(f"ONNX model for {model_type} not found. Export it first")
+
+        paths = get_onnx_model_paths(model_type, model_dir)
+        with open(paths["metadata"], "r") as f:
+            self.metadata = json.load(f)
+
+        self.encoder_session = create_onnx_session(paths["encoder"], num_threads, enable_cpu_mem_arena)
+        self.decoder_session = create_onnx_session(paths["decoder"], num_threads, enable_cpu_mem_arena)
+        self.mask_threshold = mask_threshold
+        self._transforms = SAM2Transforms(
+            resolution=self.metadata["image_size"],
+            mask_threshold=mask_threshold
+        )
+        self._features = None
+        self._orig_hw = None
+
+    def set_image(self, image: Union[np.ndarray, Image]) -> None:
+        """Calculates the image embeddings for the provided image."""
+        if isinstance(image, np.ndarray):
+            self._orig_hw = image.shape[:2]
+        else:
+            w, h = image.size
+            self._orig_hw = (h, w)
+
+        input_image = self._transforms(image)[None, ...].numpy().astype(np.float32)
+        image_embed, high_res_feats_0, high_res_feats_1 = self.encoder_session.run(
+            None, {"image": input_image})
+        self._features = {
+            "image_embed": image_embed,
+            "high_res_feats_0": high_res_feats_0,
+            "high_res_feats_1": high_res_feats_1,
+        }
+
+    def predict(self,
+                point_coords: Optional[np.ndarray] = None,
+                point_labels: Optional[np.ndarray] = None,
+                box: Optional[np.ndarray] = None,
+                mask_input: Optional[np.ndarray] = None,
+                multimask_output: bool = True,
+                return_logits: bool = False,
+                normalize_coords: bool = True) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Predict masks for the given input prompts, using the currently set image. Same as SAM2ImagePredictor.predict().
+
+        Returns:
+            np.ndarray: The output masks in CxHxW format, or BxCxHxW format for multiple boxes.
+            np.ndarray: An array of length C containing the predicted quality of each mask.
+            np.ndarray: An array of low resolution logits in CxHxW format.
+        """
+        if self._features is None:
+            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+
+        coords, labels = self._prep_prompts(point_coords, point_labels, box, normalize_coords)
+        num_prompts = coords.shape[0]
+
+        low_res_size = self.metadata["image_size"] // 4
+        if mask_input is not None:
+            mask_input = np.asarray(mask_input, dtype=np.float32).reshape(-1, 1, low_res_size, low_res_size)
+            mask_input = np.broadcast_to(mask_input, (num_prompts, 1, low_res_size, low_res_size))
+            has_mask_input = np.ones(1, dtype=np.float32)
+        else:
+            mask_input = np.zeros((num_prompts, 1, low_res_size, low_res_size), dtype=np.float32)
+            has_mask_input = np.zeros(1, dtype=np.float32)
+
+        low_res_masks, iou_predictions = self.decoder_session.run(None, {
+            **self._features,
+            "point_coords": coords,
+            "point_labels": labels,
+            "mask_input": np.ascontiguousarray(mask_input),
+            "has_mask_input": has_mask_input,
+        })
+        low_res_masks, iou_predictions = self._select_masks(low_res_masks, iou_predictions, multimask_output)
+
+        masks = self._transforms.postprocess_masks(torch.from_numpy(low_res_masks), self._orig_hw).numpy()
+        low_res_masks = np.clip(low_res_masks, -32.0, 32.0)
+        if not return_logits:
+            masks = masks > self.mask_threshold
+
+        if num_prompts == 1:
+            return masks[0], iou_predictions[0], low_res_masks[0]
+        return masks, iou_predictions, low_res_masks
+
+    def reset_predictor(self) -> None:
+        self._features = None
+        self._orig_hw = None
+
+    def _prep_prompts(self,
+                      point_coords: Optional[np.ndarray],
+                      point_labels: Optional[np.ndarray],
+                      box: Optional[np.ndarray],
+                      normalize_coords: bool) -> Tuple[np.ndarray, np.ndarray]:
+        """Merge boxes and points into the decoder inputs in the input image scale, with the padding point."""
+        coords_list: List[np.ndarray] = []
+        labels_list: List[np.ndarray] = []
+
+        if box is not None:
+            box = np.asarray(box, dtype=np.float32).reshape(-1, 2, 2)
+            coords_list.append(self._transform_coords(box, normalize_coords))
+            labels_list.append(np.tile(np.array([[2, 3]], dtype=np.float32), (box.shape[0], 1)))
+
+        if point_coords is not None:
+            points = np.asarray(point_coords, dtype=np.float32).reshape(1, -1, 2)
+            labels = np.asarray(point_labels, dtype=np.float32).reshape(1, -1)
+            num_prompts = coords_list[0].shape[0] if coords_list else 1
+            coords_list.append(np.repeat(self._transform_coords(points, normalize_coords), num_prompts, axis=0))
+            labels_list.append(np.repeat(labels, num_prompts, axis=0))
+
+        if not coords_list:
+            coords_list.append(np.zeros((1, 0, 2), dtype=np.float32))
+            labels_list.append(np.zeros((1, 0), dtype=np.float32))
+
+        coords = np.concatenate(coords_list, axis=1)
+        labels = np.concatenate(labels_list, axis=1)
+        # Padding point, same as the prompt encoder does when there's no box input
+        coords = np.concatenate([coords, np.zeros((coords.shape[0], 1, 2), dtype=np.float32)], axis=1)
+        labels = np.concatenate([labels, -np.ones((labels.shape[0], 1), dtype=np.float32)], axis=1)
+        return coords.astype(np.float32), labels.astype(np.float32)
+
+    def _transform_coords(self, coords: np.ndarray, normalize_coords: bool) -> np.ndarray:
+        coords = coords.copy()
+        if normalize_coords:
+            h, w = self._orig_hw
+            coords[..., 0] = coords[..., 0] / w
+            coords[..., 1] = coords[..., 1] / h
+        return coords * self.metadata["image_size"]
+
+    def _select_masks(self,
+                      low_res_masks: np.ndarray,
+                      iou_predictions: np.ndarray,
+                      multimask_output: bool) -> Tuple[np.ndarray, np.ndarray]:
+        """Select the output mask tokens, same as the SAM2 mask decoder does."""
+        if multimask_output:
+            return low_res_masks[:, 1:], iou_predictions[:, 1:]
+
+        single_masks, single_ious = low_res_masks[:, 0:1], iou_predictions[:, 0:1]
+        if not self.metadata["dynamic_multimask_via_stability"]:
+            return single_masks, single_ious
+
+        # Fall back to the best multimask output when the single mask output is unstable
+        delta = self.metadata["dynamic_multimask_stability_delta"]
+        flat = single_masks.reshape(single_masks.shape[0], -1)
+        area_i = (flat > delta).sum(-1)
+        area_u = (flat > -delta).sum(-1)
+        stability = np.where(area_u > 0, area_i / np.maximum(area_u, 1), 1.0)
+        is_stable = stability >= self.metadata["dynamic_multimask_stability_thresh"]
+
+        batch_inds = np.arange(low_res_masks.shape[0])
+        best_inds = np.argmax(iou_predictions[:, 1:], axis=-1) + 1
+        best_masks = low_res_masks[batch_inds, best_inds][:, None]
+        best_ious = iou_predictions[batch_inds, best_inds][:, None]
+        return (np.where(is_stable[:, None, None, None], single_masks, best_masks),
+                np.where(is_stable[:, None], single_ious, best_ious))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the image encoder and the prompt decoder to ONNX")
+    parser.add_argument('--model_types', type=str, nargs='+', default=list(AVAILABLE_MODELS.keys()),
+                        help='Model types to export')
+    parser.add_argument('--model_dir', type=str, default=MODELS_DIR,
+                        help='Model directory for segment-anything-2')
+    args = parser.parse_args()
+
+    from modules.sam_inference import SamInference
+
+    sam_inf = SamInference(model_dir=args.model_dir)
+    sam_inf.device = "cpu"
+    for model_type in args.model_types:
+        sam_inf.load_model(model_type=model_type)
+        export_onnx_models(sam_inf.model, model_type, args.model_dir)
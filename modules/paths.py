@@ -30,6 +30,10 @@ OUTPUT_PSD_DIR = os.path.join(OUTPUT_DIR, "psd")
 OUTPUT_FILTER_DIR = os.path.join(OUTPUT_DIR, "filter")
 TEMP_DIR = os.path.join(WEBUI_DIR, "temp")
 TEMP_OUT_DIR = os.path.join(TEMP_DIR, "out")
+TEMP_PROXY_DIR = os.path.join(TEMP_DIR, "proxy")
+TEMP_TRACKS_DIR = os.path.join(TEMP_DIR, "tracks")
+TEMP_GALLERY_DIR = os.path.join(TEMP_DIR, "gallery")
+TEMP_JOBS_DIR = os.path.join(TEMP_DIR, "jobs")
 
 for dir_path in [MODELS_DIR,
                  SAM2_CONFIGS_DIR,
@@ -37,5 +41,9 @@ for dir_path in [MODELS_DIR,
                  OUTPUT_PSD_DIR,
                  OUTPUT_FILTER_DIR,
                  TEMP_DIR,
-                 TEMP_OUT_DIR]:
+                 TEMP_OUT_DIR,
+                 TEMP_PROXY_DIR,
+                 TEMP_TRACKS_DIR,
+                 TEMP_GALLERY_DIR,
+                 TEMP_JOBS_DIR]:
     os.makedirs(dir_path, exist_ok=True)
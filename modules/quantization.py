@@ -0,0 +1,199 @@
+"""Dynamic int8 quantization of SAM2 models for CPU serving."""
+
+import argparse
+import os
+import time
+from typing import Dict, List
+
+import numpy as np
+import torch
+from PIL import Image
+
+from modules.model_downloader import (
+    AVAILABLE_MODELS, DEFAULT_MODEL_TYPE,
+    QUANTIZED_MODEL_SUFFIX,
+    get_base_model_type
+)
+from modules.paths import MODELS_DIR
+from modules.exceptions import ModelLoadError
+from modules.logger_util import get_logger
+
+logger = get_logger()
+
+# Submodules of SAM2Base whose Linear layers are dynamically quantized.
+QUANTIZED_SUBMODULES = ["image_encoder.trunk", "memory_attention"]
+
+
+def get_quantized_model_path(model_type: str,
+                             model_dir: str = MODELS_DIR) -> str:
+    """Get the path of the cached int8 weights for the model type."""
+    base_model_type = get_base_model_type(model_type)
+    filename, url = AVAILABLE_MODELS[base_model_type]
+    name, ext = os.path.splitext(filename)
+    return os.path.join(model_dir, f"{name}{QUANTIZED_MODEL_SUFFIX}{ext}")
+
+
+def quantize_sam_model(model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Apply dynamic int8 quantization to the Linear layers of the Hiera trunk and the memory attention.
+    Quantized layers only run on CPU.
+
+    Args:
+        model: SAM2 model on CPU.
+
+    Returns:
+        The same model with quantized submodules.
+    """
+    model.eval()
+    for name in QUANTIZED_SUBMODULES:
+        parent_name, _, attr = name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name else model
+        submodule = getattr(parent, attr, None)
+        if submodule is None:
+            logger.warning(f"Skipping quantization of missing submodule '{name}'")
+            continue
+
+        quantized = torch.ao.quantization.quantize_dynamic(
+            submodule, {torch.nn.Linear}, dtype=torch.qint8
+        )
+        setattr(parent, attr, quantized)
+    return model
+
+
+def load_quantized_model(model: torch.nn.Module,
+                         model_type: str,
+                         model_dir: str = MODELS_DIR) -> torch.nn.Module:
+    """
+    Quantize the model and load the cached int8 weights if they exist. Otherwise, the fp32 weights that are
+    already loaded in the model are converted and cached to disk for the next load.
+
+    Args:
+        model: SAM2 model on CPU. It must hold the fp32 checkpoint weights if no cache exists yet.
+        model_type: The quantized model type.
+        model_dir: The model directory.
+
+    Returns:
+        The quantized model.
+    """
+    quantized_path = get_quantized_model_path(model_type, model_dir)
+    model = quantize_sam_model(model)
+
+    if os.path.exists(quantized_path):
+        try:
+            state_dict = torch.load(quantized_path, map_location="cpu")
+            model.load_state_dict(state_dict)
+            return model
+        except Exception as e:
+            raise ModelLoadError(
+                f"Failed to load quantized weights from {quantized_path}") from e
+
+    logger.info(f"Caching quantized weights to {quantized_path}")
+    torch.save(model.state_dict(), quantized_path)
+    return model
+
+
+def mask_iou(mask_a: np.ndarray, mask_b: np.ndarray) -> float:
+    """Calculate IoU between two binary masks."""
+    mask_a, mask_b = mask_a.astype(bool), mask_b.astype(bool)
+    union = np.logical_or(mask_a, mask_b).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(mask_a, mask_b).sum() / union)
+
+
+def compare_quantized_model(image_paths: List[str],
+                            model_type: str = DEFAULT_MODEL_TYPE,
+                            model_dir: str = MODELS_DIR,
+                            num_runs: int = 3) -> List[Dict]:
+    """
+    Compare quality and latency of the int8 model against the fp32 model on sample images. Each image is prompted
+    with a single point at the center, and the best mask of each model is compared.
+
+    Args:
+        image_paths: Sample image paths.
+        model_type: The base model type to compare.
+        model_dir: The model directory.
+        num_runs: Number of timed runs per image.
+
+    Returns:
+        List of result dicts with "image", "fp32_ms", "int8_ms", "speedup" and "iou" keys.
+    """
+    from modules.sam_inference import SamInference
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+    base_model_type = get_base_model_type(model_type)
+    predictors = {}
+    for variant in [base_model_type, base_model_type + QUANTIZED_MODEL_SUFFIX]:
+        sam_inf = SamInference(model_dir=model_dir)
+        sam_inf.device = "cpu"
+        sam_inf.load_model(model_type=variant)
+        predictors[variant] = SAM2ImagePredictor(sam_model=sam_inf.model)
+
+    results = []
+    for image_path in image_paths:
+        image = np.array(Image.open(image_path).convert("RGB"))
+        h, w = image.shape[:2]
+        point_coords = np.array([[w / 2, h / 2]])
+        point_labels = np.array([1])
+
+        latencies, best_masks = [], []
+        for variant, predictor in predictors.items():
+            elapsed = []
+            for _ in range(num_runs):
+                start = time.perf_counter()
+                predictor.set_image(image)
+                masks, scores, logits = predictor.predict(
+                    point_coords=point_coords,
+                    point_labels=point_labels,
+                    multimask_output=True
+                )
+                elapsed.append(time.perf_counter() - start)
+            latencies.append(min(elapsed) * 1000)
+            best_masks.append(masks[np.argmax(scores)])
+
+        fp32_ms, int8_ms = latencies
+        results.append({
+            "image": image_path,
+            "fp32_ms": fp32_ms,
+            "int8_ms": int8_ms,
+            "speedup": fp32_ms / int8_ms if int8_ms > 0 else None,
+            "iou": mask_iou(*best_masks)
+        })
+
+    return results
+
+
+def format_comparison_report(results: List[Dict]) -> str:
+    """Format the comparison results as a markdown table."""
+    lines = ["| image | fp32 (ms) | int8 (ms) | speedup | IoU |",
+             "|---|---|---|---|---|"]
+    for r in results:
+        lines.append(f"| {os.path.basename(r['image'])} | {r['fp32_ms']:.1f} | {r['int8_ms']:.1f} "
+                     f"| {r['speedup']:.2f}x | {r['iou']:.4f} |")
+    if results:
+        lines.append(f"| **mean** | {np.mean([r['fp32_ms'] for r in results]):.1f} "
+                     f"| {np.mean([r['int8_ms'] for r in results]):.1f} "
+                     f"| {np.mean([r['speedup'] for r in results]):.2f}x "
+                     f"| {np.mean([r['iou'] for r in results]):.4f} |")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the int8 quantized model against the fp32 model")
+    parser.add_argument('images', type=str, nargs='+',
+                        help='Sample image paths')
+    parser.add_argument('--model_type', type=str, default=DEFAULT_MODEL_TYPE,
+                        help='Model type to compare')
+    parser.add_argument('--model_dir', type=str, default=MODELS_DIR,
+                        help='Model directory for segment-anything-2')
+    parser.add_argument('--num_runs', type=int, default=3,
+                        help='Number of timed runs per image')
+    args = parser.parse_args()
+
+    print(format_comparison_report(compare_quantized_model(
+        image_paths=args.images,
+        model_type=args.model_type,
+        model_dir=args.model_dir,
+        num_runs=args.num_runs
+    )))
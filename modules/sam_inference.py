@@ -1,25 +1,43 @@
 from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
 from sam2.build_sam import build_sam2, build_sam2_video_predictor
 from sam2.sam2_image_predictor import SAM2ImagePredictor
-from typing import Dict, List, Optional, Tuple, Any
+from typing import Dict, List, Optional, Tuple, Any, Union, Callable, Set, Container
+from collections import OrderedDict
+from contextlib import nullcontext
 import torch
 import os
+import gc
+import hashlib
+import threading
+import queue
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import numpy as np
+import cv2
+from PIL import Image
 import gradio as gr
 from gradio_i18n import gettext as _
 
 from modules.model_downloader import (
-    AVAILABLE_MODELS, DEFAULT_MODEL_TYPE,
+    AVAILABLE_MODELS, DEFAULT_MODEL_TYPE, QUANTIZED_MODELS,
     is_sam_exist,
+    is_quantized_model_type,
+    get_base_model_type,
     download_sam_model_url
 )
-from modules.paths import (MODELS_DIR, TEMP_OUT_DIR,
+from modules.exceptions import JobCancelledError
+from modules.quantization import get_quantized_model_path, load_quantized_model
+from modules.checkpoint_cache import load_mmap_weights
+from modules.onnx_backend import (ONNX_BACKEND, TORCH_BACKEND, OnnxImagePredictor, check_backend,
+                                  is_onnx_model_exist, export_onnx_models)
+from modules.paths import (MODELS_DIR, TEMP_OUT_DIR, TEMP_PROXY_DIR, TEMP_GALLERY_DIR,
                            TEMP_DIR, MODEL_CONFIGS, OUTPUT_DIR)
 from modules.constants import (BOX_PROMPT_MODE, AUTOMATIC_MODE, COLOR_FILTER, PIXELIZE_FILTER, IMAGE_FILE_EXT,
                                TRANSPARENT_VIDEO_FILE_EXT, TRANSPARENT_COLOR_FILTER)
 from modules.mask_utils import (
     invert_masks,
+    upsample_mask_logits,
     save_psd_with_masks,
     create_mask_combined_images,
     create_mask_gallery,
@@ -27,37 +45,185 @@ from modules.mask_utils import (
     create_solid_color_mask_image,
     create_alpha_mask_image
 )
+from modules.frame_cache import FrameCache
+from modules.amg_tuning import get_points_per_batch, MIN_POINTS_PER_BATCH
+from modules.tiled_amg import (generate_tiled_masks, DEFAULT_TILE_SIZE, DEFAULT_TILE_OVERLAP,
+                               DEFAULT_MERGE_IOU_THRESH)
+from modules.segment_store import SegmentStore, DEFAULT_SEGMENT_RAM_BUDGET_MB
+from modules.video_state import VideoInferenceState, diff_video_prompts, DEFAULT_FEATURE_CACHE_SIZE
+from modules.frame_encoder import BackgroundFrameEncoder, DEFAULT_PRECOMPUTE_BUDGET_MB
+from modules.mask_interpolation import (get_keyframes, load_flow_frame, compute_flow, interpolate_logits,
+                                        needs_full_tracking, DEFAULT_MAX_KEYFRAME_MOTION, DEFAULT_MIN_KEYFRAME_IOU)
+from modules.mask_tracks import (MaskTrackWriter, MaskCheckpoint, get_video_id, get_mask_track_key,
+                                 get_mask_track_path, load_mask_track)
 from modules.video_utils import (get_frames_from_dir, create_video_from_frames, get_video_info, extract_frames,
-                                 extract_sound, clean_temp_dir, clean_files_with_extension)
-from modules.utils import save_image
+                                 extract_sound, clean_temp_dir, clean_files_with_extension, detect_shots,
+                                 get_region_histogram)
+from modules.utils import save_image, FrameWriter, get_config_manager
 from modules.logger_util import get_logger
 
 logger = get_logger()
 
+# Number of frames shared by consecutive windows in the chunked video mode. Masks of these frames are carried to the
+# next window as conditioning masks.
+VIDEO_WINDOW_OVERLAP = 4
+VIDEO_WINDOW_DIR = os.path.join(TEMP_DIR, "window")
+# Keyframes of the keyframe stride mode, tracked in their own inference state while the gaps are tracked in windows
+VIDEO_KEYFRAME_DIR = os.path.join(TEMP_DIR, "keyframes")
+# Shots of videos with hard cuts are tracked in parallel windows, and each worker keeps up to this many tracked frames
+# waiting to be rendered
+VIDEO_SHOTS_DIR = os.path.join(TEMP_DIR, "shots")
+SHOT_QUEUE_SIZE = 4
+# Longest side of the preview frame, and the number of frame embeddings cached for the preview
+PREVIEW_MAX_SIZE = 1024
+PREVIEW_CACHE_SIZE = 8
+# Number of images whose prompt history is kept for prompt refinement, and the number of prompts kept per image
+IMAGE_SESSION_CACHE_SIZE = 8
+PROMPT_HISTORY_SIZE = 16
+# Autocast precisions of the performance profiles
+PRECISIONS = {
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+    "float32": torch.float32,
+}
+# Longest side of the proxy frames that videos are tracked on. SAM2 resizes frames to 1024 internally.
+DEFAULT_PROXY_MAX_SIZE = 1024
+
 
 class SamInference:
     def __init__(self,
                  model_dir: str = MODELS_DIR,
-                 output_dir: str = OUTPUT_DIR
+                 output_dir: str = OUTPUT_DIR,
+                 backend: str = TORCH_BACKEND,
+                 onnx_num_threads: Optional[int] = None,
+                 onnx_enable_cpu_mem_arena: bool = True,
+                 video_memory_budget_mb: Optional[int] = None,
+                 proxy_max_size: Optional[int] = DEFAULT_PROXY_MAX_SIZE,
+                 segment_ram_budget_mb: Optional[float] = DEFAULT_SEGMENT_RAM_BUDGET_MB,
+                 keep_mask_logits: bool = False,
+                 video_feature_cache_size: int = DEFAULT_FEATURE_CACHE_SIZE,
+                 precompute_budget_mb: Optional[float] = DEFAULT_PRECOMPUTE_BUDGET_MB,
+                 keyframe_stride: int = 1,
+                 keyframe_max_motion: float = DEFAULT_MAX_KEYFRAME_MOTION,
+                 keyframe_min_iou: float = DEFAULT_MIN_KEYFRAME_IOU
                  ):
         self.model = None
-        self.available_models = list(AVAILABLE_MODELS.keys())
         self.current_model_type = DEFAULT_MODEL_TYPE
         self.model_dir = model_dir
         self.output_dir = output_dir
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.available_models = list(AVAILABLE_MODELS.keys())
+        if self.device == "cpu":
+            self.available_models += QUANTIZED_MODELS
         self.dtype = torch.float16 if torch.cuda.is_available() else torch.bfloat16
+        # Model type selected by the performance profile for the UI
+        self.default_model_type = DEFAULT_MODEL_TYPE
+        self.profile = None
+        # Settings that were set explicitly, e.g. on the command line, so the profiles don't override them
+        self.fixed_settings: Set[str] = set()
         self.mask_generator = None
         self.image_predictor = None
+        # Key of the image that is set to the image predictor, so predicting the same image again skips the encoder
+        self.image_predictor_key = None
+        # Image key -> prompt history of the image, with the low resolution logits predicted for each prompt
+        self.image_sessions: OrderedDict = OrderedDict()
         self.video_predictor = None
+        # Held while the loaded video, its prompts or the video predictor are used, so the background video jobs and
+        # the UI don't replace the video or the prompts under each other
+        self.video_lock = threading.RLock()
         self.video_inference_state = None
         self.video_info = None
+        self.video_id = None
+        self.video_path = None
+        # Registered video prompts, object id -> frame index -> prompt data
+        self.video_prompts: Dict[int, Dict[int, Dict[str, Optional[np.ndarray]]]] = {}
+        # Prompts that are applied to the video inference state, to apply only the changes on the next render
+        self.video_applied_prompts: Dict[int, Dict[int, Dict[str, Optional[np.ndarray]]]] = {}
+        # Number of frames whose image features are kept in the video inference state
+        self.video_feature_cache_size = video_feature_cache_size
+        # Image features of the video frames are computed in the background while the video is prompted, up to the
+        # budget. Disabled if None or 0
+        self.precompute_budget_mb = precompute_budget_mb
+        self.frame_encoder = None
+        # Videos are tracked on every keyframe_stride-th frame if it's over 1, and the masks of the frames between are
+        # interpolated with optical flow. Keyframe gaps over the motion or under the mask IoU thresholds are tracked.
+        self.keyframe_stride = keyframe_stride
+        self.keyframe_max_motion = keyframe_max_motion
+        self.keyframe_min_iou = keyframe_min_iou
+        # (first frame index, last frame index) of the shots of the video, split at hard cuts
+        self.video_shots: List[Tuple[int, int]] = []
+        # Image prediction runs with ONNX Runtime if the backend is "onnx". Automatic segmentation, quantized models
+        # and video tracking can't be exported, so they always run with PyTorch.
+        check_backend(backend)
+        self.backend = backend
+        self.onnx_num_threads = onnx_num_threads
+        self.onnx_enable_cpu_mem_arena = onnx_enable_cpu_mem_arena
+        self.onnx_image_predictor = None
+        self.onnx_model_type = None
+        # Videos whose inference state exceeds the memory budget are tracked in overlapping windows
+        self.video_memory_budget_mb = video_memory_budget_mb
+        self.video_chunked = False
+        # Index of the extracted frames and downscaled images for the frame prompter
+        self.frame_cache = FrameCache()
+        # Videos are tracked on downscaled proxy frames, and the masks are upsampled to the full resolution frames
+        self.proxy_max_size = proxy_max_size
+        self.video_tracking_dir = TEMP_DIR
+        self.video_proxy_scale = 1.0
+        # Masks of the propagation results over the budget are spilled to disk
+        self.segment_ram_budget_mb = segment_ram_budget_mb
+        # Keep the low resolution mask logits of the tracked frames, and upsample and threshold them at render time
+        self.keep_mask_logits = keep_mask_logits
+        # Frame index -> image embedding of the preview frame
+        self.preview_predictor = None
+        self.preview_features: OrderedDict = OrderedDict()
+
+    def apply_profile(self, profile: str):
+        """
+        Apply the named performance profile from './configs/default_hparams.yaml'. The profile sets the model type,
+        precision, proxy resolution and memory budgets of this instance, and overrides the mask hyperparameters,
+        tiling and video encoding settings of the config manager. Settings in fixed_settings keep their values.
+
+        Args:
+            profile (str): The profile name, such as "interactive", "batch-throughput" or "low-memory".
+        """
+        config_manager = get_config_manager()
+        config_manager.set_profile(profile)
+        settings = config_manager.profile_settings
+
+        self.profile = profile
+        self.default_model_type = settings.get("model_type", DEFAULT_MODEL_TYPE)
+        precision = settings.get("precision", "auto")
+        if precision == "auto":
+            self.dtype = torch.float16 if torch.cuda.is_available() else torch.bfloat16
+        elif precision in PRECISIONS:
+            self.dtype = PRECISIONS[precision]
+        else:
+            raise ValueError(f"Unknown precision '{precision}'. Available precisions: auto, {', '.join(PRECISIONS)}")
+
+        kept = []
+        for attr in ["proxy_max_size", "video_memory_budget_mb", "segment_ram_budget_mb", "keep_mask_logits",
+                     "onnx_num_threads", "precompute_budget_mb", "keyframe_stride"]:
+            if attr in self.fixed_settings:
+                kept.append(attr)
+            elif attr in settings:
+                setattr(self, attr, settings[attr])
+        logger.info(f"Applied {profile} profile: {settings}")
+        if kept:
+            logger.info(f"Kept the explicitly set {', '.join(kept)} over the {profile} profile")
+
+    def is_autocast_enabled(self) -> bool:
+        """Whether the video predictor runs with autocast. Quantized layers and fp32 precision run without it."""
+        return self.dtype != torch.float32 and not is_quantized_model_type(self.current_model_type)
 
     def load_model(self,
                    model_type: Optional[str] = None,
                    load_video_predictor: bool = False):
         """
         Load the model from the model directory. If the model is not found, download it from the URL.
+        The checkpoint is converted to a memory-mappable format on the first load, and the weights are mapped from
+        it instead of unpickling the whole checkpoint on every load.
+        Quantized model types ( with "_int8" suffix ) are converted from the fp32 model on the first load and
+        cached in the model directory.
 
         Args:
             model_type (str): The model type to load.
@@ -66,12 +232,21 @@ class SamInference:
         if model_type is None:
             model_type = DEFAULT_MODEL_TYPE
 
-        config_path = MODEL_CONFIGS[model_type]
+        base_model_type = get_base_model_type(model_type)
+        quantize = is_quantized_model_type(model_type)
+        config_path = MODEL_CONFIGS[base_model_type]
 
-        filename, url = AVAILABLE_MODELS[model_type]
+        filename, url = AVAILABLE_MODELS[base_model_type]
         model_path = os.path.join(self.model_dir, filename)
 
-        if not is_sam_exist(model_dir=self.model_dir, model_type=model_type):
+        if quantize and self.device != "cpu":
+            raise RuntimeError(
+                f"Quantized model {model_type} is only supported on CPU")
+
+        if quantize and os.path.exists(get_quantized_model_path(model_type, self.model_dir)):
+            # The weights come from the cached quantized model
+            model_path = None
+        elif not is_sam_exist(model_dir=self.model_dir, model_type=model_type):
             logger.info(
                 f"No SAM2 model found, downloading {model_type} model...")
             download_sam_model_url(
@@ -83,11 +258,17 @@ class SamInference:
                 self.model = None
                 self.video_predictor = build_sam2_video_predictor(
                     config_file=config_path,
-                    ckpt_path=model_path,
-                    device=self.device
+                    ckpt_path=None,
+                    device="cpu"
                 )
+                if model_path is not None:
+                    load_mmap_weights(self.video_predictor, model_path, self.model_dir)
+                self.video_predictor = self.video_predictor.to(self.device)
+                if quantize:
+                    self.video_predictor = load_quantized_model(
+                        self.video_predictor, model_type, self.model_dir)
                 return
-            except Exception as e:
+            except Exception:
                 logger.exception(
                     "Error while loading SAM2 model for video predictor")
 
@@ -95,9 +276,15 @@ class SamInference:
             self.video_predictor = None
             self.model = build_sam2(
                 config_file=config_path,
-                ckpt_path=model_path,
-                device=self.device
+                ckpt_path=None,
+                device="cpu"
             )
+            if model_path is not None:
+                load_mmap_weights(self.model, model_path, self.model_dir)
+            self.model = self.model.to(self.device)
+            if quantize:
+                self.model = load_quantized_model(
+                    self.model, model_type, self.model_dir)
         except Exception as e:
             logger.exception("Error while loading SAM2 model")
             raise RuntimeError(f"Failed to load model") from e
@@ -115,40 +302,184 @@ class SamInference:
         if model_type is None:
             model_type = self.current_model_type
 
+        # Abandon the frame loading and encoding of the previous video before its frames are removed
+        self.stop_frame_encoder()
         if self.video_predictor is None or model_type != self.current_model_type:
             self.current_model_type = model_type
             self.load_model(model_type=model_type, load_video_predictor=True)
 
         self.video_info = get_video_info(vid_input)
+        self.video_id = get_video_id(vid_input)
+        self.video_path = vid_input
         frames_temp_dir = TEMP_DIR
         clean_temp_dir(frames_temp_dir)
-        extract_frames(vid_input, frames_temp_dir)
+        extract_frames(vid_input, frames_temp_dir,
+                       proxy_dir=TEMP_PROXY_DIR if self.proxy_max_size else None,
+                       proxy_max_size=self.proxy_max_size)
+        self.video_tracking_dir, self.video_proxy_scale = frames_temp_dir, 1.0
+        self.frame_cache.build_index(frames_temp_dir)
+        frame_paths = self.frame_cache.frame_paths
+        proxy_paths = get_frames_from_dir(vid_dir=TEMP_PROXY_DIR) if self.proxy_max_size else []
+        if frame_paths and len(proxy_paths) == len(frame_paths):
+            full_width = Image.open(frame_paths[0]).width
+            proxy_width = Image.open(proxy_paths[0]).width
+            if proxy_width < full_width:
+                self.video_tracking_dir, self.video_proxy_scale = TEMP_PROXY_DIR, proxy_width / full_width
+
+        num_frames = len(frame_paths)
+        # Only the keyframes are held in an inference state in the keyframe stride mode
+        num_state_frames = -(-num_frames // max(self.keyframe_stride, 1))
+        self.video_chunked = (self.video_memory_budget_mb is not None and
+                              num_state_frames > self.get_video_window_size(self.video_memory_budget_mb))
+        # Windowed and keyframe tracking take precedence over shots, so the shots are only detected without them
+        self.video_shots = []
+        shot_config = get_config_manager().shot_detection
+        if not self.video_chunked and self.keyframe_stride <= 1 and shot_config.get("threshold", 0):
+            self.video_shots = detect_shots(get_frames_from_dir(vid_dir=self.video_tracking_dir),
+                                            threshold=shot_config["threshold"],
+                                            min_shot_frames=shot_config.get("min_shot_frames", 1))
+
         if self.video_info.has_sound:
             extract_sound(vid_input, frames_temp_dir)
 
         if self.video_inference_state is not None and self.video_predictor is not None:
             self.video_predictor.reset_state(self.video_inference_state)
             self.video_inference_state = None
+        self.clear_video_prompts()
+        self.video_applied_prompts = {}
+        self.preview_features.clear()
 
         if self.video_predictor is None:
             raise RuntimeError("Video predictor failed to load")
 
-        self.video_inference_state = self.video_predictor.init_state(
-            video_path=frames_temp_dir)
+        if self.video_chunked:
+            logger.info(f"Video has {num_frames} frames, tracking in windows to fit the memory budget")
+            return
+        if self.keyframe_stride > 1:
+            logger.info(f"Video has {num_frames} frames, tracking every {self.keyframe_stride}th frame")
+            return
+        if self.uses_shot_tracking():
+            logger.info(f"Video has {len(self.video_shots)} shots, tracking each shot separately")
+            return
+
+        if not self.precompute_budget_mb:
+            self.video_inference_state = VideoInferenceState(
+                self.video_predictor.init_state(video_path=self.video_tracking_dir),
+                max_cached_features=self.video_feature_cache_size
+            )
+            return
+
+        # Only the first frame is loaded before returning, and the other frames are loaded and encoded in the
+        # background while the video is prompted
+        inference_state = self.video_predictor.init_state(video_path=self.video_tracking_dir,
+                                                          async_loading_frames=True)
+        self.frame_encoder = self.start_frame_encoder(inference_state)
+        self.video_inference_state = VideoInferenceState(
+            inference_state,
+            max_cached_features=self.video_feature_cache_size,
+            feature_fallback=self.get_precomputed_features_fn(inference_state)
+        )
+
+    def uses_shot_tracking(self) -> bool:
+        """Whether the shots of the video are tracked separately. Windowed and keyframe tracking take precedence."""
+        return len(self.video_shots) > 1 and not self.video_chunked and self.keyframe_stride <= 1
+
+    @staticmethod
+    def get_shot_carry_params() -> Optional[List[float]]:
+        """Get the max histogram distance of the carried objects in shot tracking. None if objects aren't carried."""
+        shot_config = get_config_manager().shot_detection
+        if not shot_config.get("carry_objects", False):
+            return None
+        return [shot_config.get("max_carry_distance", 0.4)]
+
+    def uses_video_state(self) -> bool:
+        """Whether the video is tracked in self.video_inference_state, instead of windows, keyframes or shots."""
+        return not self.video_chunked and self.keyframe_stride <= 1 and not self.uses_shot_tracking()
+
+    def start_frame_encoder(self,
+                            inference_state: Dict) -> BackgroundFrameEncoder:
+        """
+        Start encoding the frames of the inference state in the background, in the order of the frames.
+
+        Args:
+            inference_state (Dict): The inference state for the video predictor.
+
+        Returns:
+            BackgroundFrameEncoder: The started frame encoder.
+        """
+        video_predictor, device = self.video_predictor, self.device
+        use_autocast = self.is_autocast_enabled()
+
+        def encode_frame(frame_idx: int) -> Dict[str, List[torch.Tensor]]:
+            image = inference_state["images"][frame_idx].to(device).float().unsqueeze(0)
+            with torch.inference_mode(), torch.autocast(device_type=device, dtype=self.dtype, enabled=use_autocast):
+                return video_predictor.forward_image(image)
+
+        frame_encoder = BackgroundFrameEncoder(encode_frame, budget_mb=self.precompute_budget_mb,
+                                               storage_device="cpu")
+        # The first frame is already encoded by init_state()
+        frame_encoder.start(range(1, inference_state["num_frames"]))
+        return frame_encoder
+
+    def get_precomputed_features_fn(self,
+                                    inference_state: Dict) -> Callable[[int], Optional[Tuple]]:
+        """
+        Get the feature fallback of the video inference state, which returns the (image, backbone output) of the frames
+        that are encoded by the frame encoder, and None for the others.
+
+        Args:
+            inference_state (Dict): The inference state for the video predictor.
+
+        Returns:
+            Callable: The feature fallback.
+        """
+        frame_encoder, device = self.frame_encoder, self.device
+
+        def get_precomputed_features(frame_idx: int) -> Optional[Tuple]:
+            backbone_out = frame_encoder.get(frame_idx, device=device)
+            if backbone_out is None:
+                return None
+            image = inference_state["images"][frame_idx].to(device).float().unsqueeze(0)
+            return image, backbone_out
+
+        return get_precomputed_features
+
+    def stop_frame_encoder(self):
+        """Stop the background frame encoder and the background frame loading of the current video."""
+        if self.frame_encoder is not None:
+            self.frame_encoder.stop(wait=True)
+            self.frame_encoder = None
+        images = self.video_inference_state.get("images") if self.video_inference_state is not None else None
+        loader_thread = getattr(images, "thread", None)
+        if loader_thread is not None and loader_thread.is_alive():
+            # SAM2's frame loader stops when its exception is set
+            images.exception = RuntimeError("Video was replaced")
+            loader_thread.join()
+
+    def pause_frame_encoder(self):
+        """Context manager that pauses the background frame encoder while the foreground work runs."""
+        if self.frame_encoder is None:
+            return nullcontext()
+        return self.frame_encoder.paused()
 
     def generate_mask(self,
                       image: np.ndarray,
                       model_type: str,
                       invert_mask: bool = False,
+                      tiled: Optional[bool] = None,
                       **params) -> List[Dict[str, Any]]:
         """
         Generate masks with Automatic segmentation. Default hyperparameters are in './configs/default_hparams.yaml.'
+        Large images are segmented in overlapping tiles with the "tiled_segmentation" settings, so small parts
+        aren't lost to the downscale to the model resolution.
 
         Args:
             image (np.ndarray): The input image.
             model_type (str): The model type to load.
             invert_mask (bool): Invert the mask output - used for background masking.
-            **params: The hyperparameters for the mask generator.
+            tiled (bool): Segment the image in tiles. Decide by the image size and "min_megapixels" if None.
+            **params: The hyperparameters for the mask generator. "points_per_batch" of 0 is calibrated from the
+                available memory for the model type and the image size, and cached per host.
 
         Returns:
             List[Dict[str, Any]]: The auto-generated mask data.
@@ -161,12 +492,45 @@ class SamInference:
         if self.model is None:
             raise RuntimeError("Model failed to load")
 
+        tiling_config = get_config_manager().tiled_segmentation
+        if tiled is None:
+            min_megapixels = tiling_config.get("min_megapixels", 0)
+            tiled = bool(min_megapixels) and image.shape[0] * image.shape[1] > min_megapixels * 1e6
+        tile_size = tiling_config.get("tile_size", DEFAULT_TILE_SIZE)
+        max_workers = tiling_config.get("max_workers", 1)
+
+        if params.get("points_per_batch", 0) <= 0:
+            crop_size = image.shape[:2]
+            if tiled:
+                crop_size = (min(tile_size, crop_size[0]), min(tile_size, crop_size[1]))
+            points_per_batch = get_points_per_batch(
+                model=self.model,
+                model_type=model_type,
+                crop_size=crop_size,
+                device=self.device
+            )
+            # Tiles in parallel workers share the memory
+            if tiled:
+                points_per_batch = max(MIN_POINTS_PER_BATCH, points_per_batch // max(1, max_workers))
+            params["points_per_batch"] = points_per_batch
+
         self.mask_generator = SAM2AutomaticMaskGenerator(
             model=self.model,
             **params
         )
         try:
-            generated_masks = self.mask_generator.generate(image)
+            if tiled:
+                # Each worker needs its own generator because the image predictor keeps the image features
+                generated_masks = generate_tiled_masks(
+                    image=image,
+                    create_generator=lambda: SAM2AutomaticMaskGenerator(model=self.model, **params),
+                    tile_size=tile_size,
+                    overlap=tiling_config.get("tile_overlap", DEFAULT_TILE_OVERLAP),
+                    max_workers=max_workers,
+                    iou_thresh=tiling_config.get("merge_iou_thresh", DEFAULT_MERGE_IOU_THRESH)
+                )
+            else:
+                generated_masks = self.mask_generator.generate(image)
         except Exception as e:
             logger.exception(f"Error while auto generating masks : {e}")
             raise RuntimeError(f"Failed to generate masks") from e
@@ -184,9 +548,15 @@ class SamInference:
                       point_coords: Optional[np.ndarray] = None,
                       point_labels: Optional[np.ndarray] = None,
                       invert_mask: bool = False,
+                      mask_input: Optional[np.ndarray] = None,
+                      refine: bool = True,
                       **params) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         """
-        Predict image with prompt data.
+        Predict image with prompt data. The image embedding is kept until another image is predicted, so prompting
+        the same image again only runs the prompt decoder.
+        The prompt history of the image is kept with the low resolution logits of each prediction. When the prompt
+        extends an earlier prompt of the image, e.g. with one more point, the logits of the best mask of that prompt
+        are fed back as mask_input, so the click refines the previous mask instead of starting from scratch.
 
         Args:
             image (np.ndarray): The input image.
@@ -195,6 +565,9 @@ class SamInference:
             point_coords (np.ndarray): The point coordinates prompt data.
             point_labels (np.ndarray): The point labels prompt data.
             invert_mask (bool): Invert the mask output - used for background masking.
+            mask_input (np.ndarray): The low resolution mask logits in 1xHxW format from a previous prediction. Use
+                the logits from the prompt history if None and refine is True.
+            refine (bool): Whether to refine the mask of the prompt history that the prompt extends.
             **params: The hyperparameters for the mask generator.
 
         Returns:
@@ -202,21 +575,42 @@ class SamInference:
             np.ndarray: Array of scores for each mask.
             np.ndarray: Array of logits in CxHxW format.
         """
-        if self.model is None or self.current_model_type != model_type:
-            self.current_model_type = model_type
-            self.load_model(model_type=model_type)
-
-        if self.model is None:
-            raise RuntimeError("Model failed to load")
-
-        self.image_predictor = SAM2ImagePredictor(sam_model=self.model)
-        self.image_predictor.set_image(image)
+        if self.backend == ONNX_BACKEND and not is_quantized_model_type(model_type):
+            predictor = self.get_onnx_image_predictor(model_type)
+        else:
+            if self.model is None or self.current_model_type != model_type:
+                self.current_model_type = model_type
+                self.load_model(model_type=model_type)
+
+            if self.model is None:
+                raise RuntimeError("Model failed to load")
+
+            predictor = self.image_predictor
+            if not isinstance(predictor, SAM2ImagePredictor) or predictor.model is not self.model:
+                predictor = SAM2ImagePredictor(sam_model=self.model)
+        if predictor is not self.image_predictor:
+            self.image_predictor = predictor
+            self.image_predictor_key = None
+
+        image_key = self.get_image_key(image)
+        if image_key != self.image_predictor_key:
+            self.image_predictor.set_image(image)
+            self.image_predictor_key = image_key
+
+        prompt = {"points": point_coords, "labels": point_labels, "box": box}
+        history = self.image_sessions.setdefault(image_key, [])
+        self.image_sessions.move_to_end(image_key)
+        if len(self.image_sessions) > IMAGE_SESSION_CACHE_SIZE:
+            self.image_sessions.popitem(last=False)
+        if mask_input is None and refine:
+            mask_input = self.get_refinement_logits(history, prompt)
 
         try:
             masks, scores, logits = self.image_predictor.predict(
                 box=box,
                 point_coords=point_coords,
                 point_labels=point_labels,
+                mask_input=mask_input,
                 multimask_output=params["multimask_output"],
             )
         except Exception as e:
@@ -224,6 +618,11 @@ class SamInference:
                 f"Error while predicting image with prompt: {str(e)}")
             raise RuntimeError(f"Failed to predict image with prompt") from e
 
+        # Batched box predictions can't be refined with a single mask input
+        if logits.ndim == 3:
+            history.append({"prompt": prompt, "logits": logits[np.argmax(scores)][None]})
+            del history[:-PROMPT_HISTORY_SIZE]
+
         if invert_mask:
             formatted_masks = self.format_to_auto_result(masks)
             inverted_masks = [{'segmentation': invert_masks(mask['segmentation']),
@@ -232,6 +631,102 @@ class SamInference:
 
         return masks, scores, logits
 
+    @staticmethod
+    def get_image_key(image: np.ndarray) -> str:
+        """Get the key of the image content, to detect the same image between predictions."""
+        image = np.ascontiguousarray(image)
+        digest = hashlib.sha1(str((image.shape, image.dtype.str)).encode())
+        digest.update(image.data)
+        return digest.hexdigest()
+
+    @staticmethod
+    def extends_prompt(base: Dict[str, Optional[np.ndarray]],
+                       prompt: Dict[str, Optional[np.ndarray]]) -> bool:
+        """
+        Whether the prompt is the base prompt with more points added, and the same box.
+
+        Args:
+            base (Dict): The earlier prompt with "points", "labels" and "box" keys.
+            prompt (Dict): The new prompt with "points", "labels" and "box" keys.
+
+        Returns:
+            bool: True if the prompt strictly extends the base prompt.
+        """
+        def equal(a: Optional[np.ndarray], b: Optional[np.ndarray]) -> bool:
+            if a is None or b is None:
+                return a is None and b is None
+            return np.array_equal(np.asarray(a), np.asarray(b))
+
+        if not equal(base["box"], prompt["box"]) or prompt["points"] is None:
+            return False
+        if base["points"] is None:
+            return True
+        num_points = len(base["points"])
+        return (len(prompt["points"]) > num_points and
+                equal(prompt["points"][:num_points], base["points"]) and
+                equal(prompt["labels"][:num_points], base["labels"]))
+
+    def get_refinement_logits(self,
+                              history: List[Dict[str, Any]],
+                              prompt: Dict[str, Optional[np.ndarray]]) -> Optional[np.ndarray]:
+        """
+        Get the logits of the longest prompt in the history that the prompt extends. Removing the last click goes
+        back to the logits of the prompt before it, as the history keeps every prompt.
+
+        Args:
+            history (List[Dict]): The prompt history of the image with "prompt" and "logits" entries.
+            prompt (Dict): The new prompt with "points", "labels" and "box" keys.
+
+        Returns:
+            np.ndarray: The low resolution logits in 1xHxW format. None if the prompt doesn't extend any prompt.
+        """
+        best = None
+        for entry in history:
+            if not self.extends_prompt(entry["prompt"], prompt):
+                continue
+            num_points = len(entry["prompt"]["points"]) if entry["prompt"]["points"] is not None else 0
+            if best is None or num_points >= best[0]:
+                best = (num_points, entry["logits"])
+        return best[1] if best is not None else None
+
+    def get_onnx_image_predictor(self,
+                                 model_type: str) -> OnnxImagePredictor:
+        """
+        Get the ONNX Runtime image predictor for the model type. The model is exported into the model directory
+        if it's not exported yet.
+
+        Args:
+            model_type (str): The model type to load.
+
+        Returns:
+            OnnxImagePredictor: The image predictor that runs with ONNX Runtime.
+        """
+        if self.onnx_image_predictor is not None and self.onnx_model_type == model_type:
+            return self.onnx_image_predictor
+
+        if not is_onnx_model_exist(model_type=model_type, model_dir=self.model_dir):
+            if self.model is None or self.current_model_type != model_type:
+                self.current_model_type = model_type
+                self.load_model(model_type=model_type)
+
+            if self.model is None:
+                raise RuntimeError("Model failed to load")
+
+            try:
+                export_onnx_models(self.model, model_type, self.model_dir)
+            except Exception as e:
+                logger.exception("Error while exporting SAM2 model to ONNX")
+                raise RuntimeError(f"Failed to export model to ONNX") from e
+
+        self.onnx_image_predictor = OnnxImagePredictor(
+            model_type=model_type,
+            model_dir=self.model_dir,
+            num_threads=self.onnx_num_threads,
+            enable_cpu_mem_arena=self.onnx_enable_cpu_mem_arena
+        )
+        self.onnx_model_type = model_type
+        return self.onnx_image_predictor
+
     def add_prediction_to_frame(self,
                                 frame_idx: int,
                                 obj_id: int,
@@ -282,19 +777,160 @@ class SamInference:
 
         return out_frame_idx, out_obj_ids, out_mask_logits
 
+    def set_video_prompt(self,
+                         frame_idx: int,
+                         obj_id: int,
+                         points: Optional[np.ndarray] = None,
+                         labels: Optional[np.ndarray] = None,
+                         box: Optional[np.ndarray] = None):
+        """
+        Register the prompt of the object on the frame. Registered prompts of all objects are added to the inference
+        state together, so they are tracked in a single propagation pass.
+
+        Args:
+            frame_idx (int): The frame index of the video.
+            obj_id (int): The object id of the prompt.
+            points (np.ndarray): The point coordinates prompt data.
+            labels (np.ndarray): The point labels prompt data.
+            box (np.ndarray): The box prompt data.
+        """
+        if box is not None and len(box) > 1:
+            logger.warning(
+                f"Only one box is supported per object in a frame, using the first box for object {obj_id}")
+            box = box[:1]
+
+        self.video_prompts.setdefault(obj_id, {})[frame_idx] = {
+            "points": points,
+            "labels": labels,
+            "box": box
+        }
+
+    def clear_video_prompts(self,
+                            obj_id: Optional[int] = None):
+        """
+        Clear the registered video prompts.
+
+        Args:
+            obj_id (int): The object id to clear. Clear all objects if None.
+        """
+        if obj_id is None:
+            self.video_prompts.clear()
+        else:
+            self.video_prompts.pop(obj_id, None)
+
+    def register_prompt_data(self,
+                             image_prompt_input_data: Dict,
+                             frame_idx: int,
+                             obj_id: int = 0):
+        """
+        Register the prompt of the frame prompter for the object. The prompt coordinates of the downscaled frame are
+        mapped back to the full resolution frame.
+
+        Args:
+            image_prompt_input_data (Dict): The image prompt data with "image" and "points" keys.
+            frame_idx (int): The frame index of the video.
+            obj_id (int): The object id of the prompt.
+        """
+        prompt = image_prompt_input_data["points"]
+        if not prompt:
+            return
+        point_labels, point_coords, box = self.handle_prompt_data(prompt)
+        self.set_video_prompt(frame_idx=frame_idx, obj_id=int(obj_id),
+                              points=self.frame_cache.to_full_resolution(point_coords), labels=point_labels,
+                              box=self.frame_cache.to_full_resolution(box))
+
+    def apply_video_prompts_to_state(self,
+                                     inference_state: Optional[Dict] = None):
+        """
+        Apply the changes of the registered video prompts since the last call to the inference state, instead of
+        resetting the state and adding every prompt again. Removed objects are removed from the state, changed and
+        removed prompts are cleared from their frames, and only new or changed prompts are predicted.
+        The tracking results of the previous propagation are cleared, so the prompts are added to untracked frames
+        and the propagation gives the same masks as a state with all prompts added from scratch. The outputs of the
+        unchanged prompts and the cached frame features are kept.
+
+        Args:
+            inference_state (Dict): The inference state for the video predictor. Use self.video_inference_state if None.
+        """
+        if inference_state is None:
+            inference_state = self.video_inference_state
+
+        removed_objects, cleared_prompts, added_prompts = diff_video_prompts(self.video_applied_prompts,
+                                                                             self.video_prompts)
+        try:
+            for obj_id in removed_objects:
+                self.video_predictor.remove_object(inference_state, obj_id, need_output=False)
+            for obj_id, frame_idx in cleared_prompts:
+                self.video_predictor.clear_all_prompts_in_frame(inference_state, frame_idx, obj_id,
+                                                                need_output=False)
+            self.clear_tracking_results(inference_state)
+
+            for obj_id, frame_idx in added_prompts:
+                prompt = self.get_tracking_prompt(self.video_prompts[obj_id][frame_idx])
+                self.add_prediction_to_frame(
+                    frame_idx=frame_idx,
+                    obj_id=obj_id,
+                    inference_state=inference_state,
+                    points=prompt["points"],
+                    labels=prompt["labels"],
+                    box=prompt["box"]
+                )
+        except Exception:
+            # Start from a clean state on the next render
+            self.video_predictor.reset_state(inference_state)
+            self.video_applied_prompts = {}
+            raise
+
+        self.video_applied_prompts = {obj_id: dict(frame_prompts)
+                                      for obj_id, frame_prompts in self.video_prompts.items()}
+
+    @staticmethod
+    def clear_tracking_results(inference_state: Dict):
+        """
+        Clear the propagated masks of the inference state, and keep the prompts and their outputs.
+
+        Args:
+            inference_state (Dict): The inference state for the video predictor.
+        """
+        for obj_idx, obj_output_dict in inference_state["output_dict_per_obj"].items():
+            obj_output_dict["non_cond_frame_outputs"].clear()
+            inference_state["temp_output_dict_per_obj"][obj_idx]["non_cond_frame_outputs"].clear()
+            inference_state["frames_tracked_per_obj"][obj_idx].clear()
+
     def propagate_in_video(self,
-                           inference_state: Optional[Dict] = None,) -> Dict:
+                           inference_state: Optional[Dict] = None,
+                           start_frame_idx: Optional[int] = None,
+                           frame_range: Optional[Tuple[int, int]] = None,
+                           max_frames: Optional[int] = None,
+                           mask_threshold: float = 0.0,
+                           cancel_event: Optional[threading.Event] = None,
+                           mask_checkpoint: Optional[MaskCheckpoint] = None) -> SegmentStore:
         """
-        Propagate in the video with the tracked predictions for each frame. Currently only supports
-        single frame tracking.
+        Propagate in the video with the tracked predictions for each frame. All objects in the inference state are
+        tracked together in a single pass. Tracking starts from the earliest prompted frame and runs forward and in
+        reverse, only over the given frame window.
+        With a mask checkpoint, every tracked frame is saved to it, and the frames it already has from an interrupted
+        render are not tracked again. Each pass resumes from its last saved frame before the first missing frame,
+        with the saved masks added as mask prompts of that frame while the pass runs.
 
         Args:
             inference_state (Dict): The inference state for the video predictor. Use self.video_inference_state if None.
+            start_frame_idx (int): The frame index to start tracking from. Use the earliest prompted frame if None.
+            frame_range (Tuple[int, int]): The first and the last frame index (inclusive) to track. Track the whole
+                video if None.
+            max_frames (int): The maximum number of frames to track in each direction from the start frame.
+            mask_threshold (float): The logit threshold of the masks. Unused if self.keep_mask_logits is True.
+            cancel_event (threading.Event): Tracking stops with JobCancelledError when the event is set.
+            mask_checkpoint (MaskCheckpoint): The checkpoint that the tracked masks are saved to and resumed from.
 
         Returns:
-            Dict: The video segments with the image and mask data. It has frame index as each key and each key has
-                "image" and "mask" data. "image" key contains the path of the original image file and "mask" key contains
-                the np.ndarray mask output.
+            SegmentStore: The video segments with the image and mask data, which is used like a dict. It has frame
+                index as each key and each key has "image", "mask" and "obj_ids" data. "image" key contains the
+                original image loaded on access, "mask" key contains the np.ndarray mask output in Nx1xHxW format
+                with a mask for each object and "obj_ids" key contains the object ids in the same order. Only the
+                tracked frames are included, and masks over self.segment_ram_budget_mb are spilled to disk.
+                If self.keep_mask_logits is True, "logits" key contains the float16 low resolution mask logits of
+                the model instead of "mask", to be converted with get_frame_masks() when the frame is rendered.
         """
         if inference_state is None and self.video_inference_state is None:
             logger.exception(
@@ -309,39 +945,1195 @@ class SamInference:
         if inference_state is None:
             inference_state = self.video_inference_state
 
-        video_segments = {}
+        prompted_frames = set()
+        for inputs_per_obj in [inference_state["point_inputs_per_obj"], inference_state["mask_inputs_per_obj"]]:
+            for frame_inputs in inputs_per_obj.values():
+                prompted_frames.update(frame_inputs.keys())
+
+        propagation_ranges = self.get_propagation_ranges(
+            prompted_frames=sorted(prompted_frames),
+            num_frames=inference_state["num_frames"],
+            start_frame_idx=start_frame_idx,
+            frame_range=frame_range,
+            max_frames=max_frames
+        )
 
+        seeded_prompts = []
         try:
-            generator = self.video_predictor.propagate_in_video(
-                inference_state=inference_state,
-                start_frame_idx=0
-            )
-            images = get_frames_from_dir(vid_dir=TEMP_DIR, as_numpy=True)
-
-            with torch.autocast(device_type=self.device, dtype=self.dtype):
-                for out_frame_idx, out_obj_ids, out_mask_logits in generator:
-                    mask = (out_mask_logits[0] > 0.0).cpu().numpy()
-                    video_segments[out_frame_idx] = {
-                        "image": images[out_frame_idx],
-                        "mask": mask
-                    }
+            frame_paths = get_frames_from_dir(vid_dir=TEMP_DIR)
+            tracking_paths = get_frames_from_dir(vid_dir=self.video_tracking_dir)
+            video_segments = SegmentStore(frame_paths, ram_budget_mb=self.segment_ram_budget_mb,
+                                          keep_logits=self.keep_mask_logits)
+            saved_frames = set()
+            if mask_checkpoint is not None:
+                for saved_frame_idx, masks, obj_ids in mask_checkpoint.load():
+                    # Masks saved with the other mask format can't be used
+                    if np.issubdtype(masks.dtype, np.floating) == self.keep_mask_logits:
+                        video_segments.add(frame_idx=saved_frame_idx, masks=masks, obj_ids=obj_ids)
+                        saved_frames.add(saved_frame_idx)
+                if saved_frames:
+                    logger.info(f"Resuming tracking with {len(saved_frames)} frames from the mask checkpoint")
+
+            with torch.autocast(device_type=self.device, dtype=self.dtype, enabled=self.is_autocast_enabled()):
+                for pass_start_idx, pass_num_frames, reverse in propagation_ranges:
+                    resumed_range = self.get_resumed_range(pass_start_idx, pass_num_frames, reverse,
+                                                           tracked_frames=saved_frames)
+                    if resumed_range is None:
+                        continue
+                    start_idx, max_frame_num_to_track = resumed_range
+                    # A pass that resumes after its start frame is seeded with the saved masks of the frame
+                    if start_idx != pass_start_idx:
+                        seeded_prompts = self.add_tracked_masks_to_frame(
+                            inference_state=inference_state,
+                            frame_idx=start_idx,
+                            masks=video_segments[start_idx][video_segments.mask_key],
+                            obj_ids=video_segments[start_idx]["obj_ids"],
+                            mask_threshold=mask_threshold
+                        )
+
+                    generator = self.video_predictor.propagate_in_video(
+                        inference_state=inference_state,
+                        start_frame_idx=start_idx,
+                        max_frame_num_to_track=max_frame_num_to_track,
+                        reverse=reverse
+                    )
+                    for out_frame_idx, out_obj_ids, out_mask_logits in generator:
+                        self.check_cancelled(cancel_event)
+                        if out_frame_idx in video_segments:
+                            continue
+                        if self.keep_mask_logits:
+                            masks = self.get_low_res_logits(inference_state, out_frame_idx)
+                        else:
+                            # The full resolution frame is only needed to refine masks tracked on proxy frames
+                            image = None
+                            if self.video_proxy_scale < 1.0:
+                                image = np.array(Image.open(frame_paths[out_frame_idx]))
+                            masks = self.get_frame_masks(out_mask_logits, image, tracking_paths[out_frame_idx],
+                                                         mask_threshold=mask_threshold)
+                        video_segments.add(
+                            frame_idx=out_frame_idx,
+                            masks=masks,
+                            obj_ids=list(out_obj_ids)
+                        )
+                        if mask_checkpoint is not None:
+                            mask_checkpoint.add(out_frame_idx, masks, list(out_obj_ids))
+                    self.remove_mask_prompts(inference_state, seeded_prompts)
+        except JobCancelledError:
+            video_segments.close()
+            raise
         except Exception as e:
             logger.exception(f"Error while propagating in video: {str(e)}")
             raise RuntimeError(f"Failed to propagate in video") from e
+        finally:
+            # The saved masks only seed the resumed pass, they're not prompts of the inference state
+            self.remove_mask_prompts(inference_state, seeded_prompts)
 
         return video_segments
 
+    @staticmethod
+    def get_resumed_range(start_frame_idx: int,
+                          max_frame_num_to_track: int,
+                          reverse: bool,
+                          tracked_frames: Container[int]) -> Optional[Tuple[int, int]]:
+        """
+        Get the part of a propagation pass that is left to track when some of its frames are already tracked. It
+        starts from the last tracked frame before the first untracked frame, whose masks seed the pass, and ends at
+        the last untracked frame.
+
+        Args:
+            start_frame_idx (int): The start frame index of the pass.
+            max_frame_num_to_track (int): The max number of frames to track in the pass.
+            reverse (bool): Whether the pass tracks in reverse.
+            tracked_frames (Container[int]): The frame indexes that are already tracked.
+
+        Returns:
+            Tuple[int, int]: The start frame index and the max number of frames to track. None if every frame of the
+                pass is tracked.
+        """
+        step = -1 if reverse else 1
+        pass_frames = [start_frame_idx + step * offset for offset in range(max_frame_num_to_track + 1)]
+        untracked = [pos for pos, frame_idx in enumerate(pass_frames) if frame_idx not in tracked_frames]
+        if not untracked:
+            return None
+        seed_pos = max(untracked[0] - 1, 0)
+        return pass_frames[seed_pos], untracked[-1] - seed_pos
+
+    def add_tracked_masks_to_frame(self,
+                                   inference_state: Dict,
+                                   frame_idx: int,
+                                   masks: np.ndarray,
+                                   obj_ids: List[int],
+                                   mask_threshold: float = 0.0) -> List[Tuple[int, int]]:
+        """
+        Add the tracked masks of a frame as mask prompts, so propagation resumes from the frame. Objects that are
+        prompted on the frame keep their prompts.
+
+        Args:
+            inference_state (Dict): The inference state for the video predictor.
+            frame_idx (int): The frame index of the masks.
+            masks (np.ndarray): The masks in Nx1xHxW format, or the low resolution mask logits.
+            obj_ids (List[int]): The object ids of the masks.
+            mask_threshold (float): The logit threshold of the mask logits.
+
+        Returns:
+            List[Tuple[int, int]]: The (frame index, object id) of the added mask prompts.
+        """
+        added_prompts = []
+        for obj_id, obj_masks in zip(obj_ids, masks):
+            obj_idx = inference_state["obj_id_to_idx"].get(obj_id)
+            if (obj_idx is None or frame_idx in inference_state["point_inputs_per_obj"][obj_idx] or
+                    frame_idx in inference_state["mask_inputs_per_obj"][obj_idx]):
+                continue
+            mask = obj_masks[0] > mask_threshold if np.issubdtype(obj_masks.dtype, np.floating) else obj_masks[0]
+            self.video_predictor.add_new_mask(
+                inference_state=inference_state,
+                frame_idx=frame_idx,
+                obj_id=obj_id,
+                mask=np.array(mask, dtype=bool)
+            )
+            added_prompts.append((frame_idx, obj_id))
+        return added_prompts
+
+    def remove_mask_prompts(self,
+                            inference_state: Dict,
+                            prompts: List[Tuple[int, int]]):
+        """
+        Remove the mask prompts from add_tracked_masks_to_frame(). The list is emptied, so removing them again does
+        nothing.
+
+        Args:
+            inference_state (Dict): The inference state for the video predictor.
+            prompts (List[Tuple[int, int]]): The (frame index, object id) of the mask prompts.
+        """
+        while prompts:
+            frame_idx, obj_id = prompts.pop()
+            self.video_predictor.clear_all_prompts_in_frame(inference_state, frame_idx, obj_id, need_output=False)
+
+    @staticmethod
+    def get_propagation_ranges(
+        prompted_frames: List[int],
+        num_frames: int,
+        start_frame_idx: Optional[int] = None,
+        frame_range: Optional[Tuple[int, int]] = None,
+        max_frames: Optional[int] = None
+    ) -> List[Tuple[int, int, bool]]:
+        """
+        Get the propagation passes to track the frame window from the start frame.
+
+        Args:
+            prompted_frames (List[int]): The frame indexes that have prompts.
+            num_frames (int): The number of frames in the video.
+            start_frame_idx (int): The frame index to start tracking from. Use the earliest prompted frame if None.
+            frame_range (Tuple[int, int]): The first and the last frame index (inclusive) to track.
+            max_frames (int): The maximum number of frames to track in each direction from the start frame.
+
+        Returns:
+            List[Tuple[int, int, bool]]: List of (start frame index, max number of frames to track, reverse) passes.
+        """
+        first_frame_idx, last_frame_idx = 0, num_frames - 1
+        if frame_range is not None:
+            first_frame_idx = max(first_frame_idx, int(frame_range[0]))
+            last_frame_idx = min(last_frame_idx, int(frame_range[1]))
+
+        if start_frame_idx is None:
+            in_range = [idx for idx in prompted_frames if first_frame_idx <= idx <= last_frame_idx]
+            start_frame_idx = in_range[0] if in_range else first_frame_idx
+        start_frame_idx = min(max(start_frame_idx, first_frame_idx), last_frame_idx)
+
+        forward_frames = last_frame_idx - start_frame_idx
+        reverse_frames = start_frame_idx - first_frame_idx
+        if max_frames is not None:
+            forward_frames = min(forward_frames, max_frames)
+            reverse_frames = min(reverse_frames, max_frames)
+
+        ranges = [(start_frame_idx, forward_frames, False)]
+        if reverse_frames > 0:
+            ranges.append((start_frame_idx, reverse_frames, True))
+        return ranges
+
+    def get_num_tracked_frames(self,
+                               frame_range: Optional[Tuple[int, int]] = None,
+                               max_frames: Optional[int] = None) -> int:
+        """
+        Get the number of frames that tracking the registered video prompts yields, to report the render progress.
+
+        Args:
+            frame_range (Tuple[int, int]): The first and the last frame index (inclusive) to track.
+            max_frames (int): The maximum number of frames to track in each direction from the start frame.
+
+        Returns:
+            int: The number of tracked frames.
+        """
+        prompted_frames = sorted({frame_idx for frame_prompts in self.video_prompts.values()
+                                  for frame_idx in frame_prompts})
+        propagation_ranges = self.get_propagation_ranges(
+            prompted_frames=prompted_frames,
+            num_frames=len(self.frame_cache),
+            frame_range=frame_range,
+            max_frames=max_frames
+        )
+        # The start frame is yielded by both passes
+        return 1 + sum(num_frames for _, num_frames, _ in propagation_ranges)
+
+    @staticmethod
+    def check_cancelled(cancel_event: Optional[threading.Event]):
+        """Raise JobCancelledError if the cancel event is set."""
+        if cancel_event is not None and cancel_event.is_set():
+            raise JobCancelledError("The video render was cancelled")
+
+    def get_tracking_prompt(self,
+                            prompt: Dict[str, Optional[np.ndarray]]) -> Dict[str, Optional[np.ndarray]]:
+        """
+        Scale the registered prompt from the full resolution frame to the frames that the video is tracked on.
+
+        Args:
+            prompt (Dict): The prompt data with "points", "labels" and "box" keys in full resolution coordinates.
+
+        Returns:
+            Dict: The prompt data in the tracking frame coordinates.
+        """
+        scale = self.video_proxy_scale
+        return {
+            "points": prompt["points"] * scale if prompt["points"] is not None else None,
+            "labels": prompt["labels"],
+            "box": prompt["box"] * scale if prompt["box"] is not None else None
+        }
+
+    def get_frame_masks(self,
+                        mask_logits: Union[torch.Tensor, np.ndarray],
+                        image: Optional[np.ndarray],
+                        tracking_frame_path: str,
+                        mask_threshold: float = 0.0) -> np.ndarray:
+        """
+        Get the full resolution masks of the frame from the tracked mask logits. If the video is tracked on proxy
+        frames, the logits are upsampled with edge-aware refinement guided by the full resolution frame.
+
+        Args:
+            mask_logits (Union[torch.Tensor, np.ndarray]): The mask logits output of the video predictor in Nx1xHxW
+                format, or the low resolution mask logits from get_low_res_logits().
+            image (np.ndarray): The full resolution frame. Only needed if the logits are not at the full resolution.
+            tracking_frame_path (str): The path of the frame that the video is tracked on.
+            mask_threshold (float): The logit threshold of the masks.
+
+        Returns:
+            np.ndarray: The masks in Nx1xHxW format at the full resolution.
+        """
+        if image is None or mask_logits.shape[-2:] == image.shape[:2]:
+            masks = mask_logits > mask_threshold
+            return masks.cpu().numpy() if isinstance(masks, torch.Tensor) else masks
+
+        if isinstance(mask_logits, torch.Tensor):
+            mask_logits = mask_logits.float().cpu().numpy()
+        mask_logits = mask_logits[:, 0].astype(np.float32)
+        height, width = image.shape[:2]
+
+        if self.video_proxy_scale >= 1.0:
+            masks = [cv2.resize(logits, (width, height), interpolation=cv2.INTER_LINEAR) > mask_threshold
+                     for logits in mask_logits]
+            return np.array(masks, dtype=bool).reshape(-1, 1, height, width)
+
+        proxy_image = np.array(Image.open(tracking_frame_path).convert("RGB"))
+        proxy_h, proxy_w = proxy_image.shape[:2]
+        if mask_logits.shape[-2:] != (proxy_h, proxy_w):
+            # Low resolution logits are resized to the tracking frame first, same as the video predictor outputs
+            mask_logits = np.array([cv2.resize(logits, (proxy_w, proxy_h), interpolation=cv2.INTER_LINEAR)
+                                    for logits in mask_logits]).reshape(-1, proxy_h, proxy_w)
+        masks = upsample_mask_logits(
+            mask_logits=mask_logits,
+            guide_image=image[..., :3],
+            proxy_image=proxy_image,
+            threshold=mask_threshold
+        )
+        return masks[:, None]
+
+    @staticmethod
+    def get_low_res_logits(inference_state: Dict, frame_idx: int) -> np.ndarray:
+        """
+        Get the low resolution mask logits of the tracked frame from the inference state, without upsampling them to
+        the video resolution.
+
+        Args:
+            inference_state (Dict): The inference state that the frame is tracked in.
+            frame_idx (int): The frame index in the inference state.
+
+        Returns:
+            np.ndarray: The float16 mask logits in Nx1xhxw format, in the order of the object ids.
+        """
+        mask_logits = []
+        for obj_idx in range(len(inference_state["obj_ids"])):
+            obj_output_dict = inference_state["output_dict_per_obj"][obj_idx]
+            output = obj_output_dict["cond_frame_outputs"].get(frame_idx)
+            if output is None:
+                output = obj_output_dict["non_cond_frame_outputs"][frame_idx]
+            mask_logits.append(output["pred_masks"])
+        return torch.cat(mask_logits, dim=0).to(torch.float16).cpu().numpy()
+
+    def get_video_window_size(self,
+                              memory_budget_mb: int,
+                              num_objects: int = 1) -> int:
+        """
+        Estimate the number of frames in a window whose inference state fits in the memory budget. The state holds
+        the resized frame images and the memory features and masks of each tracked object for every frame.
+
+        Args:
+            memory_budget_mb (int): The memory budget for the inference state in MB.
+            num_objects (int): The number of tracked objects.
+
+        Returns:
+            int: The number of frames in a window. It's always larger than the window overlap.
+        """
+        image_size = self.video_predictor.image_size if self.video_predictor is not None else 1024
+        frame_bytes = 3 * image_size ** 2 * 4
+        object_frame_bytes = 64 * (image_size // 16) ** 2 * 4 + (image_size // 4) ** 2 * 4
+        per_frame_bytes = frame_bytes + max(num_objects, 1) * object_frame_bytes
+
+        window_size = int(memory_budget_mb * 1024 ** 2 // per_frame_bytes)
+        if window_size <= VIDEO_WINDOW_OVERLAP:
+            logger.warning(f"Memory budget of {memory_budget_mb}MB is too small, "
+                           f"using {VIDEO_WINDOW_OVERLAP + 1} frames per window")
+            window_size = VIDEO_WINDOW_OVERLAP + 1
+        return window_size
+
+    @staticmethod
+    def get_video_windows(
+        first_frame_idx: int,
+        last_frame_idx: int,
+        window_size: int,
+        overlap: int = VIDEO_WINDOW_OVERLAP,
+        reverse: bool = False
+    ) -> List[Tuple[int, int]]:
+        """
+        Split the frame span into overlapping windows in tracking order.
+
+        Args:
+            first_frame_idx (int): The first frame index of the span.
+            last_frame_idx (int): The last frame index (inclusive) of the span.
+            window_size (int): The number of frames in a window.
+            overlap (int): The number of frames shared by consecutive windows.
+            reverse (bool): Split from the last frame towards the first frame.
+
+        Returns:
+            List[Tuple[int, int]]: List of (first frame index, last frame index) of each window, both inclusive.
+        """
+        stride = max(window_size - overlap, 1)
+        windows = []
+        if not reverse:
+            start = first_frame_idx
+            while True:
+                end = min(start + window_size - 1, last_frame_idx)
+                windows.append((start, end))
+                if end >= last_frame_idx:
+                    break
+                start += stride
+        else:
+            end = last_frame_idx
+            while True:
+                start = max(end - window_size + 1, first_frame_idx)
+                windows.append((start, end))
+                if start <= first_frame_idx:
+                    break
+                end -= stride
+        return windows
+
+    def init_window_state(self,
+                          frame_paths: List[str],
+                          window_dir: str = VIDEO_WINDOW_DIR) -> Dict:
+        """
+        Initialize an inference state that only holds the given frames. The frames are linked into a temporary
+        directory, so the local frame index is the position in frame_paths.
+
+        Args:
+            frame_paths (List[str]): The frame paths of the window.
+            window_dir (str): The temporary directory of the frame links.
+
+        Returns:
+            Dict: The inference state for the window.
+        """
+        shutil.rmtree(window_dir, ignore_errors=True)
+        os.makedirs(window_dir, exist_ok=True)
+        for local_idx, frame_path in enumerate(frame_paths):
+            link_path = os.path.join(window_dir, f"{local_idx:05d}.jpg")
+            try:
+                os.symlink(os.path.abspath(frame_path), link_path)
+            except OSError:
+                # Symlinks may be unavailable, e.g. on Windows without privileges
+                shutil.copyfile(frame_path, link_path)
+
+        return self.video_predictor.init_state(video_path=window_dir)
+
+    def release_window_state(self,
+                             inference_state: Dict,
+                             window_dir: str = VIDEO_WINDOW_DIR):
+        """Release the frames and the features of the window inference state."""
+        self.video_predictor.reset_state(inference_state)
+        inference_state.clear()
+        shutil.rmtree(window_dir, ignore_errors=True)
+        gc.collect()
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
+
+    def propagate_in_video_chunked(self,
+                                   frame_range: Optional[Tuple[int, int]] = None,
+                                   max_frames: Optional[int] = None,
+                                   window_size: Optional[int] = None,
+                                   mask_threshold: float = 0.0,
+                                   cancel_event: Optional[threading.Event] = None):
+        """
+        Propagate the registered video prompts in overlapping windows, for videos that are too long to hold in a
+        single inference state. Only one window is loaded at a time, so the memory usage doesn't depend on the
+        video length. The masks of the frames shared with the next window are added to it as conditioning masks, to
+        carry the objects across window boundaries.
+        Tracking runs forward from the earliest prompted frame, and then in reverse for the frames before it.
+
+        Args:
+            frame_range (Tuple[int, int]): The first and the last frame index (inclusive) to track. Track the whole
+                video if None.
+            max_frames (int): The maximum number of frames to track in each direction from the start frame.
+            window_size (int): The number of frames in a window. Estimate it from self.video_memory_budget_mb if None.
+            mask_threshold (float): The logit threshold of the masks. Unused if self.keep_mask_logits is True.
+            cancel_event (threading.Event): Tracking stops with JobCancelledError when the event is set.
+
+        Yields:
+            int: The frame index.
+            Dict: The frame segment with "image", "mask" (or "logits") and "obj_ids" keys, same as
+                propagate_in_video().
+        """
+        if self.video_predictor is None:
+            logger.exception(
+                "Error while propagating in video, video predictor is None")
+            raise RuntimeError("Video predictor not initialized")
+
+        frame_paths = get_frames_from_dir(vid_dir=TEMP_DIR)
+        tracking_paths = get_frames_from_dir(vid_dir=self.video_tracking_dir)
+        prompted_frames = sorted({frame_idx for frame_prompts in self.video_prompts.values()
+                                  for frame_idx in frame_prompts})
+        propagation_ranges = self.get_propagation_ranges(
+            prompted_frames=prompted_frames,
+            num_frames=len(frame_paths),
+            frame_range=frame_range,
+            max_frames=max_frames
+        )
+
+        if window_size is None:
+            memory_budget_mb = self.video_memory_budget_mb if self.video_memory_budget_mb is not None else 2048
+            window_size = self.get_video_window_size(memory_budget_mb, num_objects=len(self.video_prompts))
+
+        yielded_frames = set()
+        start_frame_masks = {}
+        use_autocast = self.is_autocast_enabled()
+
+        for start_frame_idx, num_frames_to_track, reverse in propagation_ranges:
+            if reverse:
+                windows = self.get_video_windows(start_frame_idx - num_frames_to_track, start_frame_idx,
+                                                 window_size, reverse=True)
+            else:
+                windows = self.get_video_windows(start_frame_idx, start_frame_idx + num_frames_to_track,
+                                                 window_size)
+
+            # Frame index -> object id -> mask, for the frames shared with the next window. The reverse pass starts
+            # with the masks of the start frame from the forward pass, to also carry objects prompted later.
+            carried_masks = {start_frame_idx: start_frame_masks} if reverse and start_frame_masks else {}
+            for window_idx, (window_start, window_end) in enumerate(windows):
+                if window_idx + 1 < len(windows):
+                    next_start, next_end = windows[window_idx + 1]
+                    overlap_frames = set(range(max(window_start, next_start), min(window_end, next_end) + 1))
+                else:
+                    overlap_frames = set()
+
+                inference_state = self.init_window_state(tracking_paths[window_start:window_end + 1])
+                try:
+                    with torch.autocast(device_type=self.device, dtype=self.dtype, enabled=use_autocast):
+                        for obj_id, frame_prompts in self.video_prompts.items():
+                            for frame_idx, prompt in frame_prompts.items():
+                                if window_start <= frame_idx <= window_end:
+                                    prompt = self.get_tracking_prompt(prompt)
+                                    self.add_prediction_to_frame(
+                                        frame_idx=frame_idx - window_start,
+                                        obj_id=obj_id,
+                                        inference_state=inference_state,
+                                        points=prompt["points"],
+                                        labels=prompt["labels"],
+                                        box=prompt["box"]
+                                    )
+
+                        for frame_idx, obj_masks in carried_masks.items():
+                            for obj_id, mask in obj_masks.items():
+                                if frame_idx in self.video_prompts.get(obj_id, {}):
+                                    continue
+                                self.video_predictor.add_new_mask(
+                                    inference_state=inference_state,
+                                    frame_idx=frame_idx - window_start,
+                                    obj_id=obj_id,
+                                    mask=mask
+                                )
+                        carried_masks = {}
+
+                        if not inference_state["obj_ids"]:
+                            continue
+
+                        generator = self.video_predictor.propagate_in_video(
+                            inference_state=inference_state,
+                            start_frame_idx=window_end - window_start if reverse else 0,
+                            max_frame_num_to_track=window_end - window_start,
+                            reverse=reverse
+                        )
+                        for out_frame_idx, out_obj_ids, out_mask_logits in generator:
+                            self.check_cancelled(cancel_event)
+                            frame_idx = out_frame_idx + window_start
+                            # Masks carried to the next window stay at the tracking resolution
+                            masks = (out_mask_logits > 0.0).cpu().numpy()
+                            if frame_idx == start_frame_idx and not reverse:
+                                start_frame_masks = {obj_id: masks[i, 0] for i, obj_id in enumerate(out_obj_ids)}
+                            if frame_idx in overlap_frames:
+                                carried_masks[frame_idx] = {
+                                    obj_id: masks[i, 0] for i, obj_id in enumerate(out_obj_ids)
+                                }
+                            if frame_idx in yielded_frames:
+                                continue
+                            yielded_frames.add(frame_idx)
+
+                            image = np.array(Image.open(frame_paths[frame_idx]))
+                            if self.keep_mask_logits:
+                                yield frame_idx, {
+                                    "image": image,
+                                    "logits": self.get_low_res_logits(inference_state, out_frame_idx),
+                                    "obj_ids": list(out_obj_ids)
+                                }
+                                continue
+                            yield frame_idx, {
+                                "image": image,
+                                "mask": self.get_frame_masks(out_mask_logits, image, tracking_paths[frame_idx],
+                                                             mask_threshold=mask_threshold),
+                                "obj_ids": list(out_obj_ids)
+                            }
+                except JobCancelledError:
+                    raise
+                except Exception as e:
+                    logger.exception(f"Error while propagating in video window: {str(e)}")
+                    raise RuntimeError(f"Failed to propagate in video") from e
+                finally:
+                    self.release_window_state(inference_state)
+
+    def propagate_in_video_strided(self,
+                                   frame_range: Optional[Tuple[int, int]] = None,
+                                   max_frames: Optional[int] = None,
+                                   stride: Optional[int] = None,
+                                   mask_threshold: float = 0.0,
+                                   cancel_event: Optional[threading.Event] = None):
+        """
+        Propagate the registered video prompts on every stride-th frame, and interpolate the masks of the frames
+        between the keyframes by warping the mask logits of both keyframes with dense optical flow. The keyframes are
+        linked into their own inference state, so the tracker only runs on the keyframes and the prompted frames.
+        The stride adapts to the video: keyframe gaps where the objects move more than self.keyframe_max_motion, or
+        where the flow doesn't explain the mask change to self.keyframe_min_iou, are tracked on every frame instead.
+
+        Args:
+            frame_range (Tuple[int, int]): The first and the last frame index (inclusive) to track. Track the whole
+                video if None.
+            max_frames (int): The maximum number of frames to track in each direction from the start frame.
+            stride (int): The number of frames between keyframes. Use self.keyframe_stride if None.
+            mask_threshold (float): The logit threshold of the masks. Unused if self.keep_mask_logits is True.
+            cancel_event (threading.Event): Tracking stops with JobCancelledError when the event is set.
+
+        Yields:
+            int: The frame index.
+            Dict: The frame segment with "image", "mask" (or "logits") and "obj_ids" keys, same as
+                propagate_in_video().
+        """
+        if self.video_predictor is None:
+            logger.exception(
+                "Error while propagating in video, video predictor is None")
+            raise RuntimeError("Video predictor not initialized")
+
+        if stride is None:
+            stride = self.keyframe_stride
+        frame_paths = get_frames_from_dir(vid_dir=TEMP_DIR)
+        tracking_paths = get_frames_from_dir(vid_dir=self.video_tracking_dir)
+        prompted_frames = sorted({frame_idx for frame_prompts in self.video_prompts.values()
+                                  for frame_idx in frame_prompts})
+        propagation_ranges = self.get_propagation_ranges(
+            prompted_frames=prompted_frames,
+            num_frames=len(frame_paths),
+            frame_range=frame_range,
+            max_frames=max_frames
+        )
+        start_frame_idx, num_forward_frames, _ = propagation_ranges[0]
+        num_reverse_frames = propagation_ranges[1][1] if len(propagation_ranges) > 1 else 0
+        keyframes = get_keyframes(
+            first_frame_idx=start_frame_idx - num_reverse_frames,
+            last_frame_idx=start_frame_idx + num_forward_frames,
+            start_frame_idx=start_frame_idx,
+            stride=stride,
+            required_frames=prompted_frames
+        )
+        local_indexes = {frame_idx: local_idx for local_idx, frame_idx in enumerate(keyframes)}
+        yielded_frames = set()
+
+        inference_state = self.init_window_state([tracking_paths[frame_idx] for frame_idx in keyframes],
+                                                 window_dir=VIDEO_KEYFRAME_DIR)
+        try:
+            with torch.autocast(device_type=self.device, dtype=self.dtype, enabled=self.is_autocast_enabled()):
+                for obj_id, frame_prompts in self.video_prompts.items():
+                    for frame_idx, prompt in frame_prompts.items():
+                        if frame_idx in local_indexes:
+                            prompt = self.get_tracking_prompt(prompt)
+                            self.add_prediction_to_frame(
+                                frame_idx=local_indexes[frame_idx],
+                                obj_id=obj_id,
+                                inference_state=inference_state,
+                                points=prompt["points"],
+                                labels=prompt["labels"],
+                                box=prompt["box"]
+                            )
+                if not inference_state["obj_ids"]:
+                    return
+
+                for start_idx, num_frames_to_track, reverse in propagation_ranges:
+                    end_idx = start_idx - num_frames_to_track if reverse else start_idx + num_frames_to_track
+                    generator = self.video_predictor.propagate_in_video(
+                        inference_state=inference_state,
+                        start_frame_idx=local_indexes[start_idx],
+                        max_frame_num_to_track=abs(local_indexes[end_idx] - local_indexes[start_idx]),
+                        reverse=reverse
+                    )
+                    previous_keyframe = None
+                    for out_local_idx, out_obj_ids, out_mask_logits in generator:
+                        self.check_cancelled(cancel_event)
+                        frame_idx = keyframes[out_local_idx]
+                        keyframe = {
+                            "frame_idx": frame_idx,
+                            "obj_ids": list(out_obj_ids),
+                            # Masks at the tracking resolution, to check the gap and to condition the gap tracking
+                            "masks": (out_mask_logits > 0.0).cpu().numpy(),
+                            "logits": (self.get_low_res_logits(inference_state, out_local_idx)
+                                       if self.keep_mask_logits else out_mask_logits.float().cpu().numpy()),
+                            "flow_frame": load_flow_frame(tracking_paths[frame_idx]),
+                        }
+                        if previous_keyframe is not None:
+                            yield from self.fill_keyframe_gap(previous_keyframe, keyframe, frame_paths,
+                                                              tracking_paths, yielded_frames,
+                                                              mask_threshold=mask_threshold,
+                                                              cancel_event=cancel_event)
+                        if frame_idx not in yielded_frames:
+                            yielded_frames.add(frame_idx)
+                            yield frame_idx, self.get_interpolated_segment(
+                                frame_paths[frame_idx], tracking_paths[frame_idx], keyframe["logits"],
+                                keyframe["obj_ids"], mask_threshold
+                            )
+                        previous_keyframe = keyframe
+        except JobCancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"Error while propagating in video keyframes: {str(e)}")
+            raise RuntimeError(f"Failed to propagate in video") from e
+        finally:
+            self.release_window_state(inference_state, window_dir=VIDEO_KEYFRAME_DIR)
+
+    def fill_keyframe_gap(self,
+                          keyframe_a: Dict,
+                          keyframe_b: Dict,
+                          frame_paths: List[str],
+                          tracking_paths: List[str],
+                          yielded_frames: Set[int],
+                          mask_threshold: float = 0.0,
+                          cancel_event: Optional[threading.Event] = None):
+        """
+        Get the masks of the frames between two consecutive keyframes, in tracking order. The mask logits are
+        interpolated with optical flow, or the frames are tracked from the masks of the keyframes if the objects
+        move too far or change too much between them.
+
+        Args:
+            keyframe_a (Dict): The keyframe where the gap starts in tracking order.
+            keyframe_b (Dict): The keyframe where the gap ends in tracking order.
+            frame_paths (List[str]): The full resolution frame paths of the video.
+            tracking_paths (List[str]): The frame paths that the video is tracked on.
+            yielded_frames (Set[int]): The frame indexes that are already yielded. The yielded frames are added to it.
+            mask_threshold (float): The logit threshold of the masks. Unused if self.keep_mask_logits is True.
+            cancel_event (threading.Event): Tracking stops with JobCancelledError when the event is set.
+
+        Yields:
+            int: The frame index.
+            Dict: The frame segment, same as propagate_in_video_strided().
+        """
+        frame_a, frame_b = keyframe_a["frame_idx"], keyframe_b["frame_idx"]
+        step = 1 if frame_b > frame_a else -1
+        gap_frames = [frame_idx for frame_idx in range(frame_a + step, frame_b, step)
+                      if frame_idx not in yielded_frames]
+        if not gap_frames:
+            return
+
+        flow_b_to_a = compute_flow(keyframe_b["flow_frame"], keyframe_a["flow_frame"])
+        if needs_full_tracking(keyframe_a["masks"], keyframe_b["masks"], flow_b_to_a,
+                               max_motion=self.keyframe_max_motion, min_iou=self.keyframe_min_iou):
+            logger.debug(f"Tracking frames {frame_a} to {frame_b}, the masks change too much to interpolate")
+            yield from self.track_keyframe_gap(keyframe_a, keyframe_b, frame_paths, tracking_paths, yielded_frames,
+                                               mask_threshold=mask_threshold, cancel_event=cancel_event)
+            return
+
+        for frame_idx in gap_frames:
+            self.check_cancelled(cancel_event)
+            flow_frame = load_flow_frame(tracking_paths[frame_idx])
+            logits = interpolate_logits(
+                logits_a=keyframe_a["logits"],
+                logits_b=keyframe_b["logits"],
+                flow_to_a=compute_flow(flow_frame, keyframe_a["flow_frame"]),
+                flow_to_b=compute_flow(flow_frame, keyframe_b["flow_frame"]),
+                weight=(frame_idx - frame_a) / (frame_b - frame_a)
+            )
+            yielded_frames.add(frame_idx)
+            yield frame_idx, self.get_interpolated_segment(frame_paths[frame_idx], tracking_paths[frame_idx], logits,
+                                                           keyframe_a["obj_ids"], mask_threshold)
+
+    def track_keyframe_gap(self,
+                           keyframe_a: Dict,
+                           keyframe_b: Dict,
+                           frame_paths: List[str],
+                           tracking_paths: List[str],
+                           yielded_frames: Set[int],
+                           mask_threshold: float = 0.0,
+                           cancel_event: Optional[threading.Event] = None):
+        """
+        Track the frames between two consecutive keyframes in a window, with the masks of both keyframes added as
+        conditioning masks.
+
+        Args:
+            Same as fill_keyframe_gap()
+
+        Yields:
+            int: The frame index.
+            Dict: The frame segment, same as propagate_in_video_strided().
+        """
+        frame_a, frame_b = keyframe_a["frame_idx"], keyframe_b["frame_idx"]
+        window_start = min(frame_a, frame_b)
+        inference_state = self.init_window_state(tracking_paths[window_start:max(frame_a, frame_b) + 1])
+        try:
+            for keyframe in [keyframe_a, keyframe_b]:
+                for obj_idx, obj_id in enumerate(keyframe["obj_ids"]):
+                    self.video_predictor.add_new_mask(
+                        inference_state=inference_state,
+                        frame_idx=keyframe["frame_idx"] - window_start,
+                        obj_id=obj_id,
+                        mask=keyframe["masks"][obj_idx, 0]
+                    )
+            generator = self.video_predictor.propagate_in_video(
+                inference_state=inference_state,
+                start_frame_idx=frame_a - window_start,
+                max_frame_num_to_track=abs(frame_b - frame_a),
+                reverse=frame_b < frame_a
+            )
+            for out_frame_idx, out_obj_ids, out_mask_logits in generator:
+                self.check_cancelled(cancel_event)
+                frame_idx = out_frame_idx + window_start
+                if frame_idx in (frame_a, frame_b) or frame_idx in yielded_frames:
+                    continue
+                logits = (self.get_low_res_logits(inference_state, out_frame_idx)
+                          if self.keep_mask_logits else out_mask_logits.float().cpu().numpy())
+                yielded_frames.add(frame_idx)
+                yield frame_idx, self.get_interpolated_segment(frame_paths[frame_idx], tracking_paths[frame_idx],
+                                                               logits, list(out_obj_ids), mask_threshold)
+        finally:
+            self.release_window_state(inference_state)
+
+    def get_interpolated_segment(self,
+                                 frame_path: str,
+                                 tracking_path: str,
+                                 logits: np.ndarray,
+                                 obj_ids: List[int],
+                                 mask_threshold: float = 0.0) -> Dict:
+        """
+        Get the frame segment of the keyframe stride mode from the mask logits of the frame.
+
+        Args:
+            frame_path (str): The full resolution frame path.
+            tracking_path (str): The path of the frame that the video is tracked on.
+            logits (np.ndarray): The mask logits in Nx1xHxW format, at the tracking resolution or the low resolution
+                of the model if self.keep_mask_logits is True.
+            obj_ids (List[int]): The object ids in the order of the logits.
+            mask_threshold (float): The logit threshold of the masks. Unused if self.keep_mask_logits is True.
+
+        Returns:
+            Dict: The frame segment with "image", "mask" (or "logits") and "obj_ids" keys.
+        """
+        image = np.array(Image.open(frame_path))
+        if self.keep_mask_logits:
+            return {"image": image, "logits": logits.astype(np.float16), "obj_ids": obj_ids}
+        return {
+            "image": image,
+            "mask": self.get_frame_masks(logits, image, tracking_path, mask_threshold=mask_threshold),
+            "obj_ids": obj_ids
+        }
+
+    def get_shot_tracks(self,
+                        frame_range: Optional[Tuple[int, int]] = None,
+                        max_frames: Optional[int] = None,
+                        carry_objects: bool = False) -> List[Dict[str, Any]]:
+        """
+        Get the tracking of each shot within the tracked span of the video. The span is the same as a single
+        propagation pass, so the rendered frames are the same. An object is only tracked in the shots that have its
+        prompts, because a prompt of another shot doesn't point at the object after a cut. Shots without prompts
+        have no objects.
+        With carry_objects, the other objects are carried to the shot with their latest prompt before the shot, or
+        the earliest one after it, to be found again on the first frame of the shot by track_shot().
+
+        Args:
+            frame_range (Tuple[int, int]): The first and the last frame index (inclusive) to track.
+            max_frames (int): The maximum number of frames to track in each direction from the start frame.
+            carry_objects (bool): Whether the objects that aren't prompted in a shot are carried to it.
+
+        Returns:
+            List[Dict]: The shot tracks with "first" and "last" frame indexes, the first and the last frame index of
+                the "window" state that holds the prompted frames, "prompts" by object id and frame index, the
+                "carried" objects by object id with the "frame_idx" and the "prompt" that they're carried from, and
+                the "ranges" of the propagation passes.
+        """
+        num_frames = len(self.frame_cache)
+        prompted_frames = sorted({frame_idx for frame_prompts in self.video_prompts.values()
+                                  for frame_idx in frame_prompts})
+        propagation_ranges = self.get_propagation_ranges(
+            prompted_frames=prompted_frames,
+            num_frames=num_frames,
+            frame_range=frame_range,
+            max_frames=max_frames
+        )
+        start_frame_idx, num_forward_frames, _ = propagation_ranges[0]
+        num_reverse_frames = propagation_ranges[1][1] if len(propagation_ranges) > 1 else 0
+        span_first, span_last = start_frame_idx - num_reverse_frames, start_frame_idx + num_forward_frames
+
+        shot_tracks = []
+        for shot_first, shot_last in self.video_shots:
+            first, last = max(shot_first, span_first), min(shot_last, span_last)
+            if first > last:
+                continue
+            prompts, carried = {}, {}
+            for obj_id, frame_prompts in self.video_prompts.items():
+                shot_prompts = {frame_idx: prompt for frame_idx, prompt in frame_prompts.items()
+                                if shot_first <= frame_idx <= shot_last}
+                if shot_prompts:
+                    prompts[obj_id] = shot_prompts
+                elif carry_objects and frame_prompts:
+                    # The latest prompt before the shot, or the earliest one after it
+                    nearest_frame_idx = min(frame_prompts, key=lambda idx: (idx > first, abs(idx - first)))
+                    carried[obj_id] = {"frame_idx": nearest_frame_idx, "prompt": frame_prompts[nearest_frame_idx]}
+            shot_prompted_frames = [frame_idx for shot_prompts in prompts.values() for frame_idx in shot_prompts]
+            if carried:
+                shot_prompted_frames.append(first)
+            shot_tracks.append({
+                "first": first,
+                "last": last,
+                # Prompts of the shot outside the tracked span are added to the window state as well
+                "window": (min([first] + shot_prompted_frames), max([last] + shot_prompted_frames)),
+                "prompts": prompts,
+                "carried": carried,
+                "ranges": self.get_propagation_ranges(
+                    prompted_frames=sorted(set(shot_prompted_frames)),
+                    num_frames=num_frames,
+                    frame_range=(first, last)
+                )
+            })
+        return shot_tracks
+
+    def propagate_in_video_shots(self,
+                                 frame_range: Optional[Tuple[int, int]] = None,
+                                 max_frames: Optional[int] = None,
+                                 mask_threshold: float = 0.0,
+                                 cancel_event: Optional[threading.Event] = None,
+                                 max_workers: Optional[int] = None):
+        """
+        Propagate the registered video prompts in each shot of the video separately, so tracking doesn't run across
+        hard cuts. The shots are tracked in parallel workers, each with its own window inference state on the shared
+        model, and the frames are yielded as they are tracked, so they are not in order.
+
+        Args:
+            frame_range (Tuple[int, int]): The first and the last frame index (inclusive) to track. Track the whole
+                video if None.
+            max_frames (int): The maximum number of frames to track in each direction from the start frame.
+            mask_threshold (float): The logit threshold of the masks. Unused if self.keep_mask_logits is True.
+            cancel_event (threading.Event): Tracking stops with JobCancelledError when the event is set.
+            max_workers (int): The number of shots tracked in parallel. Use the "shot_detection" config if None.
+
+        Yields:
+            int: The frame index.
+            Dict: The frame segment with "image", "mask" (or "logits") and "obj_ids" keys, same as
+                propagate_in_video().
+        """
+        if self.video_predictor is None:
+            logger.exception(
+                "Error while propagating in video, video predictor is None")
+            raise RuntimeError("Video predictor not initialized")
+
+        shot_config = get_config_manager().shot_detection
+        if max_workers is None:
+            max_workers = shot_config.get("max_workers", 1)
+        shot_tracks = self.get_shot_tracks(frame_range=frame_range, max_frames=max_frames,
+                                           carry_objects=shot_config.get("carry_objects", False))
+        self.add_carried_object_histograms(shot_tracks)
+        max_workers = max(1, min(int(max_workers), len(shot_tracks)))
+        results = queue.Queue(maxsize=SHOT_QUEUE_SIZE * max_workers)
+        stop_event = threading.Event()
+
+        def track(shot_idx: int):
+            generator = self.track_shot(shot_idx, shot_tracks[shot_idx], mask_threshold=mask_threshold)
+            try:
+                for item in generator:
+                    while not stop_event.is_set():
+                        try:
+                            results.put(item, timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+                    if stop_event.is_set():
+                        return
+            finally:
+                generator.close()
+
+        logger.info(f"Tracking {len(shot_tracks)} shots with {max_workers} workers")
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="video_shot")
+        futures = [executor.submit(track, shot_idx) for shot_idx in range(len(shot_tracks))]
+        try:
+            while True:
+                self.check_cancelled(cancel_event)
+                try:
+                    yield results.get(timeout=0.1)
+                    continue
+                except queue.Empty:
+                    pass
+                for future in futures:
+                    if future.done() and future.exception() is not None:
+                        raise RuntimeError(f"Failed to propagate in video") from future.exception()
+                # Workers put their frames before they finish, so nothing is left once all are done
+                if all(future.done() for future in futures) and results.empty():
+                    break
+        finally:
+            stop_event.set()
+            executor.shutdown(wait=True)
+            shutil.rmtree(VIDEO_SHOTS_DIR, ignore_errors=True)
+
+    def add_carried_object_histograms(self,
+                                      shot_tracks: List[Dict[str, Any]]):
+        """
+        Add the "histogram" of each carried object of the shot tracks, from the mask of the object at the prompt that
+        it's carried from. The prompted frames are segmented in their own window inference state.
+
+        Args:
+            shot_tracks (List[Dict]): The shot tracks from get_shot_tracks().
+        """
+        sources = sorted({(carried["frame_idx"], obj_id) for shot_track in shot_tracks
+                          for obj_id, carried in shot_track["carried"].items()})
+        if not sources:
+            return
+
+        tracking_paths = get_frames_from_dir(vid_dir=self.video_tracking_dir)
+        source_frames = sorted({frame_idx for frame_idx, _ in sources})
+        window_dir = os.path.join(VIDEO_SHOTS_DIR, "carried")
+        histograms = {}
+        inference_state = self.init_window_state([tracking_paths[frame_idx] for frame_idx in source_frames],
+                                                 window_dir=window_dir)
+        try:
+            with torch.autocast(device_type=self.device, dtype=self.dtype, enabled=self.is_autocast_enabled()):
+                for frame_idx, obj_id in sources:
+                    prompt = self.get_tracking_prompt(self.video_prompts[obj_id][frame_idx])
+                    _, out_obj_ids, out_mask_logits = self.add_prediction_to_frame(
+                        frame_idx=source_frames.index(frame_idx),
+                        obj_id=obj_id,
+                        inference_state=inference_state,
+                        points=prompt["points"],
+                        labels=prompt["labels"],
+                        box=prompt["box"]
+                    )
+                    mask = (out_mask_logits[list(out_obj_ids).index(obj_id), 0] > 0.0).cpu().numpy()
+                    histograms[(frame_idx, obj_id)] = get_region_histogram(tracking_paths[frame_idx], mask)
+        finally:
+            self.release_window_state(inference_state, window_dir=window_dir)
+
+        for shot_track in shot_tracks:
+            for obj_id, carried in shot_track["carried"].items():
+                carried["histogram"] = histograms[(carried["frame_idx"], obj_id)]
+
+    def get_empty_shot_segments(self,
+                                shot_track: Dict[str, Any]):
+        """
+        Get the frame segments of a shot without objects, so the rendered span stays contiguous.
+
+        Args:
+            shot_track (Dict): The shot track from get_shot_tracks().
+
+        Yields:
+            int: The frame index.
+            Dict: The frame segment, same as propagate_in_video_shots().
+        """
+        frame_paths = get_frames_from_dir(vid_dir=TEMP_DIR)
+        mask_key, dtype = ("logits", np.float16) if self.keep_mask_logits else ("mask", bool)
+        for frame_idx in range(shot_track["first"], shot_track["last"] + 1):
+            image = np.array(Image.open(frame_paths[frame_idx]))
+            yield frame_idx, {
+                "image": image,
+                mask_key: np.zeros((0, 1, *image.shape[:2]), dtype=dtype),
+                "obj_ids": []
+            }
+
+    def track_shot(self,
+                   shot_idx: int,
+                   shot_track: Dict[str, Any],
+                   mask_threshold: float = 0.0):
+        """
+        Track the prompts of the shot in a window inference state of the shot frames. The frames of a shot without
+        objects are yielded without masks, so the rendered span stays contiguous.
+        A carried object is prompted on the first frame of the shot with the prompt it's carried from, and only
+        tracked if the histogram of its mask there is within the "max_carry_distance" of the "shot_detection" config
+        from the histogram of the object at its prompt.
+
+        Args:
+            shot_idx (int): The index of the shot track, for its window directory.
+            shot_track (Dict): The shot track from get_shot_tracks().
+            mask_threshold (float): The logit threshold of the masks. Unused if self.keep_mask_logits is True.
+
+        Yields:
+            int: The frame index.
+            Dict: The frame segment, same as propagate_in_video_shots().
+        """
+        frame_paths = get_frames_from_dir(vid_dir=TEMP_DIR)
+        tracking_paths = get_frames_from_dir(vid_dir=self.video_tracking_dir)
+        window_start, window_end = shot_track["window"]
+        window_dir = os.path.join(VIDEO_SHOTS_DIR, f"{shot_idx:05d}")
+        yielded_frames = set()
+
+        if not shot_track["prompts"] and not shot_track["carried"]:
+            yield from self.get_empty_shot_segments(shot_track)
+            return
+
+        inference_state = self.init_window_state(tracking_paths[window_start:window_end + 1], window_dir=window_dir)
+        try:
+            # Autocast is thread local, so it's enabled in each worker
+            with torch.autocast(device_type=self.device, dtype=self.dtype, enabled=self.is_autocast_enabled()):
+                for obj_id, frame_prompts in shot_track["prompts"].items():
+                    for frame_idx, prompt in frame_prompts.items():
+                        prompt = self.get_tracking_prompt(prompt)
+                        self.add_prediction_to_frame(
+                            frame_idx=frame_idx - window_start,
+                            obj_id=obj_id,
+                            inference_state=inference_state,
+                            points=prompt["points"],
+                            labels=prompt["labels"],
+                            box=prompt["box"]
+                        )
+                self.add_carried_objects(inference_state, shot_track, tracking_paths)
+                if not inference_state["obj_ids"]:
+                    yield from self.get_empty_shot_segments(shot_track)
+                    return
+
+                for start_idx, num_frames_to_track, reverse in shot_track["ranges"]:
+                    generator = self.video_predictor.propagate_in_video(
+                        inference_state=inference_state,
+                        start_frame_idx=start_idx - window_start,
+                        max_frame_num_to_track=num_frames_to_track,
+                        reverse=reverse
+                    )
+                    for out_frame_idx, out_obj_ids, out_mask_logits in generator:
+                        frame_idx = out_frame_idx + window_start
+                        if frame_idx in yielded_frames:
+                            continue
+                        yielded_frames.add(frame_idx)
+
+                        image = np.array(Image.open(frame_paths[frame_idx]))
+                        if self.keep_mask_logits:
+                            yield frame_idx, {
+                                "image": image,
+                                "logits": self.get_low_res_logits(inference_state, out_frame_idx),
+                                "obj_ids": list(out_obj_ids)
+                            }
+                            continue
+                        yield frame_idx, {
+                            "image": image,
+                            "mask": self.get_frame_masks(out_mask_logits, image, tracking_paths[frame_idx],
+                                                         mask_threshold=mask_threshold),
+                            "obj_ids": list(out_obj_ids)
+                        }
+        except Exception as e:
+            logger.exception(f"Error while propagating in video shot: {str(e)}")
+            raise
+        finally:
+            self.release_window_state(inference_state, window_dir=window_dir)
+
+    def add_carried_objects(self,
+                            inference_state: Dict,
+                            shot_track: Dict[str, Any],
+                            tracking_paths: List[str]):
+        """
+        Find the carried objects of the shot on its first frame, and remove the ones that don't look like the object
+        at the prompt they're carried from.
+
+        Args:
+            inference_state (Dict): The window inference state of the shot.
+            shot_track (Dict): The shot track from get_shot_tracks(), with the histograms of the carried objects.
+            tracking_paths (List[str]): The frame paths that the video is tracked on.
+        """
+        max_distance = get_config_manager().shot_detection.get("max_carry_distance", 0.4)
+        first = shot_track["first"]
+        for obj_id, carried in shot_track["carried"].items():
+            prompt = self.get_tracking_prompt(carried["prompt"])
+            _, out_obj_ids, out_mask_logits = self.add_prediction_to_frame(
+                frame_idx=first - shot_track["window"][0],
+                obj_id=obj_id,
+                inference_state=inference_state,
+                points=prompt["points"],
+                labels=prompt["labels"],
+                box=prompt["box"]
+            )
+            mask = (out_mask_logits[list(out_obj_ids).index(obj_id), 0] > 0.0).cpu().numpy()
+            distance = 1.0
+            if mask.any():
+                distance = cv2.compareHist(carried["histogram"], get_region_histogram(tracking_paths[first], mask),
+                                           cv2.HISTCMP_BHATTACHARYYA)
+            if distance > max_distance:
+                logger.info(f"Object {obj_id} is not found again in the shot at frame {first}")
+                self.video_predictor.remove_object(inference_state, obj_id, need_output=False)
+
+    def set_preview_frame(self,
+                          image: np.ndarray,
+                          frame_idx: int) -> SAM2ImagePredictor:
+        """
+        Set the preview frame to the image predictor on the video model. The frame embedding is cached per frame
+        index, so prompting the same frame again only runs the prompt decoder.
+
+        Args:
+            image (np.ndarray): The frame image at the preview resolution.
+            frame_idx (int): The frame index of the video.
+
+        Returns:
+            SAM2ImagePredictor: The image predictor with the frame set.
+        """
+        if self.preview_predictor is None or self.preview_predictor.model is not self.video_predictor:
+            self.preview_predictor = SAM2ImagePredictor(sam_model=self.video_predictor)
+            self.preview_features.clear()
+
+        predictor = self.preview_predictor
+        if frame_idx in self.preview_features:
+            self.preview_features.move_to_end(frame_idx)
+            predictor.reset_predictor()
+            predictor._features, predictor._orig_hw = self.preview_features[frame_idx]
+            predictor._is_image_set = True
+            return predictor
+
+        predictor.set_image(image)
+        self.preview_features[frame_idx] = (predictor._features, predictor._orig_hw)
+        if len(self.preview_features) > PREVIEW_CACHE_SIZE:
+            self.preview_features.popitem(last=False)
+        return predictor
+
     def add_filter_to_preview(self,
                               image_prompt_input_data: Dict,
                               filter_mode: str,
                               frame_idx: int,
                               pixel_size: Optional[int] = None,
                               color_hex: Optional[str] = None,
-                              invert_mask: bool = False
+                              invert_mask: bool = False,
+                              obj_id: int = 0
                               ):
         """
         Add filter to the preview image with the prompt data. Specially made for gradio app.
-        It adds prediction tracking to the self.video_inference_state and returns the filtered image.
+        It registers the prompt for the object and predicts the frame with the image predictor path on the video
+        model, so the video inference state is left untouched. The frame embedding is cached per frame index and
+        the filter is rendered at the preview resolution.
 
         Args:
             image_prompt_input_data (Dict): The image prompt data.
@@ -350,11 +2142,12 @@ class SamInference:
             pixel_size (int): The pixel size for the pixelize filter.
             color_hex (str): The color hex code for the solid color filter.
             invert_mask (bool): Invert the mask output - used for background masking.
+            obj_id (int): The object id of the prompt.
 
         Returns:
             np.ndarray: The filtered image output.
         """
-        if self.video_predictor is None or self.video_inference_state is None:
+        if self.video_predictor is None or (self.video_inference_state is None and self.uses_video_state()):
             logger.exception(
                 "Error while adding filter to preview, load video predictor first")
             raise RuntimeError("Error while adding filter to preview")
@@ -370,26 +2163,48 @@ class SamInference:
             logger.error(error_message)
             raise gr.Error(error_message, duration=20)
 
-        image = np.array(image.convert("RGB"))
+        image = image.convert("RGB")
+        preview_scale = min(1.0, PREVIEW_MAX_SIZE / max(image.size))
+        if preview_scale < 1.0:
+            image = image.resize((round(image.width * preview_scale), round(image.height * preview_scale)),
+                                 Image.BILINEAR)
+        image = np.array(image)
 
         point_labels, point_coords, box = self.handle_prompt_data(prompt)
-        obj_id = frame_idx
-
-        self.video_predictor.reset_state(self.video_inference_state)
-        idx, scores, logits = self.add_prediction_to_frame(
-            frame_idx=frame_idx,
-            obj_id=obj_id,
-            inference_state=self.video_inference_state,
-            points=point_coords,
-            labels=point_labels,
-            box=box
-        )
-        masks = (logits[0] > 0.0).cpu().numpy()
-        generated_masks = self.format_to_auto_result(masks)
+        obj_id = int(obj_id)
+        self.set_video_prompt(frame_idx=frame_idx, obj_id=obj_id,
+                              points=self.frame_cache.to_full_resolution(point_coords), labels=point_labels,
+                              box=self.frame_cache.to_full_resolution(box))
+        prompt = self.video_prompts[obj_id][frame_idx]
+        # The registered prompt is in the full resolution coordinates
+        scale = preview_scale * self.frame_cache.scale
+
+        points = prompt["points"] * scale if prompt["points"] is not None else None
+        box = prompt["box"] * scale if prompt["box"] is not None else None
+        # Same as the video predictor, a single point is ambiguous so the best of the multiple masks is used
+        multimask_output = box is None and points is not None and len(points) == 1
+
+        use_autocast = self.is_autocast_enabled()
+        try:
+            with self.pause_frame_encoder(), torch.autocast(device_type=self.device, dtype=self.dtype,
+                                                            enabled=use_autocast):
+                predictor = self.set_preview_frame(image, frame_idx)
+                masks, scores, logits = predictor.predict(
+                    point_coords=points,
+                    point_labels=prompt["labels"],
+                    box=box,
+                    multimask_output=multimask_output
+                )
+        except Exception as e:
+            logger.exception(f"Error while predicting preview frame: {str(e)}")
+            raise RuntimeError(f"Failed to predict preview frame") from e
 
+        masks = masks[np.argmax(scores)][None, None].astype(bool)
+        if pixel_size is not None:
+            pixel_size = max(1, round(pixel_size * scale))
         if invert_mask:
-            generated_masks = [{'segmentation': invert_masks(mask['segmentation'])[0],
-                                'area': mask['area']} for mask in generated_masks]
+            masks = self.invert_object_masks(masks)
+        generated_masks = self.format_to_auto_result(masks)
 
         if filter_mode == COLOR_FILTER:
             image = create_solid_color_mask_image(
@@ -411,10 +2226,29 @@ class SamInference:
                               pixel_size: Optional[int] = None,
                               color_hex: Optional[str] = None,
                               output_mime_type: Optional[str] = None,
-                              invert_mask: bool = False
+                              invert_mask: bool = False,
+                              obj_id: int = 0,
+                              mask_threshold: float = 0.0,
+                              frame_range: Optional[Tuple[int, int]] = None,
+                              max_frames: Optional[int] = None,
+                              frames_dir: Optional[str] = None,
+                              completed_frames: Optional[Set[int]] = None,
+                              progress_callback: Optional[Callable[[int, int, int], None]] = None,
+                              cancel_event: Optional[threading.Event] = None,
+                              mask_checkpoint_dir: Optional[str] = None
                               ):
         """
-        Create a whole filtered video with video_inference_state. Currently only one frame tracking is supported.
+        Create a whole filtered video with video_inference_state. The prompt data is registered for the object, and
+        all registered objects are tracked together in a single propagation pass. If frame_range or max_frames is
+        given, only the tracked span of the video is rendered. Long videos that exceed the memory budget are
+        tracked in overlapping windows with propagate_in_video_chunked(), and videos with a keyframe stride are tracked
+        on the keyframes with propagate_in_video_strided().
+        The tracked masks are saved as a mask track, so rendering again with other filter settings or output format
+        with the same prompts skips tracking. If self.keep_mask_logits is True, the mask track keeps the low
+        resolution mask logits, so changing the mask threshold skips tracking as well.
+        Background jobs render into their own frames_dir, and pass the frames that an interrupted run already rendered
+        there as completed_frames, which are not rendered again. They save the tracked masks to a mask checkpoint as
+        well, so an interrupted run resumes tracking from its last tracked frame.
         This needs FFmpeg to run. Returns two output path because of the gradio app.
 
         Args:
@@ -425,13 +2259,24 @@ class SamInference:
             color_hex (str): The color hex code for the solid color filter.
             output_mime_type (str): Output video mime type such '.mp4', '.mov' etc.
             invert_mask (bool): Invert the mask output - used for background masking.
+            obj_id (int): The object id of the prompt.
+            mask_threshold (float): The logit threshold of the masks. Higher values give tighter masks.
+            frame_range (Tuple[int, int]): The first and the last frame index (inclusive) to track and render.
+            max_frames (int): The maximum number of frames to track in each direction from the prompted frame.
+            frames_dir (str): The directory of the rendered frames. Use TEMP_OUT_DIR, which is cleaned first, if None.
+            completed_frames (Set[int]): The frame indexes that are already rendered in frames_dir.
+            progress_callback (Callable): Called with the frame index, the number of rendered frames and the number of
+                frames to render after each frame.
+            cancel_event (threading.Event): Rendering stops with JobCancelledError when the event is set.
+            mask_checkpoint_dir (str): The directory that the tracked masks are saved to, so tracking resumes from
+                them after an interruption. Only used when the video is tracked in a single inference state.
 
         Returns:
             str: The output video path. ( Return to gr.Video )
             str: The output video path. ( Return to gr.Files )
         """
 
-        if self.video_predictor is None or self.video_inference_state is None:
+        if self.video_predictor is None or (self.video_inference_state is None and self.uses_video_state()):
             logger.exception(
                 "Error while adding filter to preview, load video predictor first")
             raise RuntimeError("Error while adding filter to preview")
@@ -444,71 +2289,215 @@ class SamInference:
 
         use_alpha = True if output_mime_type in TRANSPARENT_VIDEO_FILE_EXT else False
 
-        prompt = image_prompt_input_data["points"]
-        if not prompt:
+        self.register_prompt_data(image_prompt_input_data, frame_idx=frame_idx, obj_id=obj_id)
+
+        if not self.video_prompts:
             error_message = ("No prompt data provided. If this is an incorrect flag, "
                              "Please press the eraser button (on the image prompter) and add your prompts again.")
             logger.error(error_message)
             raise gr.Error(error_message, duration=20)
 
-        point_labels, point_coords, box = self.handle_prompt_data(prompt)
-        obj_id = frame_idx
-
         output_dir = os.path.join(self.output_dir, "filter")
 
-        clean_files_with_extension(TEMP_OUT_DIR, IMAGE_FILE_EXT)
-        self.video_predictor.reset_state(self.video_inference_state)
-
-        idx, scores, logits = self.add_prediction_to_frame(
-            frame_idx=frame_idx,
-            obj_id=obj_id,
-            inference_state=self.video_inference_state,
-            points=point_coords,
-            labels=point_labels,
-            box=box,
+        if frames_dir is None:
+            frames_dir = TEMP_OUT_DIR
+            clean_files_with_extension(TEMP_OUT_DIR, IMAGE_FILE_EXT)
+        completed_frames = completed_frames or set()
+        mask_threshold = float(mask_threshold) if mask_threshold is not None else 0.0
+        track_path = self.get_mask_track_path(frame_range=frame_range, max_frames=max_frames,
+                                              mask_threshold=mask_threshold)
+        track_writer = None
+        video_segments = None
+        if track_path is not None and os.path.exists(track_path):
+            logger.info("Masks are already tracked with the same prompts, rendering from the mask track")
+            frame_segments = self.load_frame_segments(track_path)
+        elif self.video_chunked:
+            frame_segments = self.propagate_in_video_chunked(
+                frame_range=frame_range,
+                max_frames=max_frames,
+                mask_threshold=mask_threshold,
+                cancel_event=cancel_event
+            )
+        elif self.keyframe_stride > 1:
+            frame_segments = self.propagate_in_video_strided(
+                frame_range=frame_range,
+                max_frames=max_frames,
+                mask_threshold=mask_threshold,
+                cancel_event=cancel_event
+            )
+        elif self.uses_shot_tracking():
+            frame_segments = self.propagate_in_video_shots(
+                frame_range=frame_range,
+                max_frames=max_frames,
+                mask_threshold=mask_threshold,
+                cancel_event=cancel_event
+            )
+        else:
+            # Frames that aren't encoded yet are encoded by the propagation instead
+            with self.pause_frame_encoder():
+                self.apply_video_prompts_to_state(self.video_inference_state)
+
+                video_segments = self.propagate_in_video(
+                    inference_state=self.video_inference_state,
+                    frame_range=frame_range,
+                    max_frames=max_frames,
+                    mask_threshold=mask_threshold,
+                    cancel_event=cancel_event,
+                    mask_checkpoint=MaskCheckpoint(mask_checkpoint_dir) if mask_checkpoint_dir is not None else None
+                )
+            # Segments are fetched one at a time, so spilled masks are only read for the frame being rendered
+            frame_segments = ((frame_index, video_segments[frame_index]) for frame_index in sorted(video_segments))
+
+        if track_path is not None and not os.path.exists(track_path):
+            track_writer = MaskTrackWriter(track_path)
+
+        encoding_config = get_config_manager().video_encoding
+        frame_writer = FrameWriter(
+            output_dir=frames_dir,
+            img_format=encoding_config.get("frame_format", "png"),
+            compress_level=encoding_config.get("frame_compress_level"),
+            use_alpha=use_alpha
         )
-
-        video_segments = self.propagate_in_video(
-            inference_state=self.video_inference_state)
-        for frame_index, info in video_segments.items():
-            orig_image, masks = info["image"], info["mask"]
-            if invert_mask:
-                inverted = invert_masks(masks)
-                masks = np.array([inverted[0]]) if isinstance(
-                    inverted, np.ndarray) and inverted.ndim == 2 else inverted
-            if isinstance(masks, np.ndarray):
-                masks = self.format_to_auto_result(masks)
-
-            if filter_mode == COLOR_FILTER:
-                filtered_image = create_solid_color_mask_image(
-                    orig_image, masks, color_hex if color_hex is not None else "#000000")
-
-            elif filter_mode == PIXELIZE_FILTER:
-                filtered_image = create_mask_pixelized_image(
-                    orig_image, masks, pixel_size if pixel_size is not None else 16)
-
-            else:
-                filtered_image = create_alpha_mask_image(orig_image, masks)
-
-            save_image(image=filtered_image,
-                       output_dir=TEMP_OUT_DIR, use_alpha=use_alpha)
-
-        if len(video_segments) == 1:
+        tracking_paths = get_frames_from_dir(vid_dir=self.video_tracking_dir)
+        num_frames = self.get_num_tracked_frames(frame_range=frame_range, max_frames=max_frames)
+        rendered_frames = []
+        filtered_image = None
+        try:
+            with frame_writer:
+                for frame_index, info in frame_segments:
+                    self.check_cancelled(cancel_event)
+                    if frame_index in completed_frames:
+                        # Rendered by an interrupted run, only the masks are needed for the mask track
+                        if track_writer is not None:
+                            mask_key = "logits" if "logits" in info else "mask"
+                            track_writer.add(frame_index, info[mask_key], info["obj_ids"])
+                        rendered_frames.append(frame_index)
+                        if progress_callback is not None:
+                            progress_callback(frame_index, len(rendered_frames), num_frames)
+                        continue
+
+                    orig_image = info["image"]
+                    if "logits" in info:
+                        mask_logits = info["logits"]
+                        masks = self.get_frame_masks(mask_logits, orig_image, tracking_paths[frame_index],
+                                                     mask_threshold=mask_threshold)
+                    else:
+                        masks = mask_logits = info["mask"]
+                    if track_writer is not None:
+                        track_writer.add(frame_index, mask_logits, info["obj_ids"])
+                    if invert_mask:
+                        masks = self.invert_object_masks(masks)
+                    masks = self.format_to_auto_result(masks)
+
+                    if filter_mode == COLOR_FILTER:
+                        filtered_image = create_solid_color_mask_image(
+                            orig_image, masks, color_hex if color_hex is not None else "#000000")
+
+                    elif filter_mode == PIXELIZE_FILTER:
+                        filtered_image = create_mask_pixelized_image(
+                            orig_image, masks, pixel_size if pixel_size is not None else 16)
+
+                    else:
+                        filtered_image = create_alpha_mask_image(orig_image, masks)
+
+                    # Frames are named by the frame index because the chunked mode renders them out of order
+                    frame_writer.write(filtered_image, index=frame_index)
+                    rendered_frames.append(frame_index)
+                    if progress_callback is not None:
+                        progress_callback(frame_index, len(rendered_frames), num_frames)
+        except Exception:
+            if track_writer is not None:
+                track_writer.abort()
+            raise
+        finally:
+            if video_segments is not None:
+                video_segments.close()
+        if track_writer is not None:
+            track_writer.close()
+
+        if len(rendered_frames) == 1:
+            if filtered_image is None:
+                filtered_image = np.array(Image.open(
+                    os.path.join(frames_dir, f"{rendered_frames[0]:05d}{frame_writer.frame_ext}")))
             out_image = save_image(image=filtered_image, output_dir=output_dir)
             return None, out_image
 
         if self.video_info is None:
             raise RuntimeError("Video info not initialized")
 
+        frame_rate = self.video_info.frame_rate
+        # Keep the sound in sync with the rendered span
+        first_frame_idx = min(rendered_frames)
+        sound_start_time = float(first_frame_idx / frame_rate) if frame_rate else None
+
         out_video = create_video_from_frames(
-            frames_dir=TEMP_OUT_DIR,
-            frame_rate=self.video_info.frame_rate,
+            frames_dir=frames_dir,
+            frame_rate=frame_rate,
             output_dir=output_dir,
-            output_mime_type=output_mime_type
+            output_mime_type=output_mime_type,
+            sound_start_time=sound_start_time,
+            start_number=first_frame_idx,
+            frame_ext=frame_writer.frame_ext
         )
 
         return out_video, out_video
 
+    def get_mask_track_path(self,
+                            frame_range: Optional[Tuple[int, int]] = None,
+                            max_frames: Optional[int] = None,
+                            mask_threshold: float = 0.0) -> Optional[str]:
+        """
+        Get the path of the mask track for the current video, model, registered prompts and tracking parameters.
+
+        Args:
+            frame_range (Tuple[int, int]): The frame range to track.
+            max_frames (int): The maximum number of frames to track in each direction.
+            mask_threshold (float): The logit threshold of the masks. Mask tracks of logits don't depend on it.
+
+        Returns:
+            str: The mask track path. None if no video is loaded.
+        """
+        if self.video_id is None:
+            return None
+
+        key = get_mask_track_key(
+            video_id=self.video_id,
+            model_type=self.current_model_type,
+            prompts=self.video_prompts,
+            frame_range=frame_range,
+            max_frames=max_frames,
+            proxy_max_size=self.proxy_max_size,
+            chunked=self.video_chunked,
+            keyframe_stride=self.keyframe_stride,
+            keyframe_thresholds=[self.keyframe_max_motion, self.keyframe_min_iou] if self.keyframe_stride > 1 else None,
+            shots=self.video_shots if self.uses_shot_tracking() else None,
+            shot_carry=self.get_shot_carry_params() if self.uses_shot_tracking() else None,
+            keep_mask_logits=self.keep_mask_logits,
+            mask_threshold=None if self.keep_mask_logits else mask_threshold
+        )
+        return get_mask_track_path(key)
+
+    @staticmethod
+    def load_frame_segments(track_path: str):
+        """
+        Load the frame segments from the mask track, with the frame images loaded lazily.
+
+        Args:
+            track_path (str): The mask track path.
+
+        Yields:
+            int: The frame index.
+            Dict: The frame segment with "image", "mask" (or "logits") and "obj_ids" keys, same as
+                propagate_in_video().
+        """
+        frame_paths = get_frames_from_dir(vid_dir=TEMP_DIR)
+        for frame_idx, masks, obj_ids in load_mask_track(track_path):
+            yield frame_idx, {
+                "image": np.array(Image.open(frame_paths[frame_idx])),
+                "logits" if np.issubdtype(masks.dtype, np.floating) else "mask": masks,
+                "obj_ids": obj_ids
+            }
+
     def divide_layer(self,
                      image_input: np.ndarray,
                      image_prompt_input_data: Dict,
@@ -581,9 +2570,11 @@ class SamInference:
             generated_masks = self.format_to_auto_result(predicted_masks)
 
         save_psd_with_masks(image, generated_masks, output_path)
+        # The gallery only shows downscaled previews, the full resolution layers are in the psd file
         mask_combined_image = create_mask_combined_images(
             image, generated_masks)
-        gallery = create_mask_gallery(image, generated_masks)
+        clean_files_with_extension(TEMP_GALLERY_DIR, IMAGE_FILE_EXT)
+        gallery = create_mask_gallery(image, generated_masks, file_prefix=f"result-{timestamp}")
         gallery = [mask_combined_image] + gallery
 
         return gallery, output_path
@@ -600,6 +2591,13 @@ class SamInference:
                   for mask in masks]
         return result
 
+    @staticmethod
+    def invert_object_masks(
+        masks: np.ndarray
+    ) -> np.ndarray:
+        """Invert the union of the object masks in Nx1xHxW format into a single 1x1xHxW background mask."""
+        return np.logical_not(np.any(masks, axis=0, keepdims=True))
+
     @staticmethod
     def handle_prompt_data(
         prompt_data: List
@@ -0,0 +1,179 @@
+"""Propagation results store that keeps long videos within a RAM budget."""
+
+import os
+import tempfile
+import weakref
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from modules.paths import TEMP_DIR
+from modules.logger_util import get_logger
+
+logger = get_logger()
+
+DEFAULT_SEGMENT_RAM_BUDGET_MB = 1024
+
+
+class FrameSegment(Mapping):
+    """
+    Segment of a frame with "image", "mask" and "obj_ids" keys, or "logits" instead of "mask" if the store keeps
+    the low resolution mask logits. The image is loaded from disk on access, so only the frames that are being used
+    are decoded.
+    """
+
+    def __init__(self, store: "SegmentStore", frame_idx: int):
+        self._store = store
+        self._frame_idx = frame_idx
+
+    def __getitem__(self, key: str):
+        if key == "image":
+            return np.array(Image.open(self._store.frame_paths[self._frame_idx]))
+        if key == self._store.mask_key:
+            return self._store.get_mask(self._frame_idx)
+        if key == "obj_ids":
+            return list(self._store.get_obj_ids(self._frame_idx))
+        raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        # Don't load the data to check the key
+        return key in ("image", self._store.mask_key, "obj_ids")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(["image", self._store.mask_key, "obj_ids"])
+
+    def __len__(self) -> int:
+        return 3
+
+
+class SegmentStore(Mapping):
+    """
+    Read-only mapping of frame index -> FrameSegment for the propagation results, used like the video segments dict.
+    Masks are kept in RAM up to the budget, and the masks of the oldest frames are spilled to a memory-mapped file
+    over the budget. Frame images are never kept, they're loaded from the frame paths on access.
+    With keep_logits, the store keeps the low resolution mask logits of the model as float16 instead of the full
+    resolution boolean masks, so the masks can be upsampled and thresholded when each frame is rendered.
+    """
+
+    def __init__(self,
+                 frame_paths: List[str],
+                 ram_budget_mb: Optional[float] = DEFAULT_SEGMENT_RAM_BUDGET_MB,
+                 spill_dir: str = TEMP_DIR,
+                 keep_logits: bool = False):
+        """
+        Args:
+            frame_paths: Full resolution frame paths of the video
+            ram_budget_mb: RAM budget for the masks in MB. No masks are spilled if None
+            spill_dir: Directory of the spill file
+            keep_logits: Whether the store keeps float16 mask logits instead of boolean masks
+        """
+        self.frame_paths = frame_paths
+        self.keep_logits = keep_logits
+        self.dtype = np.float16 if keep_logits else bool
+        self.ram_budget_bytes = ram_budget_mb * 1024 ** 2 if ram_budget_mb is not None else None
+        self.spill_dir = spill_dir
+        self._obj_ids: Dict[int, List[int]] = {}
+        self._masks: OrderedDict = OrderedDict()
+        self._ram_bytes = 0
+        # Frame index -> (offset, shape) of the spilled masks, all in self.dtype
+        self._spilled: Dict[int, Tuple[int, tuple]] = {}
+        self._spill_path: Optional[str] = None
+        self._spill_file = None
+        self._spill_size = 0
+
+    def add(self, frame_idx: int, masks: np.ndarray, obj_ids: List[int]):
+        """
+        Add the masks of the frame.
+
+        Args:
+            frame_idx: Frame index
+            masks: Boolean masks in Nx1xHxW format, or mask logits in Nx1xhxw format if the store keeps logits
+            obj_ids: Object ids of the masks
+        """
+        masks = np.ascontiguousarray(masks, dtype=self.dtype)
+        self._remove_mask(frame_idx)
+        self._obj_ids[frame_idx] = list(obj_ids)
+        self._masks[frame_idx] = masks
+        self._ram_bytes += masks.nbytes
+
+        if self.ram_budget_bytes is None:
+            return
+        while self._ram_bytes > self.ram_budget_bytes and len(self._masks) > 1:
+            self._spill_oldest()
+
+    @property
+    def mask_key(self) -> str:
+        """Key of the masks in the frame segments."""
+        return "logits" if self.keep_logits else "mask"
+
+    def get_mask(self, frame_idx: int) -> np.ndarray:
+        """
+        Get the masks of the frame in Nx1xHxW format, or the mask logits if the store keeps logits. Spilled masks
+        are read-only memory-mapped arrays.
+        """
+        if frame_idx in self._masks:
+            return self._masks[frame_idx]
+        offset, shape = self._spilled[frame_idx]
+        return np.memmap(self._spill_path, dtype=self.dtype, mode="r", offset=offset, shape=shape)
+
+    def get_obj_ids(self, frame_idx: int) -> List[int]:
+        """Get the object ids of the frame."""
+        return self._obj_ids[frame_idx]
+
+    @property
+    def num_spilled(self) -> int:
+        """Number of frames whose masks are spilled to disk."""
+        return len(self._spilled)
+
+    def close(self):
+        """Release the masks and remove the spill file."""
+        self._masks.clear()
+        self._spilled.clear()
+        self._obj_ids.clear()
+        self._ram_bytes = 0
+        if self._spill_file is not None:
+            self._finalizer()
+            self._spill_file = None
+
+    def __getitem__(self, frame_idx: int) -> FrameSegment:
+        if frame_idx not in self._obj_ids:
+            raise KeyError(frame_idx)
+        return FrameSegment(self, frame_idx)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._obj_ids)
+
+    def __len__(self) -> int:
+        return len(self._obj_ids)
+
+    def _spill_oldest(self):
+        frame_idx, masks = self._masks.popitem(last=False)
+        self._ram_bytes -= masks.nbytes
+
+        if self._spill_file is None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            fd, self._spill_path = tempfile.mkstemp(suffix=".segments", dir=self.spill_dir)
+            self._spill_file = os.fdopen(fd, "wb")
+            self._finalizer = weakref.finalize(self, _remove_spill_file, self._spill_file, self._spill_path)
+
+        self._spill_file.write(masks.tobytes())
+        self._spill_file.flush()
+        self._spilled[frame_idx] = (self._spill_size, masks.shape)
+        self._spill_size += masks.nbytes
+
+    def _remove_mask(self, frame_idx: int):
+        masks = self._masks.pop(frame_idx, None)
+        if masks is not None:
+            self._ram_bytes -= masks.nbytes
+        self._spilled.pop(frame_idx, None)
+
+
+def _remove_spill_file(spill_file, spill_path: str):
+    spill_file.close()
+    try:
+        os.remove(spill_path)
+    except OSError:
+        logger.exception(f"Error while removing the segment spill file {spill_path}")
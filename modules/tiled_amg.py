@@ -0,0 +1,228 @@
+"""Tiled automatic segmentation for images that are too large to segment in one pass."""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+
+from modules.logger_util import get_logger
+
+logger = get_logger()
+
+DEFAULT_TILE_SIZE = 1536
+DEFAULT_TILE_OVERLAP = 256
+DEFAULT_MERGE_IOU_THRESH = 0.5
+# Masks with fewer pixels than this in the overlap of two tiles are never merged across the seam
+MIN_SEAM_PIXELS = 16
+
+# Box in (x0, y0, x1, y1) format with exclusive ends
+Box = Tuple[int, int, int, int]
+
+
+def get_tiles(width: int, height: int, tile_size: int = DEFAULT_TILE_SIZE,
+              overlap: int = DEFAULT_TILE_OVERLAP) -> List[Box]:
+    """
+    Split the image into overlapping tiles. The tiles are spread evenly, so every tile is at most tile_size and
+    neighbouring tiles overlap by at least overlap pixels.
+
+    Args:
+        width: Image width
+        height: Image height
+        tile_size: Longest side of a tile
+        overlap: Minimum overlap of neighbouring tiles
+
+    Returns:
+        Tile boxes in row-major order
+    """
+    def get_starts(length: int) -> List[int]:
+        if length <= tile_size:
+            return [0]
+        num_tiles = int(np.ceil((length - overlap) / (tile_size - overlap)))
+        stride = (length - tile_size) / (num_tiles - 1)
+        return [round(i * stride) for i in range(num_tiles)]
+
+    tile_w, tile_h = min(tile_size, width), min(tile_size, height)
+    return [(x0, y0, x0 + tile_w, y0 + tile_h) for y0 in get_starts(height) for x0 in get_starts(width)]
+
+
+def crop_tile_masks(masks: List[Dict[str, Any]], tile: Box) -> List[Dict[str, Any]]:
+    """
+    Crop the masks of a tile to their bounding boxes, so only the masked part is kept in memory.
+
+    Args:
+        masks: Automatic segmentation results of the tile, with segmentations at the tile size
+        tile: Tile box in the image
+
+    Returns:
+        Tile masks with the "segmentation" cropped to the "box", in image coordinates, and the "tile" box
+    """
+    tile_masks = []
+    for info in masks:
+        segmentation = np.asarray(info["segmentation"], dtype=bool)
+        rows, cols = np.flatnonzero(segmentation.any(axis=1)), np.flatnonzero(segmentation.any(axis=0))
+        if len(rows) == 0:
+            continue
+        top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        tile_masks.append({
+            "segmentation": segmentation[top:bottom, left:right].copy(),
+            "box": (tile[0] + left, tile[1] + top, tile[0] + right, tile[1] + bottom),
+            "tile": tile,
+            "predicted_iou": float(info.get("predicted_iou", 0.0)),
+            "stability_score": float(info.get("stability_score", 0.0)),
+            "point_coords": [[x + tile[0], y + tile[1]] for x, y in info.get("point_coords", [])],
+        })
+    return tile_masks
+
+
+def intersect_boxes(a: Box, b: Box) -> Box:
+    """Get the intersection of the boxes. The box is empty if x0 >= x1 or y0 >= y1."""
+    return max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])
+
+
+def crop_mask(mask: Dict[str, Any], box: Box) -> np.ndarray:
+    """Crop the tile mask to the box in image coordinates. Pixels outside the mask box are False."""
+    x0, y0, x1, y1 = box
+    mx0, my0, mx1, my1 = mask["box"]
+    cropped = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+    ix0, iy0, ix1, iy1 = intersect_boxes(box, mask["box"])
+    if ix0 < ix1 and iy0 < iy1:
+        cropped[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] = mask["segmentation"][iy0 - my0:iy1 - my0, ix0 - mx0:ix1 - mx0]
+    return cropped
+
+
+def union_masks(masks: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Merge the tile masks into one mask that covers the union of their pixels."""
+    x0 = min(mask["box"][0] for mask in masks)
+    y0 = min(mask["box"][1] for mask in masks)
+    x1 = max(mask["box"][2] for mask in masks)
+    y1 = max(mask["box"][3] for mask in masks)
+    segmentation = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+    for mask in masks:
+        mx0, my0, mx1, my1 = mask["box"]
+        segmentation[my0 - y0:my1 - y0, mx0 - x0:mx1 - x0] |= mask["segmentation"]
+
+    best = max(masks, key=lambda mask: mask["predicted_iou"])
+    return {
+        **best,
+        "segmentation": segmentation,
+        "box": (x0, y0, x1, y1),
+        "stability_score": max(mask["stability_score"] for mask in masks),
+    }
+
+
+def merge_tile_masks(tile_masks: List[List[Dict[str, Any]]],
+                     iou_thresh: float = DEFAULT_MERGE_IOU_THRESH) -> List[Dict[str, Any]]:
+    """
+    Merge the masks of the tiles across the tile seams. Masks of two tiles that agree in the overlap of the tiles
+    are the same object, cut or duplicated by the tiling, and are merged into one mask.
+
+    Args:
+        tile_masks: Cropped masks of each tile from crop_tile_masks()
+        iou_thresh: Minimum IoU of two masks inside the tile overlap to merge them
+
+    Returns:
+        Merged masks in the crop_tile_masks() format
+    """
+    masks = [mask for masks in tile_masks for mask in masks]
+    parents = list(range(len(masks)))
+
+    def find(index: int) -> int:
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    for i, a in enumerate(masks):
+        for j in range(i + 1, len(masks)):
+            b = masks[j]
+            if a["tile"] == b["tile"]:
+                continue
+            seam = intersect_boxes(a["tile"], b["tile"])
+            region = intersect_boxes(seam, intersect_boxes(a["box"], b["box"]))
+            if region[0] >= region[2] or region[1] >= region[3]:
+                continue
+
+            # IoU of the masks inside the overlap of the tiles, where both tiles see the same pixels
+            seam_a, seam_b = crop_mask(a, seam), crop_mask(b, seam)
+            union = np.logical_or(seam_a, seam_b).sum()
+            if union < MIN_SEAM_PIXELS:
+                continue
+            if np.logical_and(seam_a, seam_b).sum() / union > iou_thresh:
+                parents[find(j)] = find(i)
+
+    groups: Dict[int, List[Dict[str, Any]]] = {}
+    for index, mask in enumerate(masks):
+        groups.setdefault(find(index), []).append(mask)
+    return [group[0] if len(group) == 1 else union_masks(group) for group in groups.values()]
+
+
+def expand_tile_masks(masks: List[Dict[str, Any]], width: int, height: int) -> List[Dict[str, Any]]:
+    """
+    Expand the merged masks to full image masks in the automatic segmentation result format.
+
+    Args:
+        masks: Merged masks from merge_tile_masks()
+        width: Image width
+        height: Image height
+
+    Returns:
+        Mask data with "segmentation", "area", "bbox" in XYWH format, "predicted_iou", "point_coords",
+        "stability_score" and "crop_box", sorted by area in descending order
+    """
+    results = []
+    for mask in masks:
+        x0, y0, x1, y1 = mask["box"]
+        segmentation = np.zeros((height, width), dtype=bool)
+        segmentation[y0:y1, x0:x1] = mask["segmentation"]
+        results.append({
+            "segmentation": segmentation,
+            "area": int(mask["segmentation"].sum()),
+            "bbox": [x0, y0, x1 - x0, y1 - y0],
+            "predicted_iou": mask["predicted_iou"],
+            "point_coords": mask["point_coords"],
+            "stability_score": mask["stability_score"],
+            "crop_box": [0, 0, width, height],
+        })
+    return sorted(results, key=lambda result: result["area"], reverse=True)
+
+
+def generate_tiled_masks(image: np.ndarray,
+                         create_generator: Callable[[], Any],
+                         tile_size: int = DEFAULT_TILE_SIZE,
+                         overlap: int = DEFAULT_TILE_OVERLAP,
+                         max_workers: int = 1,
+                         iou_thresh: float = DEFAULT_MERGE_IOU_THRESH) -> List[Dict[str, Any]]:
+    """
+    Run automatic segmentation on overlapping tiles of the image in parallel workers and merge the masks across the
+    tile seams. Each worker keeps its own mask generator, and only the cropped masks of each tile are kept until
+    the merge, so the memory usage depends on the tile size rather than the image size.
+
+    Args:
+        image: Input image
+        create_generator: Creates a mask generator with a generate(image) method for a worker
+        tile_size: Longest side of a tile
+        overlap: Minimum overlap of neighbouring tiles
+        max_workers: Number of tiles segmented in parallel
+        iou_thresh: Minimum IoU of two masks inside the tile overlap to merge them
+
+    Returns:
+        Mask data in the automatic segmentation result format
+    """
+    height, width = image.shape[:2]
+    tiles = get_tiles(width, height, tile_size=tile_size, overlap=overlap)
+    local = threading.local()
+
+    def segment_tile(tile: Box) -> List[Dict[str, Any]]:
+        if not hasattr(local, "generator"):
+            local.generator = create_generator()
+        x0, y0, x1, y1 = tile
+        tile_image = np.ascontiguousarray(image[y0:y1, x0:x1])
+        return crop_tile_masks(local.generator.generate(tile_image), tile)
+
+    logger.info(f"Segmenting the {width}x{height} image in {len(tiles)} tiles with {max_workers} workers")
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="amg_tile") as executor:
+        tile_masks = list(executor.map(segment_tile, tiles))
+
+    merged_masks = merge_tile_masks(tile_masks, iou_thresh=iou_thresh)
+    return expand_tile_masks(merged_masks, width, height)
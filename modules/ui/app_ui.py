@@ -14,6 +14,7 @@ from modules.constants import (
 )
 from modules.ui.components import UIComponents
 from modules.ui.event_handlers import EventHandlers
+from modules.jobs import VideoJobManager
 from modules.utils.config_manager import get_config_manager
 from modules.utils import open_folder
 from modules.logger_util import get_logger
@@ -44,7 +45,8 @@ class AppUI:
             self.config_manager,
             sam_inference.available_models
         )
-        self.event_handlers = EventHandlers(sam_inference)
+        self.job_manager = VideoJobManager(sam_inference)
+        self.event_handlers = EventHandlers(sam_inference, self.job_manager)
 
         # UI settings
         self.image_modes = [AUTOMATIC_MODE, BOX_PROMPT_MODE]
@@ -76,6 +78,7 @@ class AppUI:
 
                     with gr.Column(scale=1):
                         dd_models = inputs['model_dropdown']  # type: ignore
+                        self.dd_video_models = dd_models
                         # type: ignore
                         dd_filter_mode = inputs['filter_dropdown']
                         # type: ignore
@@ -84,12 +87,26 @@ class AppUI:
                         # type: ignore
                         dd_output_mime_type = inputs['output_format']
                         cb_invert_mask = inputs['invert_mask']  # type: ignore
+                        nb_object_id = inputs['object_id']  # type: ignore
+                        sld_mask_threshold = inputs['mask_threshold']  # type: ignore
                         btn_generate_preview = gr.Button(_("GENERATE PREVIEW"))
+                        btn_clear_prompts = gr.Button(_("CLEAR ALL PROMPTS"))
 
             with gr.Row():
                 btn_generate = gr.Button(
                     _("GENERATE VIDEO"), variant="primary")
 
+            job_components = self.ui_components.create_video_job_components()
+            with gr.Row(equal_height=True):
+                dd_jobs = job_components['job_dropdown']  # type: ignore
+                with gr.Column(scale=1):
+                    btn_submit_job = job_components['submit_button']  # type: ignore
+                    btn_cancel_job = job_components['cancel_button']  # type: ignore
+                    btn_resume_job = job_components['resume_button']  # type: ignore
+            md_job_status = job_components['job_status']  # type: ignore
+            tmr_job_status = job_components['status_timer']  # type: ignore
+            state_job_output = gr.State(None)
+
             # Create output components
             outputs = self.ui_components.create_video_segmentation_outputs()
 
@@ -127,26 +144,64 @@ class AppUI:
 
             preview_params = [
                 vid_frame_prompter, dd_filter_mode, sld_frame_selector,
-                nb_pixel_size, cp_color_picker, cb_invert_mask
+                nb_pixel_size, cp_color_picker, cb_invert_mask, nb_object_id
             ]
 
             video_params = [
                 vid_frame_prompter, dd_filter_mode, sld_frame_selector,
-                nb_pixel_size, cp_color_picker, dd_output_mime_type, cb_invert_mask
+                nb_pixel_size, cp_color_picker, dd_output_mime_type, cb_invert_mask, nb_object_id,
+                sld_mask_threshold
             ]
 
             btn_generate_preview.click(
-                fn=self.sam_inf.add_filter_to_preview,
+                fn=self.event_handlers.on_preview,
                 inputs=preview_params,
                 outputs=[img_preview]
             )
 
             btn_generate.click(
-                fn=self.sam_inf.create_filtered_video,
+                fn=self.event_handlers.on_generate,
                 inputs=video_params,
                 outputs=[vid_output, output_file]
             )
 
+            btn_submit_job.click(
+                fn=self.event_handlers.on_job_submit,
+                inputs=video_params,
+                outputs=[dd_jobs, md_job_status]
+            )
+
+            job_status_outputs = [dd_jobs, md_job_status, vid_output, output_file, state_job_output]
+            tmr_job_status.tick(  # type: ignore
+                fn=self.event_handlers.on_job_status,
+                inputs=[dd_jobs, state_job_output],
+                outputs=job_status_outputs
+            )
+
+            dd_jobs.input(  # type: ignore
+                fn=self.event_handlers.on_job_status,
+                inputs=[dd_jobs, state_job_output],
+                outputs=job_status_outputs
+            )
+
+            btn_cancel_job.click(
+                fn=self.event_handlers.on_job_cancel,
+                inputs=[dd_jobs],
+                outputs=[md_job_status]
+            )
+
+            btn_resume_job.click(
+                fn=self.event_handlers.on_job_resume,
+                inputs=[dd_jobs],
+                outputs=[md_job_status]
+            )
+
+            btn_clear_prompts.click(
+                fn=self.event_handlers.on_clear_prompts,
+                inputs=None,
+                outputs=None
+            )
+
             btn_open_folder.click(
                 fn=lambda: open_folder(os.path.join(
                     self.args.output_dir, "filter")),
@@ -173,6 +228,7 @@ class AppUI:
                 with gr.Column(scale=5):
                     dd_input_modes = inputs['mode_dropdown']  # type: ignore
                     dd_models = inputs['model_dropdown']  # type: ignore
+                    self.dd_layer_models = dd_models
                     cb_invert_mask = inputs['invert_mask']  # type: ignore
 
                     with gr.Accordion(
@@ -183,6 +239,7 @@ class AppUI:
                         mask_hparams_component = self.ui_components.create_mask_parameters(
                             mask_hparams
                         )
+                        self.mask_hparams_component = mask_hparams_component
 
                     # type: ignore
                     cb_multimask_output = inputs['multimask_output']
@@ -209,7 +266,7 @@ class AppUI:
 
             # Wire up event handlers
             btn_generate.click(
-                fn=self.sam_inf.divide_layer,
+                fn=self.event_handlers.on_divide_layer,
                 inputs=input_params,
                 outputs=[gallery_output, output_file]
             )
@@ -241,9 +298,17 @@ class AppUI:
                 md_header = gr.Markdown(HEADER, elem_id="md_header")
                 md_prompt_guide = gr.Markdown(
                     _("If you don't know how to prompt"))
+                dd_profile = self.ui_components.create_profile_dropdown()
 
                 with gr.Tabs():
                     self.create_video_segmentation_tab()
                     self.create_layer_divider_tab()
 
+                mask_hparam_keys = [component.label for component in self.mask_hparams_component]
+                dd_profile.change(  # type: ignore
+                    fn=lambda profile: self.event_handlers.on_profile_change(profile, mask_hparam_keys),
+                    inputs=[dd_profile],
+                    outputs=[self.dd_video_models, self.dd_layer_models] + self.mask_hparams_component
+                )
+
         return demo
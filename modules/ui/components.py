@@ -12,6 +12,7 @@ from modules.constants import (
     IMAGE_FILE_EXT, VIDEO_FILE_EXT
 )
 from modules.model_downloader import DEFAULT_MODEL_TYPE
+from modules.utils.config_manager import DEFAULT_PROFILE
 
 
 class UIComponents:
@@ -28,6 +29,21 @@ class UIComponents:
         self.config_manager = config_manager
         self.available_models = available_models
         self.mask_hparams = config_manager.mask_hparams
+        self.default_model_type = config_manager.profile_settings.get("model_type", DEFAULT_MODEL_TYPE)
+
+    def create_profile_dropdown(self) -> gr.Dropdown:
+        """
+        Create the performance profile dropdown.
+
+        Returns:
+            Gradio dropdown of the profiles in the config
+        """
+        return gr.Dropdown(
+            label=_("Performance Profile"),
+            choices=list(self.config_manager.profiles),
+            value=self.config_manager.active_profile or DEFAULT_PROFILE,
+            interactive=True
+        )
 
     def create_mask_parameters(self, hparams: Optional[Dict] = None) -> List[gr.components.Component]:
         """
@@ -132,7 +148,7 @@ class UIComponents:
             ),
             'model_dropdown': gr.Dropdown(
                 label=_("Model"),
-                value=DEFAULT_MODEL_TYPE,
+                value=self.default_model_type,
                 choices=self.available_models
             ),
             'filter_dropdown': gr.Dropdown(
@@ -165,6 +181,21 @@ class UIComponents:
             'invert_mask': gr.Checkbox(
                 label=_("invert mask"),
                 value=self.mask_hparams["invert_mask"]
+            ),
+            'object_id': gr.Number(
+                label=_("Object ID"),
+                interactive=True,
+                minimum=0,
+                precision=0,
+                value=0
+            ),
+            'mask_threshold': gr.Slider(
+                label=_("Mask Threshold"),
+                interactive=True,
+                minimum=-10,
+                maximum=10,
+                step=0.5,
+                value=0
             )
         }
 
@@ -187,6 +218,27 @@ class UIComponents:
             )
         }
 
+    def create_video_job_components(self) -> Dict[str, gr.components.Component]:
+        """
+        Create the background job components for video segmentation tab.
+
+        Returns:
+            Dictionary of named Gradio components
+        """
+        return {
+            'job_dropdown': gr.Dropdown(
+                label=_("Background Jobs"),
+                choices=[],
+                interactive=True,
+                scale=3
+            ),
+            'job_status': gr.Markdown(),
+            'submit_button': gr.Button(_("SUBMIT AS BACKGROUND JOB")),
+            'cancel_button': gr.Button(_("CANCEL JOB")),
+            'resume_button': gr.Button(_("RESUME JOB")),
+            'status_timer': gr.Timer(value=2.0)
+        }
+
     def create_layer_divider_inputs(self, default_mode: str) -> Dict[str, gr.components.Component]:
         """
         Create input components for layer divider tab.
@@ -214,7 +266,7 @@ class UIComponents:
             ),
             'model_dropdown': gr.Dropdown(
                 label=_("Model"),
-                value=DEFAULT_MODEL_TYPE,
+                value=self.default_model_type,
                 choices=self.available_models
             ),
             'invert_mask': gr.Checkbox(
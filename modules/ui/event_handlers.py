@@ -1,34 +1,54 @@
 """Event handlers for Gradio UI components."""
 
+from contextlib import contextmanager
+
 import gradio as gr
 from gradio_i18n import gettext as _
 from gradio_image_prompter import ImagePrompter
 from gradio_image_prompter.image_prompter import PromptValue
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 
 from modules.constants import (
     AUTOMATIC_MODE, BOX_PROMPT_MODE, PIXELIZE_FILTER,
     COLOR_FILTER, TRANSPARENT_COLOR_FILTER, TRANSPARENT_VIDEO_FILE_EXT,
     SUPPORTED_VIDEO_FILE_EXT
 )
-from modules.video_utils import get_frames_from_dir
-from modules.paths import TEMP_DIR
+from modules.jobs import JOB_COMPLETED
+from modules.utils.config_manager import get_config_manager
 from modules.logger_util import get_logger
 
 logger = get_logger()
 
+# UI events that use the loaded video wait this long for the video lock before failing
+VIDEO_LOCK_TIMEOUT_SECONDS = 1.0
+
 
 class EventHandlers:
     """Handles all Gradio event callbacks."""
 
-    def __init__(self, sam_inference):
+    def __init__(self, sam_inference, job_manager=None):
         """
         Initialize event handlers.
 
         Args:
             sam_inference: SamInference instance for processing
+            job_manager: VideoJobManager instance for the background video jobs
         """
         self.sam_inf = sam_inference
+        self.job_manager = job_manager
+
+    @contextmanager
+    def video_lock(self):
+        """
+        Hold the video lock of SamInference for a UI event. Fail the event instead of waiting while a background
+        video job or another render holds it.
+        """
+        if not self.sam_inf.video_lock.acquire(timeout=VIDEO_LOCK_TIMEOUT_SECONDS):
+            raise gr.Error(_("The video is busy with another render. Wait for it to finish or cancel the running job."))
+        try:
+            yield
+        finally:
+            self.sam_inf.video_lock.release()
 
     @staticmethod
     def on_mode_change(mode: str) -> List[gr.components.Component]:
@@ -47,6 +67,25 @@ class EventHandlers:
             gr.Accordion(visible=mode == AUTOMATIC_MODE),
         ]
 
+    def on_profile_change(self, profile: str, mask_hparam_keys: List[str]) -> List[Any]:
+        """
+        Handle performance profile change event.
+
+        Args:
+            profile: Selected profile name
+            mask_hparam_keys: Keys of the mask parameter components in order
+
+        Returns:
+            Updated values of the video and layer divider model dropdowns and the mask parameter components
+        """
+        with self.video_lock():
+            self.sam_inf.apply_profile(profile)
+        mask_hparams = get_config_manager().mask_hparams
+        return [
+            gr.Dropdown(value=self.sam_inf.default_model_type),
+            gr.Dropdown(value=self.sam_inf.default_model_type),
+        ] + [gr.update(value=mask_hparams[key]) for key in mask_hparam_keys]
+
     @staticmethod
     def on_filter_mode_change(mode: str) -> List[gr.components.Component]:
         """
@@ -99,14 +138,15 @@ class EventHandlers:
 
         progress(0, desc=_("Extracting frames..."))
 
-        self.sam_inf.init_video_inference_state(
-            vid_input=vid_input,
-            model_type=model_type
-        )
+        with self.video_lock():
+            self.sam_inf.init_video_inference_state(
+                vid_input=vid_input,
+                model_type=model_type
+            )
 
-        frames = get_frames_from_dir(vid_dir=TEMP_DIR)
-        initial_frame = frames[0]
-        max_frame_index = len(frames) - 1
+            frame_cache = self.sam_inf.frame_cache
+            initial_frame = frame_cache.get_preview(0)
+            max_frame_index = len(frame_cache) - 1
         i_value = PromptValue(image=initial_frame, points=[])
 
         return [
@@ -124,10 +164,10 @@ class EventHandlers:
             )
         ]
 
-    @staticmethod
-    def on_frame_change(frame_idx: int) -> ImagePrompter:
+    def on_frame_change(self, frame_idx: int) -> ImagePrompter:
         """
-        Handle frame selection change event.
+        Handle frame selection change event. The downscaled frame comes from the frame cache, and the prompt
+        coordinates are mapped back to the full resolution by SamInference.
 
         Args:
             frame_idx: Selected frame index
@@ -135,8 +175,8 @@ class EventHandlers:
         Returns:
             Updated ImagePrompter with the selected frame
         """
-        frames = get_frames_from_dir(vid_dir=TEMP_DIR)
-        selected_frame = frames[frame_idx]
+        with self.video_lock():
+            selected_frame = self.sam_inf.frame_cache.get_preview(frame_idx)
         n_value = PromptValue(image=selected_frame, points=[])
         return ImagePrompter(
             label=_("Prompt image with Box & Point"),
@@ -156,3 +196,132 @@ class EventHandlers:
         """
         image = prompt["image"]
         return gr.Image(label=_("Preview"), value=image)
+
+    def on_preview(self, *preview_params) -> Any:
+        """
+        Handle video preview event.
+
+        Args:
+            *preview_params: Same inputs as SamInference.add_filter_to_preview()
+
+        Returns:
+            Filtered preview image
+        """
+        with self.video_lock():
+            return self.sam_inf.add_filter_to_preview(*preview_params)
+
+    def on_generate(self, *video_params) -> Tuple[Any, ...]:
+        """
+        Handle video generate event.
+
+        Args:
+            *video_params: Same inputs as SamInference.create_filtered_video()
+
+        Returns:
+            Output video and output file path
+        """
+        with self.video_lock():
+            return self.sam_inf.create_filtered_video(*video_params)
+
+    def on_clear_prompts(self):
+        """Handle clear video prompts event."""
+        with self.video_lock():
+            self.sam_inf.clear_video_prompts()
+
+    def on_divide_layer(self, *layer_params) -> Tuple[Any, ...]:
+        """
+        Handle layer divide event. Loading the image model unloads the video predictor, so it takes the video lock.
+
+        Args:
+            *layer_params: Same inputs as SamInference.divide_layer()
+
+        Returns:
+            Divided layer images and the psd file path
+        """
+        with self.video_lock():
+            return self.sam_inf.divide_layer(*layer_params)
+
+    def on_job_submit(self, *video_params) -> List[gr.components.Component]:
+        """
+        Handle background job submit event.
+
+        Args:
+            *video_params: Same inputs as SamInference.create_filtered_video()
+
+        Returns:
+            Updated job dropdown with the submitted job selected, and its status
+        """
+        try:
+            with self.video_lock():
+                job_id = self.job_manager.submit(*video_params)
+        except RuntimeError as e:
+            raise gr.Error(str(e))
+        return [self.get_job_dropdown(job_id), self.format_job_status(job_id)]
+
+    def on_job_status(self, job_id: Optional[str], shown_output: Optional[str]) -> Tuple[Any, ...]:
+        """
+        Handle job status refresh event.
+
+        Args:
+            job_id: Selected job id
+            shown_output: Output path of the job that is already shown
+
+        Returns:
+            Updated job dropdown, job status, output video, output file and the shown output path
+        """
+        status = self.format_job_status(job_id)
+        output = None
+        if job_id:
+            record = self.job_manager.get_job(job_id)
+            if record["status"] == JOB_COMPLETED:
+                output = record["output"]
+        if output is None or output == shown_output:
+            return self.get_job_dropdown(job_id), status, gr.update(), gr.update(), shown_output
+        return self.get_job_dropdown(job_id), status, output, output, output
+
+    def on_job_cancel(self, job_id: Optional[str]) -> str:
+        """
+        Handle job cancel event.
+
+        Args:
+            job_id: Selected job id
+
+        Returns:
+            Updated job status
+        """
+        if job_id:
+            self.job_manager.cancel(job_id)
+        return self.format_job_status(job_id)
+
+    def on_job_resume(self, job_id: Optional[str]) -> str:
+        """
+        Handle job resume event.
+
+        Args:
+            job_id: Selected job id
+
+        Returns:
+            Updated job status
+        """
+        if job_id:
+            try:
+                self.job_manager.resume(job_id)
+            except RuntimeError as e:
+                raise gr.Error(str(e))
+        return self.format_job_status(job_id)
+
+    def get_job_dropdown(self, job_id: Optional[str]) -> gr.Dropdown:
+        """Get the job dropdown with all jobs, the latest first."""
+        return gr.Dropdown(choices=[record["id"] for record in self.job_manager.list_jobs()], value=job_id)
+
+    def format_job_status(self, job_id: Optional[str]) -> str:
+        """Format the status and the progress of the job as markdown."""
+        if not job_id:
+            return ""
+        record = self.job_manager.get_job(job_id)
+        status = f"**{record['status']}**"
+        if record["num_frames"]:
+            status += f" - {record['num_rendered']} / {record['num_frames']} frames"
+        if record["error"]:
+            status += f"\n\n{record['error']}"
+        return status
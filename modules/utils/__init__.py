@@ -5,7 +5,8 @@ from modules.utils.file_utils import (
     open_folder,
     is_image_file,
     get_image_files,
-    save_image
+    save_image,
+    FrameWriter
 )
 
 __all__ = [
@@ -14,5 +15,6 @@ __all__ = [
     'open_folder',
     'is_image_file',
     'get_image_files',
-    'save_image'
+    'save_image',
+    'FrameWriter'
 ]
@@ -8,6 +8,20 @@ from modules.logger_util import get_logger
 
 logger = get_logger()
 
+# Profile that keeps the default hyperparameters as they are
+DEFAULT_PROFILE = "default"
+
+
+def merge_configs(base: Dict[str, Any], override: Dict[str, Any]) -> Dict[str, Any]:
+    """Merge the override into a copy of the base config. Nested dicts are merged key by key."""
+    merged = dict(base)
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_configs(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
 
 class ConfigManager:
     """Singleton configuration manager for the application."""
@@ -25,6 +39,7 @@ class ConfigManager:
             return
 
         self._configs: Dict[str, Any] = {}
+        self.active_profile: Optional[str] = None
         self._load_configs()
         self._initialized = True
 
@@ -62,7 +77,68 @@ class ConfigManager:
     @property
     def mask_hparams(self) -> Dict[str, Any]:
         """Get mask generation hyperparameters."""
-        return self.default_hparams.get("mask_hparams", {})
+        return self._get_section("mask_hparams")
+
+    @property
+    def tiled_segmentation(self) -> Dict[str, Any]:
+        """Get tiled automatic segmentation settings."""
+        return self._get_section("tiled_segmentation")
+
+    @property
+    def video_encoding(self) -> Dict[str, Any]:
+        """Get video encoding settings."""
+        return self._get_section("video_encoding")
+
+    @property
+    def shot_detection(self) -> Dict[str, Any]:
+        """Get video shot detection settings."""
+        return self._get_section("shot_detection")
+
+    @property
+    def profiles(self) -> Dict[str, Any]:
+        """Get the named performance profiles."""
+        return self.default_hparams.get("profiles", {})
+
+    @property
+    def profile_settings(self) -> Dict[str, Any]:
+        """Get the SamInference settings of the active profile."""
+        if self.active_profile is None:
+            return {}
+        return self.get_profile(self.active_profile).get("sam_inference", {})
+
+    def get_profile(self, name: str) -> Dict[str, Any]:
+        """
+        Get the performance profile.
+
+        Args:
+            name: Profile name
+
+        Returns:
+            Profile with the "sam_inference" settings and overrides of the other config sections
+        """
+        if name not in self.profiles:
+            raise ConfigurationError(
+                f"Unknown profile '{name}'. Available profiles: {', '.join(self.profiles)}")
+        return self.profiles[name] or {}
+
+    def set_profile(self, name: Optional[str]) -> None:
+        """
+        Activate the performance profile. The config sections are merged with the overrides of the profile.
+
+        Args:
+            name: Profile name. None deactivates the profile
+        """
+        if name is not None:
+            self.get_profile(name)
+        self.active_profile = name
+        logger.info(f"Performance profile: {name}")
+
+    def _get_section(self, section: str) -> Dict[str, Any]:
+        """Get the config section merged with the overrides of the active profile."""
+        config = self.default_hparams.get(section, {})
+        if self.active_profile is None:
+            return config
+        return merge_configs(config, self.get_profile(self.active_profile).get(section, {}))
 
     def get_config(self, key: str, default: Any = None) -> Any:
         """
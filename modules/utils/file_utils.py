@@ -1,12 +1,17 @@
 """File utility functions."""
 
 import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from PIL import Image
-from typing import Optional, Union
+from typing import List, Optional, Union
 import numpy as np
 
 from modules.constants import IMAGE_FILE_EXT
 
+# Image formats that keep the alpha channel
+ALPHA_IMAGE_FORMATS = ["png", "tiff", "webp", "bmp"]
+
 
 def open_folder(folder_path: str):
     """Open the folder in the file explorer"""
@@ -34,9 +39,11 @@ def save_image(image: Union[np.ndarray, str],
                output_path: Optional[str] = None,
                output_dir: Optional[str] = None,
                use_alpha: Optional[bool] = None,
-               img_format: Optional[str] = None):
+               img_format: Optional[str] = None,
+               index: Optional[int] = None):
     """Save the image to the output path or output directory. If output_dir is provided,
-    the image will be saved as a numbered image file name in the directory."""
+    the image will be saved as a numbered image file name in the directory. The number is the index if it's given,
+    otherwise the number of images in the directory."""
 
     if output_dir is None and output_path is None:
         raise ValueError("Either output_path or output_dir should be provided")
@@ -56,8 +63,118 @@ def save_image(image: Union[np.ndarray, str],
         return output_path
 
     os.makedirs(output_dir, exist_ok=True)
-    num_images = len(get_image_files(output_dir))
-    output_path = os.path.join(output_dir, f"{num_images:05d}.{img_format}")
+    if index is None:
+        index = len(get_image_files(output_dir))
+    output_path = os.path.join(output_dir, f"{index:05d}.{img_format}")
     image.save(output_path)
 
     return output_path
+
+
+class FrameWriter:
+    """
+    Write numbered frames to a directory on a thread pool. The frame index is given explicitly, so the directory is
+    never listed, and at most max_in_flight frames wait for encoding to bound the memory usage.
+
+    Each frame is written to a temporary file and renamed when it's complete, so a frame file that exists is never
+    partially written, even if the process is killed.
+
+    Use it as a context manager, or call close() to wait for the pending frames.
+    """
+
+    def __init__(self,
+                 output_dir: str,
+                 img_format: str = "png",
+                 compress_level: Optional[int] = None,
+                 quality: Optional[int] = None,
+                 use_alpha: Optional[bool] = None,
+                 num_workers: Optional[int] = None,
+                 max_in_flight: Optional[int] = None):
+        """
+        Args:
+            output_dir: Output directory of the frames
+            img_format: Image format of the frames, e.g. "png", "jpg", "bmp". Formats without alpha fall back to
+                "png" when use_alpha is set
+            compress_level: PNG compression level from 0 to 9. Lower is faster with larger files, 1 is a good
+                intermediate for frames that are encoded to a video right after
+            quality: Quality for lossy formats like "jpg" and "webp"
+            use_alpha: Whether the frames have an alpha channel
+            num_workers: Number of encoding threads. Defaults to the number of CPU cores up to 8
+            max_in_flight: Maximum number of frames waiting for encoding. Defaults to twice the number of workers
+        """
+        img_format = img_format.lower().lstrip(".")
+        if img_format == "jpeg":
+            img_format = "jpg"
+        if use_alpha and img_format not in ALPHA_IMAGE_FORMATS:
+            img_format = "png"
+
+        self.output_dir = output_dir
+        self.img_format = img_format
+        self.use_alpha = use_alpha
+        self.save_params = {}
+        if img_format == "png" and compress_level is not None:
+            self.save_params["compress_level"] = compress_level
+        if img_format in ["jpg", "webp"] and quality is not None:
+            self.save_params["quality"] = quality
+
+        if num_workers is None:
+            num_workers = min(8, os.cpu_count() or 1)
+        if max_in_flight is None:
+            max_in_flight = num_workers * 2
+
+        os.makedirs(output_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="frame_writer")
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._futures: List[Future] = []
+
+    @property
+    def frame_ext(self) -> str:
+        """File extension of the written frames."""
+        return f".{self.img_format}"
+
+    def write(self, image: np.ndarray, index: int) -> str:
+        """
+        Queue the frame for writing. Blocks while max_in_flight frames are waiting.
+
+        Args:
+            image: Frame image. It must not be modified after it's queued
+            index: Frame index used as the file name
+
+        Returns:
+            Path of the frame file
+        """
+        output_path = os.path.join(self.output_dir, f"{index:05d}{self.frame_ext}")
+        self._in_flight.acquire()
+        try:
+            future = self._executor.submit(self._save, image, output_path)
+        except Exception:
+            self._in_flight.release()
+            raise
+        future.add_done_callback(lambda _: self._in_flight.release())
+        self._futures.append(future)
+        return output_path
+
+    def close(self):
+        """Wait for all queued frames, and raise the first error while writing."""
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._futures.clear()
+            self._executor.shutdown(wait=True)
+
+    def _save(self, image: np.ndarray, output_path: str):
+        if self.use_alpha:
+            image = image.astype(np.uint8)
+        pil_image = Image.fromarray(image)
+        if self.img_format == "jpg" and pil_image.mode != "RGB":
+            pil_image = pil_image.convert("RGB")
+        temp_path = output_path + ".part"
+        pil_image.save(temp_path, format=Image.registered_extensions()[self.frame_ext], **self.save_params)
+        os.replace(temp_path, output_path)
+
+    def __enter__(self) -> "FrameWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,113 @@
+"""Video inference state helpers for incremental prompt edits and frame feature reuse."""
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Number of frames whose image features are kept in the video inference state. SAM2 keeps only the last frame.
+DEFAULT_FEATURE_CACHE_SIZE = 4
+
+# Object id -> frame index -> prompt data with "points", "labels" and "box" keys
+VideoPrompts = Dict[int, Dict[int, Dict[str, Optional[np.ndarray]]]]
+
+
+class FeatureCache(OrderedDict):
+    """
+    Frame index -> image features LRU cache, used as the "cached_features" of the video inference state.
+    Missing frames are looked up with the fallback, e.g. the features precomputed in the background, before SAM2
+    encodes the frame itself.
+    """
+
+    def __init__(self,
+                 max_size: int = DEFAULT_FEATURE_CACHE_SIZE,
+                 fallback: Optional[Callable[[int], Optional[Any]]] = None):
+        super().__init__()
+        self.max_size = max(1, max_size)
+        self.fallback = fallback
+
+    def get(self, key, default=None):
+        if key not in self:
+            value = self.fallback(key) if self.fallback is not None else None
+            if value is None:
+                return default
+            self[key] = value
+        self.move_to_end(key)
+        return self[key]
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
+
+class VideoInferenceState(dict):
+    """
+    Video inference state from SAM2VideoPredictor.init_state() that keeps the image features of the most recently
+    used frames. SAM2 replaces "cached_features" with the features of the last frame on every cache miss, and the
+    replacement is merged into the LRU cache instead, so the features of the prompted frames and the frames around
+    them are reused by later prompt edits and renders.
+    """
+
+    def __init__(self,
+                 state: Dict[str, Any],
+                 max_cached_features: int = DEFAULT_FEATURE_CACHE_SIZE,
+                 feature_fallback: Optional[Callable[[int], Optional[Any]]] = None):
+        """
+        Args:
+            state: Inference state from init_state()
+            max_cached_features: Number of frames whose image features are kept
+            feature_fallback: Returns the (image, backbone output) features of a frame that isn't in the cache, or
+                None to let SAM2 encode the frame
+        """
+        super().__init__(state)
+        cache = FeatureCache(max_cached_features, fallback=feature_fallback)
+        cache.update(state.get("cached_features", {}))
+        super().__setitem__("cached_features", cache)
+
+    def __setitem__(self, key, value):
+        cache = self.get("cached_features")
+        if key == "cached_features" and isinstance(cache, FeatureCache):
+            if value is not cache:
+                cache.update(value)
+            return
+        super().__setitem__(key, value)
+
+
+def is_same_prompt(a: Dict[str, Optional[np.ndarray]], b: Dict[str, Optional[np.ndarray]]) -> bool:
+    """Whether the prompts have the same points, labels and box."""
+    for key in ["points", "labels", "box"]:
+        value_a, value_b = a.get(key), b.get(key)
+        if value_a is None or value_b is None:
+            if value_a is not value_b:
+                return False
+        elif not np.array_equal(np.asarray(value_a), np.asarray(value_b)):
+            return False
+    return True
+
+
+def diff_video_prompts(applied: VideoPrompts,
+                       registered: VideoPrompts) -> Tuple[List[int], List[Tuple[int, int]], List[Tuple[int, int]]]:
+    """
+    Get the changes from the prompts applied to the inference state to the registered prompts.
+
+    Args:
+        applied: Prompts that are in the inference state
+        registered: Prompts that should be in the inference state
+
+    Returns:
+        Object ids to remove, (object id, frame index) prompts to clear, and (object id, frame index) prompts to add.
+        Changed prompts are cleared and added again.
+    """
+    removed_objects = [obj_id for obj_id in applied if obj_id not in registered]
+    cleared, added = [], []
+    for obj_id, frame_prompts in registered.items():
+        applied_prompts = applied.get(obj_id, {})
+        for frame_idx, prompt in applied_prompts.items():
+            if frame_idx not in frame_prompts or not is_same_prompt(prompt, frame_prompts[frame_idx]):
+                cleared.append((obj_id, frame_idx))
+        for frame_idx, prompt in frame_prompts.items():
+            if frame_idx not in applied_prompts or not is_same_prompt(applied_prompts[frame_idx], prompt):
+                added.append((obj_id, frame_idx))
+    return removed_objects, cleared, added
@@ -1,35 +1,55 @@
 import subprocess
 import os
-from typing import List, Optional, Union
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
 from PIL import Image
 import numpy as np
+import cv2
 from dataclasses import dataclass
-import re
+from fractions import Fraction
 from pathlib import Path
 
 from modules.logger_util import get_logger
+from modules.utils.config_manager import get_config_manager
 from modules.constants import SOUND_FILE_EXT, IMAGE_FILE_EXT
-from modules.paths import TEMP_DIR, TEMP_OUT_DIR
+from modules.paths import TEMP_DIR, TEMP_OUT_DIR, TEMP_PROXY_DIR
 
 logger = get_logger()
 
+# Hue and saturation bins of the frame histograms that shot boundaries are detected from. Brightness is left out, so
+# fades and lighting changes within a shot change the histogram less
+SHOT_HISTOGRAM_BINS = [32, 16]
+
 
 @dataclass
 class VideoInfo:
     num_frames: Optional[int] = None
-    frame_rate: Optional[int] = None
+    frame_rate: Optional[Fraction] = None
     duration: Optional[float] = None
     has_sound: Optional[bool] = None
     codec: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    pix_fmt: Optional[str] = None
+    rotation: int = 0
+    audio_codec: Optional[str] = None
+    audio_sample_rate: Optional[int] = None
+    audio_channels: Optional[int] = None
 
 
 def extract_frames(
     vid_input: str,
     output_temp_dir: str = TEMP_DIR,
-    start_number: int = 0
+    start_number: int = 0,
+    proxy_dir: Optional[str] = None,
+    proxy_max_size: Optional[int] = None
 ):
     """
     Extract frames as jpg files and save them into output_temp_dir. This needs FFmpeg installed.
+    If proxy_dir and proxy_max_size are given, downscaled proxy frames whose longest side is at most proxy_max_size
+    are also saved into proxy_dir, decoding the video only once.
     """
     os.makedirs(output_temp_dir, exist_ok=True)
     output_path = os.path.join(output_temp_dir, "%05d.jpg")
@@ -38,12 +58,33 @@ def extract_frames(
         'ffmpeg',
         '-y',  # Enable overwriting
         '-i', vid_input,
-        '-qscale:v', '2',
-        '-vf', f'scale=iw:ih',
-        '-start_number', str(start_number),
-        f'{output_path}'
     ]
 
+    if proxy_dir is not None and proxy_max_size is not None:
+        os.makedirs(proxy_dir, exist_ok=True)
+        proxy_path = os.path.join(proxy_dir, "%05d.jpg")
+        command += [
+            '-filter_complex',
+            f"[0:v]split=2[full][proxy];"
+            f"[proxy]scale='min({proxy_max_size},iw)':'min({proxy_max_size},ih)'"
+            f":force_original_aspect_ratio=decrease[scaled]",
+            '-map', '[full]',
+            '-qscale:v', '2',
+            '-start_number', str(start_number),
+            f'{output_path}',
+            '-map', '[scaled]',
+            '-qscale:v', '2',
+            '-start_number', str(start_number),
+            f'{proxy_path}'
+        ]
+    else:
+        command += [
+            '-qscale:v', '2',
+            '-vf', f'scale=iw:ih',
+            '-start_number', str(start_number),
+            f'{output_path}'
+        ]
+
     try:
         subprocess.run(command, check=True)
     except subprocess.CalledProcessError as e:
@@ -88,73 +129,121 @@ def extract_sound(
 
 def get_video_info(vid_input: str) -> VideoInfo:
     """
-    Extract video information using ffmpeg.
+    Extract video information by probing the container with ffprobe. Only the headers are read, not the whole file.
+    This needs FFmpeg installed.
     """
     command = [
-        'ffmpeg',
-        '-i', vid_input,
-        '-map', '0:v:0',
-        '-c', 'copy',
-        '-f', 'null',
-        '-'
+        'ffprobe',
+        '-v', 'error',
+        '-print_format', 'json',
+        '-show_format',
+        '-show_streams',
+        vid_input
     ]
 
     try:
         result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                                 encoding='utf-8', errors='replace', check=True)
-        output = result.stderr
-
-        num_frames = None
-        frame_rate = None
-        duration = None
-        has_sound = False
-        codec = None
-
-        for line in output.splitlines():
-            if 'Stream #0:0' in line and 'Video:' in line:
-                fps_match = re.search(r'(\d+(?:\.\d+)?) fps', line)
-                if fps_match:
-                    frame_rate = int(float(fps_match.group(1)))
-
-                codec_match = re.search(r'Video: (\w+)', line)
-                if codec_match:
-                    codec = codec_match.group(1)
-
-            elif 'Duration:' in line:
-                duration_match = re.search(
-                    r'Duration: (\d{2}):(\d{2}):(\d{2}\.\d{2})', line)
-                if duration_match:
-                    h, m, s = map(float, duration_match.groups())
-                    duration = h * 3600 + m * 60 + s
-
-            elif 'Stream' in line and 'Audio:' in line:
-                has_sound = True
-
-        if frame_rate and duration:
-            num_frames = int(frame_rate * duration)
-
-        return VideoInfo(
-            num_frames=num_frames,
-            frame_rate=frame_rate,
-            duration=duration,
-            has_sound=has_sound,
-            codec=codec
-        )
+        return parse_video_info(json.loads(result.stdout))
 
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, json.JSONDecodeError) as e:
         logger.exception("Error occurred while getting info from the video")
         return VideoInfo()
 
 
+def parse_video_info(probe: Dict) -> VideoInfo:
+    """
+    Parse the JSON output of ffprobe with "-show_format -show_streams" into VideoInfo.
+    The frame rate is kept as a fraction, e.g. 30000/1001 for 29.97 fps.
+    """
+    streams = probe.get("streams", [])
+    video_stream = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio_stream = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    container = probe.get("format", {})
+
+    if video_stream is None:
+        logger.error("No video stream found while getting info from the video")
+        return VideoInfo(has_sound=audio_stream is not None)
+
+    frame_rate = None
+    for key in ["avg_frame_rate", "r_frame_rate"]:
+        rate = _parse_fraction(video_stream.get(key))
+        if rate:
+            frame_rate = rate
+            break
+
+    duration = _parse_float(video_stream.get("duration"))
+    if duration is None:
+        duration = _parse_float(container.get("duration"))
+
+    num_frames = _parse_int(video_stream.get("nb_frames"))
+    if not num_frames and frame_rate and duration:
+        num_frames = round(duration * frame_rate)
+
+    rotation = _parse_int(video_stream.get("tags", {}).get("rotate"))
+    if rotation is None:
+        for side_data in video_stream.get("side_data_list", []):
+            if "rotation" in side_data:
+                rotation = _parse_int(side_data["rotation"])
+                break
+
+    return VideoInfo(
+        num_frames=num_frames,
+        frame_rate=frame_rate,
+        duration=duration,
+        has_sound=audio_stream is not None,
+        codec=video_stream.get("codec_name"),
+        width=_parse_int(video_stream.get("width")),
+        height=_parse_int(video_stream.get("height")),
+        pix_fmt=video_stream.get("pix_fmt"),
+        rotation=rotation % 360 if rotation else 0,
+        audio_codec=audio_stream.get("codec_name") if audio_stream else None,
+        audio_sample_rate=_parse_int(audio_stream.get("sample_rate")) if audio_stream else None,
+        audio_channels=_parse_int(audio_stream.get("channels")) if audio_stream else None
+    )
+
+
+def _parse_fraction(value: Optional[str]) -> Optional[Fraction]:
+    """Parse ffprobe rational like "30000/1001". Returns None for missing or "0/0" values."""
+    try:
+        fraction = Fraction(value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return fraction if fraction > 0 else None
+
+
+def _parse_float(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_int(value: Optional[Union[str, int, float]]) -> Optional[int]:
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
 def create_video_from_frames(
     frames_dir: str,
-    frame_rate: Optional[int] = None,
+    frame_rate: Optional[Union[int, Fraction]] = None,
     sound_path: Optional[str] = None,
     output_dir: Optional[str] = None,
     output_mime_type: Optional[str] = None,
+    sound_start_time: Optional[float] = None,
+    start_number: int = 0,
+    max_workers: Optional[int] = None,
+    frame_ext: str = ".png",
 ):
     """
     Create a video from frames and save it to the output_path. This needs FFmpeg installed.
+    If sound_start_time is given, the sound is muxed from that time in seconds, for videos rendered from a frame span.
+    start_number is the number of the first frame file name, and frame_ext is the extension of the frame files.
+    Long outputs are split into GOP aligned segments that are encoded by parallel ffmpeg workers and concatenated
+    without re-encoding. Encoder options per format are read from the "video_encoding" section of
+    default_hparams.yaml, and max_workers overrides the configured number of workers.
     """
     if not os.path.exists(frames_dir):
         raise RuntimeError("frames_dir does not exist")
@@ -163,7 +252,7 @@ def create_video_from_frames(
         output_dir = TEMP_OUT_DIR
     os.makedirs(output_dir, exist_ok=True)
 
-    frame_img_mime_type = ".png"
+    frame_img_mime_type = frame_ext
     pix_format = "yuv420p"
     vid_codec, audio_codec = "libx264", "aac"
 
@@ -195,34 +284,77 @@ def create_video_from_frames(
     if frame_rate is None:
         frame_rate = 25  # Default frame rate for ffmpeg
 
-    command = [
-        'ffmpeg',
-        '-y',
-        '-framerate', str(frame_rate),
-        '-i', os.path.join(frames_dir, f"%05d{frame_img_mime_type}"),
-        '-c:v', vid_codec,
-    ]
+    use_sound = output_mime_type != ".gif" and sound_path is not None
+
+    encoding_config = get_config_manager().video_encoding
+    format_config = encoding_config.get("formats", {}).get(output_mime_type.lstrip("."), {})
+    threads = int(format_config.get("threads", 0))
 
+    video_args = ['-c:v', vid_codec]
     if output_mime_type == ".gif":
-        command += [
+        video_args += [
             "-filter_complex", "[0:v] palettegen=reserve_transparent=on [p]; [0:v][p] paletteuse",
             "-loop", "0"
         ]
     else:
-        command += [
+        video_args += [
             '-pix_fmt', pix_format
         ]
+    for key, value in (format_config.get("options") or {}).items():
+        video_args += [f'-{key}', str(value)]
+    if threads > 0:
+        video_args += ['-threads', str(threads)]
+
+    frames_pattern = os.path.join(frames_dir, f"%05d{frame_img_mime_type}")
+    frame_numbers = [os.path.splitext(name)[0] for name in os.listdir(frames_dir) if name.endswith(frame_img_mime_type)]
+    num_frames = len([number for number in frame_numbers if number.isdigit() and int(number) >= start_number])
+
+    if max_workers is None:
+        max_workers = int(encoding_config.get("max_workers", 0))
+    if max_workers <= 0:
+        max_workers = max(1, (os.cpu_count() or 1) // max(threads, 1))
+
+    gop_size = max(1, round(float(frame_rate) * float(encoding_config.get("gop_seconds", 2))))
+    segment_frames = int(encoding_config.get("segment_frames", 0))
+    segments = []
+    if output_mime_type != ".gif" and max_workers > 1 and segment_frames > 0:
+        segments = get_encoding_segments(start_number, num_frames, segment_frames, gop_size, max_workers)
+
+    if len(segments) > 1:
+        try:
+            encode_video_segments(
+                frames_pattern=frames_pattern,
+                frame_rate=frame_rate,
+                segments=segments,
+                video_args=video_args + ['-g', str(gop_size)],
+                output_path=output_path,
+                sound_path=sound_path if use_sound else None,
+                sound_start_time=sound_start_time,
+                audio_codec=audio_codec,
+                max_workers=max_workers
+            )
+        except subprocess.CalledProcessError as e:
+            logger.exception("Error occurred while creating video from frames")
+        return output_path
+
+    command = [
+        'ffmpeg',
+        '-y',
+        '-framerate', str(frame_rate),
+        '-start_number', str(start_number),
+        '-i', frames_pattern,
+    ]
+
+    if use_sound:
+        command += get_sound_input_args(sound_path, sound_start_time)
+
+    command += video_args
+
+    if use_sound:
+        command += get_sound_output_args(audio_codec)
 
     command += [output_path]
 
-    if output_mime_type != ".gif" and sound_path is not None:
-        command += [
-            '-i', sound_path,
-            '-c:a', audio_codec,
-            '-strict', 'experimental',
-            '-b:a', '192k',
-            '-shortest'
-        ]
     try:
         subprocess.run(command, check=True)
     except subprocess.CalledProcessError as e:
@@ -230,6 +362,162 @@ def create_video_from_frames(
     return output_path
 
 
+def get_encoding_segments(
+    start_number: int,
+    num_frames: int,
+    segment_frames: int,
+    gop_size: int,
+    max_workers: int
+) -> List[Tuple[int, int]]:
+    """
+    Split the frames into segments for parallel encoding. Segments are at least segment_frames long and a multiple
+    of gop_size, and there are about as many segments as workers. Returns (first frame number, number of frames) of
+    each segment, or a single segment if the output is too short to split.
+    """
+    if num_frames < 2 * segment_frames:
+        return [(start_number, num_frames)]
+
+    length = max(segment_frames, -(-num_frames // max_workers))
+    length = -(-length // gop_size) * gop_size
+
+    segments = []
+    for offset in range(0, num_frames, length):
+        segments.append((start_number + offset, min(length, num_frames - offset)))
+    return segments
+
+
+def encode_video_segments(
+    frames_pattern: str,
+    frame_rate: Union[int, Fraction],
+    segments: List[Tuple[int, int]],
+    video_args: List[str],
+    output_path: str,
+    sound_path: Optional[str] = None,
+    sound_start_time: Optional[float] = None,
+    audio_codec: Optional[str] = None,
+    max_workers: int = 1
+):
+    """
+    Encode each segment with its own ffmpeg process in parallel, then concatenate the segments with stream copy
+    and mux the sound into the output. This needs FFmpeg installed.
+    """
+    segment_dir = os.path.join(TEMP_DIR, "segments")
+    shutil.rmtree(segment_dir, ignore_errors=True)
+    os.makedirs(segment_dir, exist_ok=True)
+    ext = os.path.splitext(output_path)[1]
+
+    def encode_segment(index: int, segment: Tuple[int, int]) -> str:
+        first_frame, num_frames = segment
+        segment_path = os.path.join(segment_dir, f"{index:05d}{ext}")
+        command = [
+            'ffmpeg',
+            '-y',
+            '-framerate', str(frame_rate),
+            '-start_number', str(first_frame),
+            '-i', frames_pattern,
+            '-frames:v', str(num_frames),
+        ] + video_args + [segment_path]
+        try:
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except subprocess.CalledProcessError as e:
+            stderr = e.stderr.decode(errors="replace") if e.stderr else ""
+            logger.error(f"Error occurred while encoding video segment {index} "
+                         f"(frames {first_frame}-{first_frame + num_frames - 1}): {stderr}")
+            raise
+        return segment_path
+
+    logger.info(f"Encoding {len(segments)} segments with {max_workers} workers")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        segment_paths = list(executor.map(encode_segment, range(len(segments)), segments))
+
+    list_path = os.path.join(segment_dir, "segments.txt")
+    with open(list_path, "w", encoding="utf-8") as f:
+        for segment_path in segment_paths:
+            f.write(f"file '{segment_path}'\n")
+
+    command = [
+        'ffmpeg',
+        '-y',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', list_path,
+    ]
+    if sound_path is not None:
+        command += get_sound_input_args(sound_path, sound_start_time)
+    command += ['-c:v', 'copy']
+    if sound_path is not None:
+        command += get_sound_output_args(audio_codec)
+    command += [output_path]
+
+    try:
+        subprocess.run(command, check=True)
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+
+def get_sound_input_args(sound_path: str,
+                         sound_start_time: Optional[float] = None) -> List[str]:
+    """Get ffmpeg arguments to add the sound as the second input."""
+    args = []
+    if sound_start_time:
+        args += ['-ss', f"{sound_start_time:.3f}"]
+    return args + ['-i', sound_path]
+
+
+def get_sound_output_args(audio_codec: str) -> List[str]:
+    """Get ffmpeg arguments to mux the video of the first input with the sound of the second input."""
+    return [
+        '-map', '0:v:0',
+        '-map', '1:a:0',
+        '-c:a', audio_codec,
+        '-strict', 'experimental',
+        '-b:a', '192k',
+        '-shortest'
+    ]
+
+
+def get_frame_histogram(frame_path: str) -> np.ndarray:
+    """Get the hue-saturation histogram of the frame, decoded at a quarter of its resolution."""
+    image = cv2.imread(frame_path, cv2.IMREAD_REDUCED_COLOR_4)
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    return cv2.calcHist([hsv], [0, 1], None, SHOT_HISTOGRAM_BINS, [0, 180, 0, 256])
+
+
+def get_region_histogram(frame_path: str, mask: np.ndarray) -> np.ndarray:
+    """Get the hue-saturation histogram of the masked region of the frame. The mask is resized to the frame."""
+    image = cv2.imread(frame_path)
+    mask = cv2.resize(np.asarray(mask, dtype=np.uint8), (image.shape[1], image.shape[0]),
+                      interpolation=cv2.INTER_NEAREST)
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    return cv2.calcHist([hsv], [0, 1], mask, SHOT_HISTOGRAM_BINS, [0, 180, 0, 256])
+
+
+def detect_shots(frame_paths: List[str],
+                 threshold: float = 0.5,
+                 min_shot_frames: int = 1) -> List[Tuple[int, int]]:
+    """
+    Split the video into shots at hard cuts. A cut is where the Bhattacharyya distance between the histograms of
+    consecutive frames is over the threshold. Returns (first frame index, last frame index) of each shot, both
+    inclusive, or a single shot if the threshold is 0.
+    """
+    if not frame_paths:
+        return []
+    if not threshold:
+        return [(0, len(frame_paths) - 1)]
+
+    shot_starts = [0]
+    previous_hist = get_frame_histogram(frame_paths[0])
+    for frame_idx in range(1, len(frame_paths)):
+        hist = get_frame_histogram(frame_paths[frame_idx])
+        distance = cv2.compareHist(previous_hist, hist, cv2.HISTCMP_BHATTACHARYYA)
+        if distance > threshold and frame_idx - shot_starts[-1] >= min_shot_frames:
+            shot_starts.append(frame_idx)
+        previous_hist = hist
+
+    shot_ends = [start - 1 for start in shot_starts[1:]] + [len(frame_paths) - 1]
+    return list(zip(shot_starts, shot_ends))
+
+
 def get_frames_from_dir(vid_dir: str,
                         available_extensions: Optional[Union[List, str]] = None,
                         as_numpy: bool = False) -> List:
@@ -260,12 +548,16 @@ def clean_temp_dir(temp_dir: Optional[str] = None):
     if temp_dir is None:
         temp_dir = TEMP_DIR
         temp_out_dir = TEMP_OUT_DIR
+        temp_proxy_dir = TEMP_PROXY_DIR
     else:
         temp_out_dir = os.path.join(temp_dir, "out")
+        temp_proxy_dir = os.path.join(temp_dir, "proxy")
 
     clean_files_with_extension(temp_dir, SOUND_FILE_EXT)
     clean_files_with_extension(temp_dir, IMAGE_FILE_EXT)
     clean_files_with_extension(temp_out_dir, IMAGE_FILE_EXT)
+    if os.path.exists(temp_proxy_dir):
+        clean_files_with_extension(temp_proxy_dir, IMAGE_FILE_EXT)
 
 
 def clean_files_with_extension(dir_path: str, extensions: List):
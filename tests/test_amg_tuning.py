@@ -0,0 +1,85 @@
+import json
+
+import pytest
+import numpy as np
+
+from modules import amg_tuning
+from modules.amg_tuning import (calibrate_points_per_batch, get_points_per_batch, get_host_key, get_process_memory,
+                                measure_peak_process_memory, sweep_amg_params, format_sweep_report,
+                                MIN_POINTS_PER_BATCH, MAX_POINTS_PER_BATCH, FALLBACK_POINTS_PER_BATCH,
+                                CALIBRATION_MAX_AGE_SECONDS)
+
+
+@pytest.mark.parametrize(
+    "bytes_per_point,available_memory,expected",
+    [
+        (1000, 1000 * 100 / 0.6, 96),
+        (1000, 1000, MIN_POINTS_PER_BATCH),
+        (1000, 10 ** 12, MAX_POINTS_PER_BATCH),
+        (1000, None, FALLBACK_POINTS_PER_BATCH),
+    ]
+)
+def test_calibrate_points_per_batch(bytes_per_point: int, available_memory, expected: int):
+    assert calibrate_points_per_batch(bytes_per_point, available_memory) == expected
+
+
+def test_get_points_per_batch_is_cached(tmp_path, monkeypatch):
+    measured = []
+
+    def measure_bytes_per_point(model, crop_size, device):
+        measured.append(list(crop_size))
+        return 1000
+
+    monkeypatch.setattr(amg_tuning, "measure_bytes_per_point", measure_bytes_per_point)
+    monkeypatch.setattr(amg_tuning, "get_available_memory", lambda device: 1000 * 100 / 0.6)
+    cache_path = str(tmp_path / "amg_tuning.json")
+    assert get_points_per_batch(None, "sam2.1_hiera_tiny", (1000, 1500), "cpu", cache_path=cache_path) == 96
+    assert measured == [[1024, 1536]]
+
+    with open(cache_path) as f:
+        cache = json.load(f)
+    (host_key, entries), = cache.items()
+    assert host_key == get_host_key("cpu")
+    assert list(entries) == ["sam2.1_hiera_tiny|1024x1536"]
+
+    # Similar crop sizes share the measurement, and the batch size follows the available memory
+    monkeypatch.setattr(amg_tuning, "get_available_memory", lambda device: 1000 * 200 / 0.6)
+    assert get_points_per_batch(None, "sam2.1_hiera_tiny", (1024, 1400), "cpu", cache_path=cache_path) == 192
+    assert len(measured) == 1
+
+    # Old measurements are measured again
+    entries["sam2.1_hiera_tiny|1024x1536"]["calibrated_at"] -= CALIBRATION_MAX_AGE_SECONDS
+    with open(cache_path, "w") as f:
+        json.dump(cache, f)
+    get_points_per_batch(None, "sam2.1_hiera_tiny", (1000, 1500), "cpu", cache_path=cache_path)
+    assert len(measured) == 2
+
+
+def test_get_points_per_batch_falls_back_on_error(tmp_path):
+    cache_path = str(tmp_path / "amg_tuning.json")
+    # The calibration fails without a model
+    assert get_points_per_batch(None, "sam2.1_hiera_tiny", (512, 512), "cpu",
+                                cache_path=cache_path) == FALLBACK_POINTS_PER_BATCH
+
+
+@pytest.mark.skipif(get_process_memory() is None, reason="The resident memory can't be read on this platform")
+def test_measure_peak_process_memory():
+    result, peak = measure_peak_process_memory(lambda: np.ones(64 * 1024 ** 2, dtype=np.uint8).sum())
+
+    assert result == 64 * 1024 ** 2
+    assert peak >= 32 * 1024 ** 2
+
+
+def test_sweep_report():
+    def generate(image, points_per_side, points_per_batch):
+        if points_per_batch > 64:
+            raise RuntimeError("out of memory")
+        return [{}] * points_per_side
+
+    rows = sweep_amg_params(generate, np.zeros((8, 8, 3)), [4, 8], [32, 128])
+
+    assert [(row["points_per_side"], row["points_per_batch"]) for row in rows] == [(4, 32), (4, 128), (8, 32), (8, 128)]
+    assert rows[2]["num_masks"] == 8
+    report = format_sweep_report(rows)
+    assert len(report.splitlines()) == 6
+    assert "error: out of memory" in report
@@ -0,0 +1,50 @@
+import os
+
+import torch
+from sam2.build_sam import build_sam2
+
+from test_config import *
+from modules.paths import *
+from modules import checkpoint_cache
+from modules.checkpoint_cache import (load_mmap_weights, load_mmap_state_dict, load_checkpoint_index,
+                                      save_checkpoint_index, TORCH_MMAP_FORMAT)
+
+
+def test_load_mmap_weights(tmp_path, monkeypatch):
+    torch.manual_seed(0)
+    source_model = build_sam2(config_file=MODEL_CONFIGS[TEST_MODEL], ckpt_path=None, device="cpu")
+    model_path = str(tmp_path / "model.pt")
+    torch.save({"model": source_model.state_dict()}, model_path)
+
+    torch.manual_seed(1)
+    model = build_sam2(config_file=MODEL_CONFIGS[TEST_MODEL], ckpt_path=None, device="cpu")
+    load_mmap_weights(model, model_path, str(tmp_path))
+    for key, value in source_model.state_dict().items():
+        assert torch.equal(model.state_dict()[key], value)
+
+    entry = load_checkpoint_index(str(tmp_path))["model.pt"]
+    assert os.path.exists(os.path.join(str(tmp_path), entry["path"]))
+
+    # Later loads map the converted checkpoint without converting again
+    converted = []
+    monkeypatch.setattr(checkpoint_cache, "convert_checkpoint", lambda *args: converted.append(args))
+    load_mmap_weights(model, model_path, str(tmp_path))
+    assert not converted
+
+
+def test_safetensors_checkpoint_without_safetensors(tmp_path, monkeypatch):
+    model_path = str(tmp_path / "model.pt")
+    weight = torch.arange(6, dtype=torch.float32)
+    torch.save({"model": {"weight": weight}}, model_path)
+    load_mmap_state_dict(model_path, str(tmp_path))
+
+    # The index points to a safetensors checkpoint that was converted while safetensors was installed
+    index = load_checkpoint_index(str(tmp_path))
+    (tmp_path / "model.safetensors").write_bytes(b"")
+    index["model.pt"].update(path="model.safetensors", format="safetensors")
+    save_checkpoint_index(index, str(tmp_path))
+    monkeypatch.setattr(checkpoint_cache, "is_safetensors_available", lambda: False)
+
+    state_dict = load_mmap_state_dict(model_path, str(tmp_path))
+    assert torch.equal(state_dict["weight"], weight)
+    assert load_checkpoint_index(str(tmp_path))["model.pt"]["format"] == TORCH_MMAP_FORMAT
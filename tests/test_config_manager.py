@@ -0,0 +1,51 @@
+import pytest
+
+from modules.exceptions import ConfigurationError
+from modules.utils.config_manager import get_config_manager, merge_configs
+from modules.sam_inference import SamInference
+
+
+def test_merge_configs():
+    base = {"a": 1, "nested": {"b": 2, "c": 3}}
+    merged = merge_configs(base, {"nested": {"c": 4}, "d": 5})
+
+    assert merged == {"a": 1, "nested": {"b": 2, "c": 4}, "d": 5}
+    assert base == {"a": 1, "nested": {"b": 2, "c": 3}}
+
+
+@pytest.mark.parametrize("profile", ["default", "interactive", "batch-throughput", "low-memory"])
+def test_profiles(profile: str):
+    config_manager = get_config_manager()
+    base_hparams = config_manager.mask_hparams
+    try:
+        config_manager.set_profile(profile)
+        overrides = config_manager.get_profile(profile).get("mask_hparams", {})
+        mask_hparams = config_manager.mask_hparams
+
+        assert set(mask_hparams) == set(base_hparams)
+        for key, value in mask_hparams.items():
+            assert value == overrides.get(key, base_hparams[key])
+        assert "formats" in config_manager.video_encoding
+    finally:
+        config_manager.set_profile(None)
+
+    assert config_manager.mask_hparams == base_hparams
+    assert config_manager.profile_settings == {}
+
+
+def test_unknown_profile():
+    with pytest.raises(ConfigurationError):
+        get_config_manager().set_profile("unknown")
+    assert get_config_manager().active_profile is None
+
+
+def test_profile_keeps_fixed_settings():
+    sam_inference = SamInference(keyframe_stride=2)
+    sam_inference.fixed_settings = {"keyframe_stride"}
+    try:
+        sam_inference.apply_profile("batch-throughput")
+    finally:
+        get_config_manager().set_profile(None)
+
+    assert sam_inference.keyframe_stride == 2
+    assert sam_inference.proxy_max_size == 1024
@@ -0,0 +1,37 @@
+import os
+import pytest
+import numpy as np
+from PIL import Image
+
+from modules.utils import FrameWriter, save_image
+
+
+@pytest.mark.parametrize(
+    "img_format,use_alpha,expected_ext,expected_mode",
+    [
+        ("png", False, ".png", "RGB"),
+        ("bmp", False, ".bmp", "RGB"),
+        ("jpg", True, ".png", "RGBA"),
+    ]
+)
+def test_frame_writer(img_format: str, use_alpha: bool, expected_ext: str, expected_mode: str, tmp_path):
+    channels = 4 if use_alpha else 3
+    indices = [7, 3, 5, 4, 6]
+    with FrameWriter(str(tmp_path), img_format=img_format, compress_level=1, use_alpha=use_alpha,
+                     num_workers=2, max_in_flight=2) as writer:
+        for index in indices:
+            writer.write(np.full((16, 24, channels), index * 10, dtype=np.uint8), index=index)
+
+    assert writer.frame_ext == expected_ext
+    assert sorted(os.listdir(tmp_path)) == [f"{index:05d}{expected_ext}" for index in sorted(indices)]
+    image = Image.open(os.path.join(tmp_path, f"00005{expected_ext}"))
+    assert image.mode == expected_mode
+    assert np.array(image)[0, 0, 0] == 50
+
+
+def test_save_image_with_index(tmp_path):
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    output_path = save_image(image, output_dir=str(tmp_path), index=12)
+
+    assert output_path == os.path.join(str(tmp_path), "00012.png")
+    assert os.path.exists(output_path)
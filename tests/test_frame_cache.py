@@ -0,0 +1,35 @@
+import time
+
+import numpy as np
+from PIL import Image
+
+from modules.frame_cache import FrameCache
+
+
+def test_frame_cache(tmp_path):
+    for i in range(6):
+        Image.fromarray(np.full((400, 800, 3), i * 40, dtype=np.uint8)).save(tmp_path / f"{i:05d}.jpg")
+
+    frame_cache = FrameCache(preview_max_size=200, cache_size=4, prefetch_frames=1)
+    frame_cache.build_index(str(tmp_path))
+
+    assert len(frame_cache) == 6
+    assert frame_cache.scale == 0.25
+
+    preview = frame_cache.get_preview(2)
+    assert preview.size == (200, 100)
+    assert np.allclose(np.array(preview), 80, atol=2)
+
+    # Neighbouring frames are prefetched in the background
+    for _ in range(50):
+        if 1 in frame_cache._cache and 3 in frame_cache._cache:
+            break
+        time.sleep(0.1)
+    assert 1 in frame_cache._cache and 3 in frame_cache._cache
+
+    for i in range(6):
+        frame_cache.get_preview(i)
+    assert len(frame_cache._cache) <= 4
+
+    box = frame_cache.to_full_resolution(np.array([[10, 20, 50, 60]]))
+    assert np.array_equal(box, [[40, 80, 200, 240]])
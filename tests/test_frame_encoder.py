@@ -0,0 +1,65 @@
+import threading
+
+import torch
+
+from modules.frame_encoder import BackgroundFrameEncoder
+from modules.video_state import VideoInferenceState
+
+
+def encode_frame(frame_idx: int):
+    return {
+        "backbone_fpn": [torch.full((1, 4, 8, 8), float(frame_idx))],
+        "vision_pos_enc": [torch.ones((1, 4, 8, 8))],
+    }
+
+
+def test_frame_encoder_stops_at_budget():
+    # A frame of features is 1 KB
+    encoder = BackgroundFrameEncoder(encode_frame, budget_mb=3 / 1024)
+    encoder.start(range(10))
+    encoder._thread.join()
+    assert encoder.num_encoded == 3
+    assert encoder.get(9, device="cpu") is None
+    features = encoder.get(2, device="cpu")
+    assert torch.equal(features["backbone_fpn"][0], torch.full((1, 4, 8, 8), 2.0))
+    assert features["vision_pos_enc"][0] is encoder.get(1, device="cpu")["vision_pos_enc"][0]
+
+
+def test_frame_encoder_waits_while_paused():
+    started = threading.Event()
+
+    def encode(frame_idx: int):
+        started.set()
+        return encode_frame(frame_idx)
+
+    encoder = BackgroundFrameEncoder(encode)
+    with encoder.paused():
+        encoder.start(range(5))
+        assert not started.wait(timeout=0.2)
+        assert encoder.num_encoded == 0
+    encoder._thread.join()
+    assert encoder.num_encoded == 5
+
+    # Stopping a paused encoder abandons the remaining frames
+    encoder = BackgroundFrameEncoder(encode_frame)
+    with encoder.paused():
+        encoder.start(range(5))
+        encoder.stop(wait=True)
+    assert encoder.num_encoded == 0
+
+
+def test_video_inference_state_uses_feature_fallback():
+    encoder = BackgroundFrameEncoder(encode_frame)
+    encoder.start([1])
+    encoder._thread.join()
+
+    def fallback(frame_idx: int):
+        backbone_out = encoder.get(frame_idx, device="cpu")
+        return ("image", backbone_out) if backbone_out is not None else None
+
+    state = VideoInferenceState({"cached_features": {0: "features-0"}}, max_cached_features=2,
+                                feature_fallback=fallback)
+    image, backbone_out = state["cached_features"].get(1, (None, None))
+    assert image == "image" and torch.equal(backbone_out["backbone_fpn"][0], torch.ones((1, 4, 8, 8)))
+    assert list(state["cached_features"]) == [0, 1]
+    assert state["cached_features"].get(2, (None, None)) == (None, None)
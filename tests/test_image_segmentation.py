@@ -6,6 +6,9 @@ from test_config import *
 import numpy as np
 from modules.paths import *
 from modules.constants import *
+from modules import onnx_backend
+from modules.onnx_backend import ONNX_BACKEND
+from modules.exceptions import ModelLoadError
 from modules.sam_inference import SamInference
 
 
@@ -51,7 +54,54 @@ def test_image_segmentation(
     assert isinstance(logits, np.ndarray)
 
 
+def test_prompt_refinement_reuses_embedding_and_logits(monkeypatch):
+    import torch
+    from sam2.build_sam import build_sam2
+    from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+    torch.manual_seed(0)
+    inferencer = SamInference()
+    inferencer.device = "cpu"
+    inferencer.model = build_sam2(config_file=MODEL_CONFIGS[TEST_MODEL], ckpt_path=None, device="cpu")
+    inferencer.current_model_type = TEST_MODEL
+
+    set_image_calls, mask_inputs = [], []
+    set_image, predict = SAM2ImagePredictor.set_image, SAM2ImagePredictor.predict
+    monkeypatch.setattr(SAM2ImagePredictor, "set_image",
+                        lambda self, image: set_image_calls.append(1) or set_image(self, image))
+    monkeypatch.setattr(SAM2ImagePredictor, "predict",
+                        lambda self, **kwargs: mask_inputs.append(kwargs["mask_input"]) or predict(self, **kwargs))
+
+    image = np.random.randint(0, 255, (96, 128, 3), dtype=np.uint8)
+    points = np.array([[40., 30.], [80., 60.], [100., 20.]])
+    labels = np.array([1., 0., 1.])
+    outputs = []
+    for num_points in [1, 2, 3, 2]:
+        outputs.append(inferencer.predict_image(image=image, model_type=TEST_MODEL, point_coords=points[:num_points],
+                                                point_labels=labels[:num_points], multimask_output=True))
+
+    assert len(set_image_calls) == 1
+    assert mask_inputs[0] is None
+    history = inferencer.image_sessions[inferencer.get_image_key(image)]
+    # Each click refines the best mask of the prompt before it, and removing a click goes back to its base prompt
+    assert np.array_equal(mask_inputs[1], history[0]["logits"])
+    assert np.array_equal(mask_inputs[2], history[1]["logits"])
+    assert np.array_equal(mask_inputs[3], history[0]["logits"])
+    assert np.array_equal(outputs[3][2], outputs[1][2])
+
+    inferencer.predict_image(image=np.ascontiguousarray(image[::-1]), model_type=TEST_MODEL, point_coords=points[:2],
+                             point_labels=labels[:2], multimask_output=True)
+    assert len(set_image_calls) == 2
+    assert mask_inputs[4] is None
+
+
 def load_image(image_path):
     image = Image.open(image_path).convert('RGB')
     image_array = np.array(image)
     return image_array
+
+
+def test_onnx_backend_requires_onnxruntime(monkeypatch):
+    monkeypatch.setattr(onnx_backend, "is_onnxruntime_available", lambda: False)
+    with pytest.raises(ModelLoadError, match="onnxruntime"):
+        SamInference(backend=ONNX_BACKEND)
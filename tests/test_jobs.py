@@ -0,0 +1,113 @@
+import json
+import threading
+
+import numpy as np
+import pytest
+
+from test_config import *
+from modules.jobs import (VideoJobManager, to_frame_ranges, from_frame_ranges, serialize_prompts,
+                          deserialize_prompts, get_rendered_frames, JOB_INTERRUPTED, JOB_COMPLETED)
+from modules.mask_tracks import get_mask_track_key
+
+
+@pytest.mark.parametrize(
+    "frames,expected_ranges",
+    [
+        ([], []),
+        ([3], [[3, 3]]),
+        ([5, 0, 1, 2, 7, 6, 2], [[0, 2], [5, 7]]),
+    ]
+)
+def test_frame_ranges(frames, expected_ranges):
+    ranges = to_frame_ranges(frames)
+    assert ranges == expected_ranges
+    assert from_frame_ranges(ranges) == set(frames)
+
+
+def test_serialized_prompts_keep_mask_track_key():
+    prompts = {
+        1: {4: {"points": np.array([[10.5, 20.25]]), "labels": np.array([1.0]), "box": None}},
+        0: {0: {"points": None, "labels": None, "box": np.array([[1.0, 2.0, 30.0, 40.0]])}},
+    }
+    data = json.loads(json.dumps(serialize_prompts(prompts)))
+    restored = deserialize_prompts(data)
+
+    assert restored.keys() == prompts.keys()
+    assert get_mask_track_key("video", "model", restored) == get_mask_track_key("video", "model", prompts)
+
+
+def test_rendered_frames_skip_partial_files(tmp_path):
+    for filename in ["00001.png", "00002.png", "00003.png.part", "sound.mp3"]:
+        (tmp_path / filename).write_bytes(b"")
+
+    assert get_rendered_frames(str(tmp_path)) == {1, 2}
+    assert get_rendered_frames(str(tmp_path / "missing")) == set()
+
+
+def test_unfinished_jobs_are_interrupted_on_load(tmp_path):
+    for job_id, status in [("a", "running"), ("b", "queued"), ("c", JOB_COMPLETED)]:
+        with open(tmp_path / f"{job_id}.json", "w") as f:
+            json.dump({"id": job_id, "status": status, "created_at": 0}, f)
+
+    manager = VideoJobManager(sam_inference=None, job_dir=str(tmp_path))
+    try:
+        statuses = {record["id"]: record["status"] for record in manager.list_jobs()}
+    finally:
+        manager.shutdown()
+
+    assert statuses == {"a": JOB_INTERRUPTED, "b": JOB_INTERRUPTED, "c": JOB_COMPLETED}
+    with open(tmp_path / "a.json") as f:
+        assert json.load(f)["status"] == JOB_INTERRUPTED
+
+
+class FakeSamInference:
+    """Records the video and the prompts that are loaded when the job renders."""
+
+    def __init__(self, video_path: str):
+        self.video_lock = threading.RLock()
+        self.video_path = self.video_id = video_path
+        self.current_model_type = "model"
+        self.video_prompts = {}
+        self.loaded_videos = []
+        self.rendered = None
+
+    def register_prompt_data(self, image_prompt_input_data, frame_idx, obj_id):
+        self.video_prompts.setdefault(obj_id, {})[frame_idx] = {"points": np.array(image_prompt_input_data["points"])}
+
+    def init_video_inference_state(self, vid_input, model_type):
+        self.loaded_videos.append(vid_input)
+        self.video_path = self.video_id = vid_input
+        self.current_model_type = model_type
+        self.video_prompts = {}
+
+    def create_filtered_video(self, **kwargs):
+        lock_taken = []
+        thread = threading.Thread(target=lambda: lock_taken.append(self.video_lock.acquire(blocking=False)))
+        thread.start()
+        thread.join()
+        self.rendered = {"video_path": self.video_path, "prompts": serialize_prompts(self.video_prompts),
+                         "lock_taken": lock_taken[0]}
+        return None, "output.mp4"
+
+
+def test_job_restores_ui_video_session(tmp_path):
+    job_video, ui_video = str(tmp_path / "job.mp4"), str(tmp_path / "ui.mp4")
+    open(job_video, "wb").close()
+    sam_inference = FakeSamInference(job_video)
+    manager = VideoJobManager(sam_inference=sam_inference, job_dir=str(tmp_path / "jobs"))
+    try:
+        # The job waits for the lock while the UI loads another video and prompts it
+        with sam_inference.video_lock:
+            job_id = manager.submit({"points": [[1, 2]]}, filter_mode="Pixelize", frame_idx=3)
+            job_prompts = serialize_prompts(sam_inference.video_prompts)
+            sam_inference.init_video_inference_state(vid_input=ui_video, model_type="model")
+            sam_inference.register_prompt_data({"points": [[5, 6]]}, frame_idx=0, obj_id=1)
+            ui_prompts = serialize_prompts(sam_inference.video_prompts)
+    finally:
+        manager.shutdown()
+
+    assert manager.get_job(job_id)["status"] == JOB_COMPLETED
+    assert sam_inference.rendered == {"video_path": job_video, "prompts": job_prompts, "lock_taken": False}
+    assert sam_inference.loaded_videos == [ui_video, job_video, ui_video]
+    assert sam_inference.video_path == ui_video
+    assert serialize_prompts(sam_inference.video_prompts) == ui_prompts
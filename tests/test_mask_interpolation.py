@@ -0,0 +1,59 @@
+import cv2
+import numpy as np
+import pytest
+
+from modules.mask_interpolation import (get_keyframes, compute_flow, warp_to_frame, interpolate_logits,
+                                        needs_full_tracking)
+
+
+def textured_frame(shift_x: int = 0) -> np.ndarray:
+    rng = np.random.RandomState(0)
+    texture = cv2.GaussianBlur(rng.randint(0, 255, (96, 160)).astype(np.uint8), (7, 7), 0)
+    return np.roll(texture, shift_x, axis=1)
+
+
+def square_masks(shift_x: int = 0) -> np.ndarray:
+    masks = np.zeros((1, 1, 96, 160), dtype=bool)
+    masks[0, 0, 30:60, 50 + shift_x:90 + shift_x] = True
+    return masks
+
+
+@pytest.mark.parametrize(
+    "first,last,start,stride,required,expected",
+    [
+        (0, 10, 0, 4, [], [0, 4, 8, 10]),
+        (0, 10, 5, 4, [], [0, 1, 5, 9, 10]),
+        (2, 9, 2, 3, [4, 20], [2, 4, 5, 8, 9]),
+        (0, 3, 0, 1, [], [0, 1, 2, 3]),
+    ]
+)
+def test_get_keyframes(first, last, start, stride, required, expected):
+    assert get_keyframes(first, last, start, stride, required) == expected
+
+
+def test_warp_follows_motion():
+    frame_a, frame_b = textured_frame(), textured_frame(shift_x=4)
+    masks_a, masks_b = square_masks(), square_masks(shift_x=4)
+
+    flow_b_to_a = compute_flow(frame_b, frame_a)
+    warped = warp_to_frame(masks_a.astype(np.float32), flow_b_to_a) > 0.5
+    inner = (slice(None), slice(None), slice(35, 55), slice(60, 88))
+    assert (warped[inner] == masks_b[inner]).all()
+    assert not needs_full_tracking(masks_a, masks_b, flow_b_to_a)
+
+    # Halfway between the keyframes, warped from both sides
+    frame_mid = textured_frame(shift_x=2)
+    logits = interpolate_logits(np.where(masks_a, 10.0, -10.0), np.where(masks_b, 10.0, -10.0),
+                                compute_flow(frame_mid, frame_a), compute_flow(frame_mid, frame_b), weight=0.5)
+    assert ((logits > 0)[inner] == square_masks(shift_x=2)[inner]).all()
+
+
+def test_needs_full_tracking_on_unexplained_mask_change():
+    frame = textured_frame()
+    flow = compute_flow(frame, frame)
+    # The object disappears without any motion
+    assert needs_full_tracking(square_masks(), np.zeros_like(square_masks()), flow)
+    assert not needs_full_tracking(np.zeros_like(square_masks()), np.zeros_like(square_masks()), flow)
+    # Motion larger than the threshold
+    fast_flow = np.full_like(flow, 20.0)
+    assert needs_full_tracking(square_masks(), square_masks(), fast_flow, max_motion=0.05, min_iou=0.0)
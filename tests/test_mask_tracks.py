@@ -0,0 +1,73 @@
+import numpy as np
+
+from modules.mask_tracks import (MaskTrackWriter, MaskCheckpoint, get_mask_track_key, get_mask_track_path,
+                                 get_video_id, load_mask_track)
+
+
+def test_mask_track_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    frames = {
+        frame_idx: (rng.random((2, 1, 30, 45)) > 0.5, [0, 3])
+        for frame_idx in [4, 2, 3]
+    }
+    # Frames of a shot without prompts have no objects
+    frames[5] = (np.zeros((0, 1, 30, 45), dtype=bool), [])
+
+    track_path = get_mask_track_path("test", str(tmp_path))
+    writer = MaskTrackWriter(track_path)
+    for frame_idx, (masks, obj_ids) in frames.items():
+        writer.add(frame_idx, masks, obj_ids)
+    writer.close()
+
+    loaded = list(load_mask_track(track_path))
+    assert [frame_idx for frame_idx, _, _ in loaded] == [2, 3, 4, 5]
+    for frame_idx, masks, obj_ids in loaded:
+        assert np.array_equal(masks, frames[frame_idx][0])
+        assert obj_ids == frames[frame_idx][1]
+
+
+def test_mask_track_logits(tmp_path):
+    rng = np.random.default_rng(0)
+    logits = rng.normal(size=(2, 1, 16, 16)).astype(np.float16)
+
+    track_path = get_mask_track_path("test", str(tmp_path))
+    writer = MaskTrackWriter(track_path)
+    writer.add(0, logits, [0, 1])
+    writer.add(1, logits > 0, [0, 1])
+    writer.close()
+
+    (_, loaded_logits, _), (_, loaded_masks, _) = list(load_mask_track(track_path))
+    assert loaded_logits.dtype == np.float16 and np.array_equal(loaded_logits, logits)
+    assert loaded_masks.dtype == bool and np.array_equal(loaded_masks, logits > 0)
+
+
+def test_mask_checkpoint(tmp_path):
+    rng = np.random.default_rng(0)
+    masks = rng.random((2, 1, 30, 45)) > 0.5
+    logits = rng.normal(size=(1, 1, 16, 16)).astype(np.float16)
+
+    checkpoint = MaskCheckpoint(str(tmp_path / "masks"))
+    checkpoint.add(7, masks, [0, 3])
+    checkpoint.add(2, logits, [1])
+    # A frame that was being written when the render stopped
+    (tmp_path / "masks" / "00009.npz.tmp").write_bytes(b"")
+
+    loaded = list(MaskCheckpoint(str(tmp_path / "masks")).load())
+    assert [(frame_idx, obj_ids) for frame_idx, _, obj_ids in loaded] == [(2, [1]), (7, [0, 3])]
+    assert loaded[0][1].dtype == np.float16 and np.array_equal(loaded[0][1], logits)
+    assert np.array_equal(loaded[1][1], masks)
+
+
+def test_mask_track_key(tmp_path):
+    video_path = tmp_path / "video.mp4"
+    video_path.write_bytes(b"video" * 1000)
+    video_id = get_video_id(str(video_path))
+
+    prompts = {0: {5: {"points": np.array([[10, 20]]), "labels": np.array([1]), "box": None}}}
+    key = get_mask_track_key(video_id, "sam2.1_hiera_tiny", prompts, frame_range=None)
+
+    assert key == get_mask_track_key(video_id, "sam2.1_hiera_tiny", prompts, frame_range=None)
+    assert key != get_mask_track_key(video_id, "sam2.1_hiera_small", prompts, frame_range=None)
+    assert key != get_mask_track_key(video_id, "sam2.1_hiera_tiny", prompts, frame_range=(0, 10))
+    moved_prompts = {0: {5: {"points": np.array([[11, 20]]), "labels": np.array([1]), "box": None}}}
+    assert key != get_mask_track_key(video_id, "sam2.1_hiera_tiny", moved_prompts, frame_range=None)
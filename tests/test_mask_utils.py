@@ -0,0 +1,63 @@
+import pytest
+import cv2
+import numpy as np
+from PIL import Image
+
+from modules.mask_utils import (upsample_mask_logits, create_mask_combined_images, create_mask_gallery,
+                                get_color_lut)
+
+
+@pytest.mark.parametrize("edge_x", [57, 59, 62, 65])
+def test_upsample_mask_logits_follows_guide_edges(edge_x: int):
+    full_h, full_w, proxy_h, proxy_w = 120, 160, 30, 40
+    guide_image = np.zeros((full_h, full_w, 3), dtype=np.uint8)
+    guide_image[:, edge_x:] = 255
+    proxy_image = cv2.resize(guide_image, (proxy_w, proxy_h), interpolation=cv2.INTER_AREA)
+
+    # Hard mask edge on the proxy grid, which can't land on the full resolution edge by interpolation alone
+    logits = np.where(np.arange(proxy_w) >= 15, 6.0, -6.0).astype(np.float32)
+    logits = np.tile(logits, (proxy_h, 1))[None]
+
+    masks = upsample_mask_logits(logits, guide_image, proxy_image)
+
+    assert masks.shape == (1, full_h, full_w)
+    assert masks.dtype == bool
+    row = masks[0, full_h // 2]
+    assert not row[:edge_x].any()
+    assert row[edge_x:].all()
+
+
+def test_create_mask_combined_images():
+    image = np.full((400, 600, 3), 128, dtype=np.uint8)
+    first, second = np.zeros((400, 600), dtype=bool), np.zeros((400, 600), dtype=bool)
+    first[:, :300] = True
+    second[:200, 200:] = True
+    masks = [{"segmentation": first, "area": int(first.sum())}, {"segmentation": second, "area": int(second.sum())}]
+
+    overview, label = create_mask_combined_images(image, masks, max_size=300)
+
+    assert label == "Masked"
+    assert overview.shape == (200, 300, 3)
+    lut = get_color_lut(len(masks))
+    # Later masks are drawn on top
+    expected = (128 * 0.3 + lut[1:] * 0.7).astype(np.uint8)
+    assert np.array_equal(overview[150, 50], expected[0])
+    assert np.array_equal(overview[50, 250], expected[1])
+    assert np.array_equal(overview[150, 250], image[0, 0])
+
+
+def test_create_mask_gallery(tmp_path):
+    image = np.random.default_rng(0).integers(0, 255, (800, 1200, 3), dtype=np.uint8)
+    small, large = np.zeros((800, 1200), dtype=bool), np.zeros((800, 1200), dtype=bool)
+    small[100:150, 200:260] = True
+    small[120:130, 220:230] = False
+    large[:, :1000] = True
+    masks = [{"segmentation": small, "area": int(small.sum())}, {"segmentation": large, "area": int(large.sum())}]
+
+    gallery = create_mask_gallery(image, masks, output_dir=str(tmp_path), max_size=256)
+
+    assert [label for _, label in gallery] == ["Part 0", "Part 1"]
+    large_preview, small_preview = (Image.open(path) for path, _ in gallery)
+    assert small_preview.mode == "RGBA" and small_preview.size == (60, 50)
+    assert np.array(small_preview)[25, 25, 3] == 0
+    assert large_preview.size == (256, 205)
@@ -0,0 +1,72 @@
+import pytest
+import numpy as np
+import torch
+from sam2.build_sam import build_sam2
+from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+from test_config import *
+from modules.paths import *
+from modules.onnx_backend import OnnxImagePredictor, export_onnx_models, is_onnx_model_exist
+
+pytest.importorskip("onnxruntime")
+
+
+@pytest.fixture(scope="module")
+def exported_model(tmp_path_factory):
+    torch.manual_seed(0)
+    model = build_sam2(config_file=MODEL_CONFIGS[TEST_MODEL], ckpt_path=None, device="cpu")
+    model_dir = str(tmp_path_factory.mktemp("onnx"))
+    export_onnx_models(model, TEST_MODEL, model_dir)
+    return model, model_dir
+
+
+@pytest.mark.parametrize(
+    "model_name,point_coords,point_labels,box,multimask_output",
+    [
+        (TEST_MODEL, TEST_POINTS, TEST_LABELS, None, True),
+        (TEST_MODEL, None, None, TEST_BOX, True),
+        (TEST_MODEL, TEST_POINTS, TEST_LABELS, TEST_BOX, False),
+    ]
+)
+def test_onnx_image_predictor(
+    model_name: str,
+    point_coords: np.ndarray,
+    point_labels: np.ndarray,
+    box: np.ndarray,
+    multimask_output: bool,
+    exported_model
+):
+    model, model_dir = exported_model
+    assert is_onnx_model_exist(model_name, model_dir)
+
+    image = np.random.randint(0, 255, (720, 1280, 3), dtype=np.uint8)
+    torch_predictor = SAM2ImagePredictor(sam_model=model)
+    torch_predictor.set_image(image)
+    onnx_predictor = OnnxImagePredictor(model_name, model_dir, num_threads=2)
+    onnx_predictor.set_image(image)
+
+    params = {
+        "point_coords": point_coords,
+        "point_labels": point_labels,
+        "box": box,
+        "multimask_output": multimask_output
+    }
+    torch_masks, torch_scores, torch_logits = torch_predictor.predict(**params)
+    onnx_masks, onnx_scores, onnx_logits = onnx_predictor.predict(**params)
+
+    assert onnx_masks.shape == torch_masks.shape
+    assert np.allclose(onnx_scores, torch_scores, atol=1e-3)
+    assert np.allclose(onnx_logits, torch_logits, atol=1e-2)
+
+    # Refining the best mask with one more point, like predict_image() does with the prompt history
+    if point_coords is not None and box is None:
+        refine_params = {
+            "point_coords": np.concatenate([point_coords, [[100., 100.]]]),
+            "point_labels": np.concatenate([point_labels, [0.]]),
+            "mask_input": torch_logits[np.argmax(torch_scores)][None],
+            "multimask_output": False
+        }
+        torch_masks, torch_scores, torch_logits = torch_predictor.predict(**refine_params)
+        onnx_masks, onnx_scores, onnx_logits = onnx_predictor.predict(**refine_params)
+        assert np.allclose(onnx_scores, torch_scores, atol=1e-3)
+        assert np.allclose(onnx_logits, torch_logits, atol=1e-2)
@@ -0,0 +1,39 @@
+import pytest
+import torch
+from sam2.build_sam import build_sam2
+
+from test_config import *
+from modules.paths import *
+from modules.model_downloader import (QUANTIZED_MODEL_SUFFIX, QUANTIZED_MODELS, AVAILABLE_MODELS,
+                                      get_base_model_type, is_quantized_model_type)
+from modules.quantization import get_quantized_model_path, load_quantized_model
+
+
+def test_quantized_model_types():
+    assert len(QUANTIZED_MODELS) == len(AVAILABLE_MODELS)
+    for model_type in QUANTIZED_MODELS:
+        assert is_quantized_model_type(model_type)
+        assert get_base_model_type(model_type) in AVAILABLE_MODELS
+
+
+@pytest.mark.parametrize(
+    "model_name",
+    [
+        TEST_MODEL + QUANTIZED_MODEL_SUFFIX
+    ]
+)
+def test_quantized_weights_cache(model_name: str, tmp_path):
+    config_path = MODEL_CONFIGS[get_base_model_type(model_name)]
+    model = build_sam2(config_file=config_path, ckpt_path=None, device="cpu")
+    model = load_quantized_model(model, model_name, str(tmp_path))
+
+    quantized_path = get_quantized_model_path(model_name, str(tmp_path))
+    assert os.path.exists(quantized_path)
+
+    reloaded = build_sam2(config_file=config_path, ckpt_path=None, device="cpu")
+    reloaded = load_quantized_model(reloaded, model_name, str(tmp_path))
+
+    linear = reloaded.memory_attention.layers[0].self_attn.q_proj
+    assert isinstance(linear, torch.ao.nn.quantized.dynamic.Linear)
+    assert torch.equal(linear.weight().int_repr(),
+                       model.memory_attention.layers[0].self_attn.q_proj.weight().int_repr())
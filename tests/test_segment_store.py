@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from modules.segment_store import SegmentStore
+
+
+@pytest.fixture
+def frame_paths(tmp_path):
+    paths = []
+    for frame_idx in range(6):
+        path = str(tmp_path / f"{frame_idx:05d}.jpg")
+        Image.fromarray(np.full((30, 40, 3), frame_idx * 40, dtype=np.uint8)).save(path)
+        paths.append(path)
+    return paths
+
+
+@pytest.mark.parametrize(
+    "ram_budget_mb,expected_spilled",
+    [
+        (None, 0),
+        # Room for two frames of 2x1x30x40 masks
+        (2 * 2 * 30 * 40 / 1024 ** 2, 4),
+    ]
+)
+def test_segment_store(frame_paths, tmp_path, ram_budget_mb, expected_spilled):
+    rng = np.random.default_rng(0)
+    masks = {frame_idx: rng.random((2, 1, 30, 40)) > 0.5 for frame_idx in range(len(frame_paths))}
+
+    spill_dir = str(tmp_path / "spill")
+    store = SegmentStore(frame_paths, ram_budget_mb=ram_budget_mb, spill_dir=spill_dir)
+    for frame_idx, frame_masks in masks.items():
+        store.add(frame_idx, frame_masks, [0, 1])
+    assert store.num_spilled == expected_spilled
+    assert len(store) == len(frame_paths)
+
+    for frame_idx, segment in sorted(store.items()):
+        assert np.array_equal(segment["mask"], masks[frame_idx])
+        assert segment["obj_ids"] == [0, 1]
+        assert segment["image"].shape == (30, 40, 3)
+
+    store.close()
+    assert not os.path.exists(spill_dir) or not os.listdir(spill_dir)
+
+
+def test_segment_store_logits(frame_paths, tmp_path):
+    logits = np.random.default_rng(0).normal(size=(1, 1, 8, 8))
+    store = SegmentStore(frame_paths, ram_budget_mb=0, spill_dir=str(tmp_path), keep_logits=True)
+    store.add(0, logits, [0])
+    store.add(1, logits, [0])
+    assert store.num_spilled == 1
+
+    for frame_idx in [0, 1]:
+        segment = store[frame_idx]
+        assert "logits" in segment and "mask" not in segment
+        assert segment["logits"].dtype == np.float16
+        assert np.allclose(segment["logits"], logits, atol=1e-2)
+    store.close()
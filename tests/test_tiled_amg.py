@@ -0,0 +1,56 @@
+import pytest
+import cv2
+import numpy as np
+
+from modules.tiled_amg import get_tiles, generate_tiled_masks
+
+
+class ComponentMaskGenerator:
+    """Segments the connected components of the bright pixels, like automatic segmentation of a simple image."""
+
+    def generate(self, image: np.ndarray):
+        num_labels, labels = cv2.connectedComponents((image[..., 0] > 0).astype(np.uint8))
+        return [{"segmentation": labels == label, "predicted_iou": 0.9, "stability_score": 0.9,
+                 "point_coords": [[0, 0]]} for label in range(1, num_labels)]
+
+
+@pytest.mark.parametrize(
+    "width,height,tile_size,overlap",
+    [
+        (1000, 800, 1536, 256),
+        (5000, 3000, 1536, 256),
+        (4097, 1537, 1024, 128),
+    ]
+)
+def test_get_tiles(width: int, height: int, tile_size: int, overlap: int):
+    tiles = get_tiles(width, height, tile_size=tile_size, overlap=overlap)
+
+    covered = np.zeros((height, width), dtype=bool)
+    for x0, y0, x1, y1 in tiles:
+        assert 0 <= x0 < x1 <= width and 0 <= y0 < y1 <= height
+        assert x1 - x0 <= tile_size and y1 - y0 <= tile_size
+        covered[y0:y1, x0:x1] = True
+    assert covered.all()
+
+    xs = sorted({x0 for x0, _, _, _ in tiles})
+    tile_w = tiles[0][2] - tiles[0][0]
+    assert all(next_x - x <= tile_w - overlap for x, next_x in zip(xs, xs[1:]))
+
+
+def test_generate_tiled_masks():
+    image = np.zeros((600, 1000, 3), dtype=np.uint8)
+    # Crosses the seam between the tiles
+    cv2.rectangle(image, (300, 100), (700, 200), (255, 255, 255), -1)
+    # Inside the overlap of the tiles, so both tiles segment it
+    cv2.circle(image, (500, 400), 30, (255, 255, 255), -1)
+    # Only in one tile
+    cv2.circle(image, (100, 500), 40, (255, 255, 255), -1)
+
+    masks = generate_tiled_masks(image, ComponentMaskGenerator, tile_size=600, overlap=200, max_workers=2)
+
+    assert len(masks) == 3
+    expected = ComponentMaskGenerator().generate(image)
+    for mask in masks:
+        assert mask["segmentation"].shape == (600, 1000)
+        assert any(np.array_equal(mask["segmentation"], e["segmentation"]) for e in expected)
+    assert masks[0]["bbox"] == [300, 100, 401, 101]
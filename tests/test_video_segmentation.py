@@ -1,5 +1,5 @@
 import pytest
-from typing import Dict
+from typing import Mapping
 
 from test_config import *
 import numpy as np
@@ -49,7 +49,7 @@ def test_video_segmentation(
 
     video_segments = inferencer.propagate_in_video()
 
-    assert video_segments and isinstance(video_segments, Dict)
+    assert video_segments and isinstance(video_segments, Mapping)
 
 
 @pytest.mark.skipif(
@@ -92,3 +92,304 @@ def test_filtered_video_creation_pipeline(
     )
 
     assert os.path.exists(out_path)
+
+
+@pytest.mark.parametrize(
+    "prompted_frames,num_frames,frame_range,max_frames,expected",
+    [
+        ([0], 10, None, None, [(0, 9, False)]),
+        ([4, 7], 10, None, None, [(4, 5, False), (4, 4, True)]),
+        ([4], 10, (2, 6), None, [(4, 2, False), (4, 2, True)]),
+        ([4], 10, None, 3, [(4, 3, False), (4, 3, True)]),
+        ([8], 10, (0, 5), None, [(0, 5, False)]),
+    ]
+)
+def test_propagation_ranges(
+    prompted_frames: list,
+    num_frames: int,
+    frame_range: tuple,
+    max_frames: int,
+    expected: list
+):
+    ranges = SamInference.get_propagation_ranges(
+        prompted_frames=prompted_frames,
+        num_frames=num_frames,
+        frame_range=frame_range,
+        max_frames=max_frames
+    )
+
+    assert ranges == expected
+
+
+@pytest.mark.parametrize(
+    "first_frame_idx,last_frame_idx,window_size,overlap,reverse,expected",
+    [
+        (0, 9, 10, 2, False, [(0, 9)]),
+        (0, 9, 4, 1, False, [(0, 3), (3, 6), (6, 9)]),
+        (2, 11, 5, 2, False, [(2, 6), (5, 9), (8, 11)]),
+        (0, 9, 4, 1, True, [(6, 9), (3, 6), (0, 3)]),
+    ]
+)
+def test_video_windows(
+    first_frame_idx: int,
+    last_frame_idx: int,
+    window_size: int,
+    overlap: int,
+    reverse: bool,
+    expected: list
+):
+    windows = SamInference.get_video_windows(
+        first_frame_idx=first_frame_idx,
+        last_frame_idx=last_frame_idx,
+        window_size=window_size,
+        overlap=overlap,
+        reverse=reverse
+    )
+
+    assert windows == expected
+
+
+def test_shot_tracks_only_track_objects_prompted_in_the_shot():
+    sam_inference = SamInference()
+    sam_inference.frame_cache.frame_paths = [f"{idx:05d}.jpg" for idx in range(30)]
+    sam_inference.video_shots = [(0, 9), (10, 19), (20, 29)]
+    for obj_id, frame_idx, x in [(0, 12, 1.0), (0, 25, 2.0), (1, 3, 3.0)]:
+        sam_inference.set_video_prompt(frame_idx=frame_idx, obj_id=obj_id, points=np.array([[x, x]]),
+                                       labels=np.array([1]), box=None)
+
+    shot_tracks = sam_inference.get_shot_tracks(frame_range=(5, 29))
+
+    assert [(track["first"], track["last"]) for track in shot_tracks] == [(5, 9), (10, 19), (20, 29)]
+    # Object 1 is prompted in the first shot before the frame range, so the window state starts at its prompt
+    assert {obj_id: list(prompts) for obj_id, prompts in shot_tracks[0]["prompts"].items()} == {1: [3]}
+    assert shot_tracks[0]["window"] == (3, 9)
+    assert shot_tracks[0]["ranges"] == [(5, 4, False)]
+    # Prompts are never carried into shots where the object isn't prompted
+    assert {obj_id: list(prompts) for obj_id, prompts in shot_tracks[1]["prompts"].items()} == {0: [12]}
+    assert shot_tracks[1]["prompts"][0][12]["points"].tolist() == [[1.0, 1.0]]
+    assert {obj_id: list(prompts) for obj_id, prompts in shot_tracks[2]["prompts"].items()} == {0: [25]}
+    assert shot_tracks[1]["window"] == (10, 19)
+    assert shot_tracks[1]["ranges"] == [(12, 7, False), (12, 2, True)]
+    assert shot_tracks[2]["ranges"] == [(25, 4, False), (25, 5, True)]
+
+    assert all(track["carried"] == {} for track in shot_tracks)
+
+    # Carried objects are prompted on the first frame of the shot with their nearest prompt
+    shot_tracks = sam_inference.get_shot_tracks(frame_range=(5, 29), carry_objects=True)
+    assert {obj_id: carried["frame_idx"] for obj_id, carried in shot_tracks[0]["carried"].items()} == {0: 12}
+    assert {obj_id: carried["frame_idx"] for obj_id, carried in shot_tracks[1]["carried"].items()} == {1: 3}
+    assert {obj_id: carried["frame_idx"] for obj_id, carried in shot_tracks[2]["carried"].items()} == {1: 3}
+    assert shot_tracks[2]["carried"][1]["prompt"]["points"].tolist() == [[3.0, 3.0]]
+    assert shot_tracks[1]["ranges"] == [(10, 9, False)]
+
+    sam_inference.clear_video_prompts(obj_id=1)
+    shot_tracks = sam_inference.get_shot_tracks(frame_range=(5, 29))
+    assert shot_tracks[0]["prompts"] == {}
+    assert shot_tracks[0]["window"] == (5, 9)
+
+
+@pytest.mark.parametrize("keep_mask_logits,mask_key", [(False, "mask"), (True, "logits")])
+def test_empty_shot_segments_use_mask_key(tmp_path, monkeypatch, keep_mask_logits, mask_key):
+    from PIL import Image
+    import modules.sam_inference as sam_inference_module
+
+    for frame_idx in range(3):
+        Image.fromarray(np.zeros((4, 6, 3), dtype=np.uint8)).save(tmp_path / f"{frame_idx:05d}.jpg")
+    monkeypatch.setattr(sam_inference_module, "TEMP_DIR", str(tmp_path))
+
+    sam_inference = SamInference(keep_mask_logits=keep_mask_logits)
+    segments = dict(sam_inference.get_empty_shot_segments({"first": 1, "last": 2}))
+
+    assert sorted(segments) == [1, 2]
+    assert segments[1]["obj_ids"] == [] and segments[1][mask_key].shape == (0, 1, 4, 6)
+
+
+def test_video_prompts_per_object():
+    sam_inference = SamInference()
+    sam_inference.set_video_prompt(frame_idx=0, obj_id=0, points=np.array([[1, 1]]), labels=np.array([1]))
+    sam_inference.set_video_prompt(frame_idx=5, obj_id=0, box=np.array([[0, 0, 4, 4], [1, 1, 5, 5]]))
+    sam_inference.set_video_prompt(frame_idx=0, obj_id=1, points=np.array([[2, 2]]), labels=np.array([0]))
+    # The prompt of the same object and frame is overwritten
+    sam_inference.set_video_prompt(frame_idx=0, obj_id=0, points=np.array([[3, 3]]), labels=np.array([1]))
+
+    prompts = sam_inference.video_prompts
+    assert {obj_id: sorted(frame_prompts) for obj_id, frame_prompts in prompts.items()} == {0: [0, 5], 1: [0]}
+    assert prompts[0][0]["points"].tolist() == [[3, 3]]
+    assert prompts[0][5]["points"] is None and prompts[0][5]["box"].tolist() == [[0, 0, 4, 4]]
+    assert prompts[1][0]["labels"].tolist() == [0]
+
+    sam_inference.clear_video_prompts(obj_id=0)
+    assert list(sam_inference.video_prompts) == [1]
+    sam_inference.clear_video_prompts()
+    assert sam_inference.video_prompts == {}
+
+
+def test_invert_object_masks():
+    masks = np.zeros((2, 1, 2, 3), dtype=bool)
+    masks[0, 0, 0, 0] = True
+    masks[1, 0, 1, 2] = True
+
+    inverted = SamInference.invert_object_masks(masks)
+
+    assert inverted.shape == (1, 1, 2, 3)
+    assert inverted[0, 0].tolist() == [[False, True, True], [True, True, False]]
+
+
+class FakeVideoPredictor:
+    """Video predictor that yields fixed mask logits for the objects, in the order the objects were added."""
+
+    def __init__(self, obj_ids, height, width):
+        self.obj_ids = obj_ids
+        self.height, self.width = height, width
+        self.passes = []
+        self.mask_prompts = {}
+
+    def add_new_mask(self, inference_state, frame_idx, obj_id, mask):
+        self.mask_prompts[(frame_idx, obj_id)] = mask
+
+    def clear_all_prompts_in_frame(self, inference_state, frame_idx, obj_id, need_output=True):
+        self.mask_prompts.pop((frame_idx, obj_id))
+
+    def propagate_in_video(self, inference_state, start_frame_idx, max_frame_num_to_track, reverse):
+        import torch
+
+        self.passes.append((start_frame_idx, max_frame_num_to_track, reverse, dict(self.mask_prompts)))
+        step = -1 if reverse else 1
+        for frame_idx in range(start_frame_idx, start_frame_idx + step * (max_frame_num_to_track + 1), step):
+            logits = torch.full((len(self.obj_ids), 1, self.height, self.width), -1.0)
+            for obj_idx in range(len(self.obj_ids)):
+                logits[obj_idx, 0, :, obj_idx] = 1.0
+            yield frame_idx, list(self.obj_ids), logits
+
+
+def test_propagated_frame_has_a_mask_per_object(tmp_path, monkeypatch):
+    from PIL import Image
+    import modules.sam_inference as sam_inference_module
+
+    for frame_idx in range(3):
+        Image.fromarray(np.zeros((4, 6, 3), dtype=np.uint8)).save(tmp_path / f"{frame_idx:05d}.jpg")
+    monkeypatch.setattr(sam_inference_module, "TEMP_DIR", str(tmp_path))
+
+    sam_inference = SamInference(segment_ram_budget_mb=None)
+    sam_inference.device = "cpu"
+    sam_inference.video_tracking_dir = str(tmp_path)
+    sam_inference.video_predictor = FakeVideoPredictor(obj_ids=[3, 1], height=4, width=6)
+    inference_state = {
+        "point_inputs_per_obj": {0: {1: "prompt"}, 1: {1: "prompt"}},
+        "mask_inputs_per_obj": {0: {}, 1: {}},
+        "num_frames": 3,
+    }
+
+    video_segments = sam_inference.propagate_in_video(inference_state=inference_state)
+
+    assert sorted(video_segments) == [0, 1, 2]
+    segment = video_segments[2]
+    assert segment["obj_ids"] == [3, 1]
+    assert segment["mask"].shape == (2, 1, 4, 6)
+    # Each object keeps its own mask, in the order of obj_ids
+    assert segment["mask"][0, 0, :, 0].all() and not segment["mask"][0, 0, :, 1].any()
+    assert segment["mask"][1, 0, :, 1].all() and not segment["mask"][1, 0, :, 0].any()
+    video_segments.close()
+
+
+@pytest.mark.parametrize(
+    "start_frame_idx,max_frame_num_to_track,reverse,tracked_frames,expected",
+    [
+        (5, 4, False, set(), (5, 4)),
+        (5, 4, False, {5, 6, 7}, (7, 2)),
+        (5, 4, False, {5, 6, 7, 8, 9}, None),
+        (5, 3, True, {5, 4}, (4, 2)),
+        # Tracked frames after the untracked ones are tracked again, only the start is skipped
+        (5, 4, False, {3, 4, 8, 9}, (5, 2)),
+    ]
+)
+def test_resumed_range(start_frame_idx, max_frame_num_to_track, reverse, tracked_frames, expected):
+    assert SamInference.get_resumed_range(start_frame_idx, max_frame_num_to_track, reverse,
+                                          tracked_frames=tracked_frames) == expected
+
+
+def test_propagation_resumes_from_mask_checkpoint(tmp_path, monkeypatch):
+    from PIL import Image
+    import modules.sam_inference as sam_inference_module
+    from modules.mask_tracks import MaskCheckpoint
+
+    for frame_idx in range(4):
+        Image.fromarray(np.zeros((4, 6, 3), dtype=np.uint8)).save(tmp_path / f"{frame_idx:05d}.jpg")
+    monkeypatch.setattr(sam_inference_module, "TEMP_DIR", str(tmp_path))
+
+    sam_inference = SamInference(segment_ram_budget_mb=None)
+    sam_inference.device = "cpu"
+    sam_inference.video_tracking_dir = str(tmp_path)
+    predictor = sam_inference.video_predictor = FakeVideoPredictor(obj_ids=[3, 1], height=4, width=6)
+    inference_state = {
+        "obj_id_to_idx": {3: 0, 1: 1},
+        "point_inputs_per_obj": {0: {0: "prompt"}, 1: {0: "prompt"}},
+        "mask_inputs_per_obj": {0: {}, 1: {}},
+        "num_frames": 4,
+    }
+    checkpoint = MaskCheckpoint(str(tmp_path / "masks"))
+    saved_masks = np.ones((2, 1, 4, 6), dtype=bool)
+    saved_masks[1, 0, 0, 0] = False
+    for frame_idx in [0, 1]:
+        checkpoint.add(frame_idx, saved_masks, [3, 1])
+
+    video_segments = sam_inference.propagate_in_video(inference_state=inference_state, mask_checkpoint=checkpoint)
+
+    # Only the frames after the saved ones are tracked, from the last saved frame with its masks as prompts
+    assert [tracked_pass[:3] for tracked_pass in predictor.passes] == [(1, 2, False)]
+    mask_prompts = predictor.passes[0][3]
+    assert sorted(mask_prompts) == [(1, 1), (1, 3)]
+    assert np.array_equal(mask_prompts[(1, 1)], saved_masks[1, 0])
+    assert predictor.mask_prompts == {}
+    assert sorted(video_segments) == [0, 1, 2, 3]
+    assert np.array_equal(video_segments[1]["mask"], saved_masks)
+    assert not video_segments[3]["mask"][0, 0, :, 1].any()
+    assert [frame_idx for frame_idx, _, _ in checkpoint.load()] == [0, 1, 2, 3]
+    video_segments.close()
+
+
+class FakeWindowVideoPredictor(FakeVideoPredictor):
+    """Fake video predictor that also initializes inference states of frame directories and adds point prompts."""
+
+    def init_state(self, video_path):
+        return {"num_frames": len(os.listdir(video_path)), "obj_ids": [], "obj_id_to_idx": {}}
+
+    def add_new_points_or_box(self, inference_state, frame_idx, obj_id, points=None, labels=None, box=None):
+        import torch
+
+        inference_state["obj_id_to_idx"].setdefault(obj_id, len(inference_state["obj_ids"]))
+        if obj_id not in inference_state["obj_ids"]:
+            inference_state["obj_ids"].append(obj_id)
+        return frame_idx, list(inference_state["obj_ids"]), torch.zeros((1, 1, self.height, self.width))
+
+    def reset_state(self, inference_state):
+        inference_state["obj_ids"].clear()
+
+
+def test_strided_propagation_interpolates_between_keyframes(tmp_path, monkeypatch):
+    from PIL import Image
+    import modules.sam_inference as sam_inference_module
+
+    frames_dir = tmp_path / "frames"
+    frames_dir.mkdir()
+    for frame_idx in range(7):
+        Image.fromarray(np.full((4, 6, 3), 128, dtype=np.uint8)).save(frames_dir / f"{frame_idx:05d}.jpg")
+    monkeypatch.setattr(sam_inference_module, "TEMP_DIR", str(frames_dir))
+    monkeypatch.setattr(sam_inference_module, "VIDEO_KEYFRAME_DIR", str(tmp_path / "keyframes"))
+
+    sam_inference = SamInference(keyframe_stride=3)
+    sam_inference.device = "cpu"
+    sam_inference.video_tracking_dir = str(frames_dir)
+    predictor = sam_inference.video_predictor = FakeWindowVideoPredictor(obj_ids=[0], height=4, width=6)
+    sam_inference.set_video_prompt(frame_idx=0, obj_id=0, points=np.array([[1, 1]]), labels=np.array([1]))
+
+    segments = dict(sam_inference.propagate_in_video_strided())
+
+    # Only the keyframes 0, 3 and 6 are tracked, and the frames between them are interpolated
+    assert [tracked_pass[:3] for tracked_pass in predictor.passes] == [(0, 2, False)]
+    assert sorted(segments) == list(range(7))
+    for segment in segments.values():
+        assert segment["obj_ids"] == [0]
+        assert segment["mask"].shape == (1, 1, 4, 6)
+        assert segment["mask"][0, 0, :, 0].all() and not segment["mask"][0, 0, :, 1:].any()
+    assert not os.path.exists(tmp_path / "keyframes")
@@ -0,0 +1,40 @@
+import numpy as np
+
+from modules.video_state import FeatureCache, VideoInferenceState, diff_video_prompts
+
+
+def test_video_inference_state_keeps_recent_features():
+    state = VideoInferenceState({"cached_features": {0: "features-0"}, "num_frames": 10}, max_cached_features=2)
+
+    # SAM2 replaces the cache with the last frame on a cache miss
+    state["cached_features"] = {1: "features-1"}
+    assert isinstance(state["cached_features"], FeatureCache)
+    assert state["cached_features"].get(0) == "features-0"
+
+    state["cached_features"] = {2: "features-2"}
+    assert list(state["cached_features"]) == [0, 2]
+    assert state["cached_features"].get(1, (None, None)) == (None, None)
+
+    state["num_frames"] = 5
+    assert state["num_frames"] == 5
+
+
+def test_diff_video_prompts():
+    def prompt(x: float, box=None):
+        return {"points": np.array([[x, x]]), "labels": np.array([1]), "box": box}
+
+    applied = {
+        0: {0: prompt(1), 5: prompt(2)},
+        1: {3: prompt(3)},
+    }
+    registered = {
+        0: {0: prompt(1), 5: prompt(4), 7: prompt(5)},
+        2: {1: prompt(6, box=np.array([[0, 0, 4, 4]]))},
+    }
+
+    removed_objects, cleared, added = diff_video_prompts(applied, registered)
+
+    assert removed_objects == [1]
+    assert cleared == [(0, 5)]
+    assert added == [(0, 5), (0, 7), (2, 1)]
+    assert diff_video_prompts(registered, registered) == ([], [], [])
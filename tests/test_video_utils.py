@@ -0,0 +1,111 @@
+import pytest
+from fractions import Fraction
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from modules.video_utils import parse_video_info, get_encoding_segments, detect_shots, get_region_histogram
+
+PROBE_NTSC_WITH_AUDIO = {
+    "streams": [
+        {
+            "codec_type": "video", "codec_name": "h264", "width": 1920, "height": 1080, "pix_fmt": "yuv420p",
+            "r_frame_rate": "30000/1001", "avg_frame_rate": "30000/1001", "duration": "10.010000",
+            "nb_frames": "300", "side_data_list": [{"side_data_type": "Display Matrix", "rotation": -90}]
+        },
+        {
+            "codec_type": "audio", "codec_name": "aac", "sample_rate": "48000", "channels": 2
+        }
+    ],
+    "format": {"duration": "10.020000"}
+}
+
+PROBE_WEBM_WITHOUT_FRAME_COUNT = {
+    "streams": [
+        {
+            "codec_type": "video", "codec_name": "vp9", "width": 640, "height": 360, "pix_fmt": "yuv420p",
+            "r_frame_rate": "25/1", "avg_frame_rate": "0/0", "tags": {"rotate": "180"}
+        }
+    ],
+    "format": {"duration": "4.000000"}
+}
+
+
+@pytest.mark.parametrize(
+    "probe,expected",
+    [
+        (PROBE_NTSC_WITH_AUDIO, {
+            "num_frames": 300, "frame_rate": Fraction(30000, 1001), "duration": 10.01, "has_sound": True,
+            "codec": "h264", "width": 1920, "height": 1080, "pix_fmt": "yuv420p", "rotation": 270,
+            "audio_codec": "aac", "audio_sample_rate": 48000, "audio_channels": 2
+        }),
+        (PROBE_WEBM_WITHOUT_FRAME_COUNT, {
+            "num_frames": 100, "frame_rate": Fraction(25), "duration": 4.0, "has_sound": False,
+            "codec": "vp9", "width": 640, "height": 360, "rotation": 180, "audio_codec": None
+        }),
+        ({"streams": [], "format": {}}, {
+            "num_frames": None, "frame_rate": None, "has_sound": False
+        }),
+    ]
+)
+def test_parse_video_info(probe: dict, expected: dict):
+    info = parse_video_info(probe)
+
+    for key, value in expected.items():
+        assert getattr(info, key) == value
+
+
+@pytest.mark.parametrize(
+    "start_number,num_frames,segment_frames,gop_size,max_workers,expected",
+    [
+        (0, 100, 240, 50, 4, [(0, 100)]),
+        (0, 1000, 240, 50, 4, [(0, 250), (250, 250), (500, 250), (750, 250)]),
+        (10, 1000, 240, 48, 4, [(10, 288), (298, 288), (586, 288), (874, 136)]),
+        (0, 600, 240, 60, 8, [(0, 240), (240, 240), (480, 120)]),
+    ]
+)
+def test_get_encoding_segments(
+    start_number: int,
+    num_frames: int,
+    segment_frames: int,
+    gop_size: int,
+    max_workers: int,
+    expected: list
+):
+    segments = get_encoding_segments(start_number, num_frames, segment_frames, gop_size, max_workers)
+
+    assert segments == expected
+    assert sum(length for _, length in segments) == num_frames
+    assert all(length % gop_size == 0 for _, length in segments[:-1])
+
+
+def test_detect_shots(tmp_path):
+    frame_paths = []
+    colors = [(200, 40, 40)] * 5 + [(255, 255, 255)] + [(40, 200, 40)] * 6 + [(40, 40, 200)] * 3
+    for frame_idx, color in enumerate(colors):
+        image = np.full((64, 96, 3), color, dtype=np.uint8)
+        image[16:48, 24:72] = (120 + frame_idx, 128, 128)
+        frame_path = str(tmp_path / f"{frame_idx:05d}.jpg")
+        Image.fromarray(image).save(frame_path)
+        frame_paths.append(frame_path)
+
+    # The cut after the white flash is closer than min_shot_frames to the start of the shot
+    assert detect_shots(frame_paths, threshold=0.5, min_shot_frames=3) == [(0, 4), (5, 11), (12, 14)]
+    assert detect_shots(frame_paths, threshold=0) == [(0, 14)]
+    assert detect_shots([], threshold=0.5) == []
+
+
+def test_region_histogram(tmp_path):
+    image = np.full((64, 96, 3), (200, 40, 40), dtype=np.uint8)
+    image[:, 48:] = (40, 40, 200)
+    frame_path = str(tmp_path / "00000.png")
+    Image.fromarray(image).save(frame_path)
+    # Masks at a lower resolution are resized to the frame
+    left, right = np.zeros((16, 24), dtype=bool), np.zeros((16, 24), dtype=bool)
+    left[:, :12], right[:, 12:] = True, True
+
+    left_hist = get_region_histogram(frame_path, left)
+    assert left_hist.sum() == 64 * 48
+    assert cv2.compareHist(left_hist, get_region_histogram(frame_path, left), cv2.HISTCMP_BHATTACHARYYA) < 1e-6
+    assert cv2.compareHist(left_hist, get_region_histogram(frame_path, right), cv2.HISTCMP_BHATTACHARYYA) > 0.9